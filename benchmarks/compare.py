@@ -0,0 +1,58 @@
+#
+# Copyright 2016-2017 University of Oxford
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Compares two sets of benchmark results written by :mod:`benchmarks.run`,
+printing the median of each metric in both and the ratio between them.
+"""
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import json
+
+METRICS = [
+    "throughput_mib_s", "wall_time", "time_to_first_byte", "cpu_time", "peak_rss_kib"]
+
+
+def load_results(path):
+    with open(path) as f:
+        report = json.load(f)
+    return report, {
+        (result["scenario"], result["mode"], result["parallelism"]): result["median"]
+        for result in report["results"]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare htsget benchmark results.")
+    parser.add_argument("baseline", help="The baseline results file.")
+    parser.add_argument("results", help="The results file to compare with the baseline.")
+    args = parser.parse_args()
+    baseline_report, baseline = load_results(args.baseline)
+    report, results = load_results(args.results)
+    print("baseline: {}\nresults:  {}".format(
+        baseline_report["commit"], report["commit"]))
+    for key in sorted(set(baseline.keys()) & set(results.keys())):
+        print("{} {} parallelism={}".format(*key))
+        for metric in METRICS:
+            before = baseline[key][metric]
+            after = results[key][metric]
+            ratio = after / before if before else float("nan")
+            print("    {:<20}{:>14.3f}{:>14.3f}{:>10.2f}x".format(
+                metric, before, after, ratio))
+
+
+if __name__ == "__main__":
+    main()
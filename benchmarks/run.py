@@ -0,0 +1,250 @@
+#
+# Copyright 2016-2017 University of Oxford
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Runs the htsget benchmarks and writes the results as JSON. Each transfer is
+run in a separate process, so that the CPU time and peak memory usage of
+the transfer can be measured. Run from the root of the repository using::
+
+    python -m benchmarks.run -o results.json
+"""
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import benchmarks.server as server
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CLI_SCRIPT = os.path.join(ROOT_DIR, "htsget_dev.py")
+READ_SIZE = 65536
+
+MODE_API = "api"
+MODE_CLI = "cli"
+MODES = [MODE_API, MODE_CLI]
+
+# The server configurations for each scenario.
+SCENARIOS = {
+    "small-blocks": server.ServerConfig(num_blocks=256, block_size=64 * 1024),
+    "large-blocks": server.ServerConfig(num_blocks=8, block_size=16 * 2**20),
+    "mixed-blocks": server.ServerConfig(
+        num_blocks=64, block_size=2**20, size_distribution=server.SIZE_LOGNORMAL,
+        data_uri_fraction=0.1),
+    "high-latency": server.ServerConfig(num_blocks=32, block_size=2**20, latency=0.05),
+    "limited-bandwidth": server.ServerConfig(
+        num_blocks=8, block_size=4 * 2**20, bandwidth=32 * 2**20),
+}
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2 == 1:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], cwd=ROOT_DIR,
+            stderr=subprocess.STDOUT).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class TimingOutput(object):
+    """
+    An output that discards the data written to it, recording the amount of
+    data and the time at which the first byte was written.
+    """
+    def __init__(self):
+        self.file = open(os.devnull, "wb")
+        self.size = 0
+        self.first_byte_time = None
+
+    def write(self, data):
+        if self.first_byte_time is None and len(data) > 0:
+            self.first_byte_time = time.time()
+        self.size += len(data)
+        return self.file.write(data)
+
+    def tell(self):
+        return self.size
+
+    def seek(self, offset, whence=0):
+        self.size = offset
+        self.file.seek(offset, whence)
+
+    def truncate(self, size=None):
+        pass
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def run_worker(args):
+    """
+    Runs a single transfer using the API, and prints the timings as JSON.
+    """
+    import htsget
+
+    output = TimingOutput()
+    before = time.time()
+    htsget.get(args.url, output, parallelism=args.parallelism[0], max_retries=0)
+    wall_time = time.time() - before
+    output.close()
+    print(json.dumps({
+        "bytes": output.size, "wall_time": wall_time,
+        "time_to_first_byte": output.first_byte_time - before}))
+
+
+def wait(process):
+    """
+    Waits for the specified process to exit and returns its resource usage.
+    """
+    _, status, rusage = os.wait4(process.pid, 0)
+    process.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -1
+    if process.returncode != 0:
+        raise ValueError("Benchmark process failed with status {}".format(status))
+    peak_rss = rusage.ru_maxrss
+    if sys.platform == "darwin":
+        # Reported in bytes on macOS and kilobytes elsewhere.
+        peak_rss //= 1024
+    return {
+        "user_time": rusage.ru_utime, "system_time": rusage.ru_stime,
+        "cpu_time": rusage.ru_utime + rusage.ru_stime, "peak_rss_kib": peak_rss}
+
+
+def measure_api(url, parallelism):
+    cmd = [
+        sys.executable, "-m", "benchmarks.run", "--worker", "--url", url,
+        "--parallelism", str(parallelism)]
+    process = subprocess.Popen(cmd, cwd=ROOT_DIR, stdout=subprocess.PIPE)
+    stdout = process.stdout.read()
+    process.stdout.close()
+    usage = wait(process)
+    result = json.loads(stdout.decode())
+    result.update(usage)
+    return result
+
+
+def measure_cli(url, parallelism):
+    cmd = [sys.executable, CLI_SCRIPT, url, "--parallel", str(parallelism)]
+    before = time.time()
+    process = subprocess.Popen(cmd, cwd=ROOT_DIR, stdout=subprocess.PIPE)
+    size = 0
+    first_byte_time = None
+    while True:
+        data = process.stdout.read1(READ_SIZE) if hasattr(
+            process.stdout, "read1") else process.stdout.read(READ_SIZE)
+        if len(data) == 0:
+            break
+        if first_byte_time is None:
+            first_byte_time = time.time()
+        size += len(data)
+    wall_time = time.time() - before
+    process.stdout.close()
+    result = {
+        "bytes": size, "wall_time": wall_time,
+        "time_to_first_byte": first_byte_time - before}
+    result.update(wait(process))
+    return result
+
+
+def run_benchmark(name, mode, parallelism, repeats):
+    config = SCENARIOS[name]
+    httpd = server.SyntheticServer(config)
+    httpd.start()
+    try:
+        measure = measure_api if mode == MODE_API else measure_cli
+        runs = []
+        for _ in range(repeats):
+            run = measure(httpd.ticket_url, parallelism)
+            if run["bytes"] != httpd.total_size:
+                raise ValueError("Transferred {} bytes; expected {}".format(
+                    run["bytes"], httpd.total_size))
+            run["throughput_mib_s"] = run["bytes"] / 2**20 / run["wall_time"]
+            runs.append(run)
+    finally:
+        httpd.stop()
+    summary = {key: median([run[key] for run in runs]) for key in runs[0].keys()}
+    return {
+        "scenario": name, "mode": mode, "parallelism": parallelism,
+        "server": config.to_dict(), "runs": runs, "median": summary}
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description="Run the htsget benchmarks.")
+    parser.add_argument(
+        "--scenario", "-s", action="append", choices=sorted(SCENARIOS.keys()),
+        help="The scenarios to run. May be repeated; defaults to all scenarios.")
+    parser.add_argument(
+        "--mode", "-m", action="append", choices=MODES,
+        help="Whether to run transfers using the API or the CLI; defaults to both.")
+    parser.add_argument(
+        "--parallelism", "-p", type=int, action="append",
+        help="The parallelism of the transfers. May be repeated; defaults to 1 and 4.")
+    parser.add_argument(
+        "--repeats", "-r", type=int, default=3,
+        help="The number of times to run each benchmark.")
+    parser.add_argument(
+        "--output", "-o", default=None,
+        help="The file to write the results to; defaults to stdout.")
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--url", help=argparse.SUPPRESS)
+    return parser
+
+
+def main():
+    args = get_parser().parse_args()
+    if args.worker:
+        run_worker(args)
+        return
+    scenarios = args.scenario or sorted(SCENARIOS.keys())
+    modes = args.mode or MODES
+    parallelisms = args.parallelism or [1, 4]
+    results = []
+    for name in scenarios:
+        for mode in modes:
+            for parallelism in parallelisms:
+                result = run_benchmark(name, mode, parallelism, args.repeats)
+                print("{} {} parallelism={}: {:.2f} MiB/s".format(
+                    name, mode, parallelism, result["median"]["throughput_mib_s"]),
+                    file=sys.stderr)
+                results.append(result)
+    report = {
+        "commit": git_commit(), "timestamp": time.time(),
+        "python": platform.python_version(), "platform": platform.platform(),
+        "results": results}
+    if args.output is None:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
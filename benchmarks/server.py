@@ -0,0 +1,193 @@
+#
+# Copyright 2016-2017 University of Oxford
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+A synthetic htsget server for benchmarking. The server returns a ticket for
+a configurable number of blocks, whose sizes are drawn from a distribution
+using a fixed seed so that runs are reproducible. Block data is served with
+an optional latency before the response and an optional cap on the
+bandwidth of each connection.
+"""
+from __future__ import division
+from __future__ import print_function
+
+import base64
+import hashlib
+import json
+import random
+import threading
+import time
+
+from six.moves import BaseHTTPServer
+from six.moves import socketserver
+
+TICKET_PATH = "/ticket"
+BLOCK_PREFIX = "/block/"
+WRITE_SIZE = 65536
+
+SIZE_FIXED = "fixed"
+SIZE_UNIFORM = "uniform"
+SIZE_LOGNORMAL = "lognormal"
+SIZE_DISTRIBUTIONS = [SIZE_FIXED, SIZE_UNIFORM, SIZE_LOGNORMAL]
+
+
+class ServerConfig(object):
+    """
+    The configuration of a synthetic server.
+
+    :param int num_blocks: The number of blocks in the ticket.
+    :param int block_size: The mean size of the blocks in bytes.
+    :param str size_distribution: The distribution of the block sizes. One of
+        ``fixed``; ``uniform``, between zero and twice ``block_size``; or
+        ``lognormal``, with a long tail of large blocks.
+    :param float data_uri_fraction: The fraction of the blocks returned as
+        data URIs in the ticket rather than as HTTP URLs.
+    :param float latency: The time in seconds to wait before responding to
+        each request.
+    :param float bandwidth: The maximum rate in bytes per second at which each
+        response body is sent, or None for no limit.
+    :param int seed: The seed for the random number generator.
+    """
+    def __init__(
+            self, num_blocks=16, block_size=2**20, size_distribution=SIZE_FIXED,
+            data_uri_fraction=0, latency=0, bandwidth=None, seed=1):
+        if size_distribution not in SIZE_DISTRIBUTIONS:
+            raise ValueError("Unknown size distribution: {}".format(size_distribution))
+        self.num_blocks = num_blocks
+        self.block_size = block_size
+        self.size_distribution = size_distribution
+        self.data_uri_fraction = data_uri_fraction
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.seed = seed
+
+    def to_dict(self):
+        return dict(self.__dict__)
+
+    def block_sizes(self):
+        rng = random.Random(self.seed)
+        sizes = []
+        for _ in range(self.num_blocks):
+            if self.size_distribution == SIZE_UNIFORM:
+                size = rng.randint(0, 2 * self.block_size)
+            elif self.size_distribution == SIZE_LOGNORMAL:
+                # The mean of this distribution is block_size.
+                size = int(self.block_size * rng.lognormvariate(-0.5, 1))
+            else:
+                size = self.block_size
+            sizes.append(size)
+        return sizes
+
+    def data_uri_blocks(self):
+        rng = random.Random(self.seed + 1)
+        return set(
+            j for j in range(self.num_blocks) if rng.random() < self.data_uri_fraction)
+
+
+def block_data(index, size):
+    """
+    Returns the data for the block with the specified index, which varies with
+    the index so that blocks written out of order are detected.
+    """
+    pattern = hashlib.sha256(str(index).encode()).digest()
+    return (pattern * (size // len(pattern) + 1))[:size]
+
+
+class SyntheticServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    A threaded HTTP server serving the ticket and blocks for the specified
+    configuration.
+    """
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, config, address=("127.0.0.1", 0)):
+        BaseHTTPServer.HTTPServer.__init__(self, address, SyntheticRequestHandler)
+        self.config = config
+        self.blocks = [
+            block_data(j, size) for j, size in enumerate(config.block_sizes())]
+        self.data_uri_blocks = config.data_uri_blocks()
+        self.thread = None
+
+    @property
+    def url(self):
+        return "http://{}:{}".format(*self.server_address[:2])
+
+    @property
+    def ticket_url(self):
+        return self.url + TICKET_PATH
+
+    @property
+    def total_size(self):
+        return sum(len(block) for block in self.blocks)
+
+    def ticket(self):
+        md5 = hashlib.md5()
+        urls = []
+        for j, block in enumerate(self.blocks):
+            md5.update(block)
+            if j in self.data_uri_blocks:
+                urls.append({"url": "data:application/octet-stream;base64,{}".format(
+                    base64.b64encode(block).decode())})
+            else:
+                urls.append({"url": "{}{}{}".format(self.url, BLOCK_PREFIX, j)})
+        return {"htsget": {"format": "BAM", "urls": urls, "md5": md5.hexdigest()}}
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self.thread.join()
+
+
+class SyntheticRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, data):
+        config = self.server.config
+        if config.latency > 0:
+            time.sleep(config.latency)
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        start = time.time()
+        for offset in range(0, len(data), WRITE_SIZE):
+            piece = data[offset: offset + WRITE_SIZE]
+            self.wfile.write(piece)
+            if config.bandwidth is not None:
+                delay = start + (offset + len(piece)) / config.bandwidth - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+
+    def do_GET(self):
+        if self.path == TICKET_PATH:
+            self.send_body(json.dumps(self.server.ticket()).encode())
+        elif self.path.startswith(BLOCK_PREFIX):
+            try:
+                index = int(self.path[len(BLOCK_PREFIX):])
+                data = self.server.blocks[index]
+            except (ValueError, IndexError):
+                self.send_error(404)
+                return
+            self.send_body(data)
+        else:
+            self.send_error(404)
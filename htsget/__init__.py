@@ -23,5 +23,5 @@ try:
 except ImportError:
     pass
 
-from .io import get  # NOQA
+from .io import get, get_header, get_regions, Client  # NOQA
 from .exceptions import *  # NOQA
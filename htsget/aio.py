@@ -0,0 +1,370 @@
+#
+# Copyright 2016-2017 University of Oxford
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Asynchronous interface for the htsget library using asyncio. This module
+requires Python 3.7 or later and the aiohttp library.
+"""
+from __future__ import division
+from __future__ import print_function
+
+import asyncio
+import collections
+import logging
+import tempfile
+
+from six.moves.urllib.parse import urlparse
+from six.moves.urllib.parse import urlunparse
+
+import aiohttp
+import humanize
+
+import htsget.protocol as protocol
+import htsget.transfer as transfer
+import htsget.exceptions as exceptions
+
+CONTENT_LENGTH = "Content-Length"
+
+
+async def _coalesce_blocks(blocks, max_gap):
+    """
+    Returns an asynchronous generator of the block descriptors from the
+    specified asynchronous iterator with the ranges of consecutive blocks
+    merged by a :class:`htsget.protocol.RangeCoalescer`.
+    """
+    coalescer = protocol.RangeCoalescer(max_gap)
+    async for descriptor in blocks:
+        merged = coalescer.add(descriptor)
+        if merged is not None:
+            yield merged
+    last = coalescer.flush()
+    if last is not None:
+        yield last
+
+
+async def _next(iterator):
+    """
+    Returns the next item from the specified asynchronous iterator, or None
+    if it is exhausted.
+    """
+    try:
+        return await iterator.__anext__()
+    except StopAsyncIteration:
+        return None
+
+
+async def get(
+        url, output, reference_name=None, reference_md5=None,
+        start=None, end=None, fields=None, tags=None, notags=None,
+        data_format=None, max_retries=5, retry_wait=5, timeout=120,
+        bearer_token=None, headers=None, parallelism=1, session=None,
+        backoff=protocol.BACKOFF_EXPONENTIAL, max_retry_wait=60, retry_budget=None,
+        retry_deadline=None, buffer_size=protocol.BUFFER_SIZE, listener=None,
+        write_behind=None, coalesce_gap=None):
+    """
+    Runs a request to the specified URL and write the resulting data to
+    the specified file-like object. This coroutine takes the same arguments
+    as :func:`htsget.get`, except that ``session`` must be an
+    :class:`aiohttp.ClientSession`. If it is not specified, a new session is
+    created for the transfer and closed when it completes. Returns the MD5
+    digest of the data written.
+    """
+    manager = AsyncDownloadManager(
+        url, output, reference_name=reference_name,
+        reference_md5=reference_md5, start=start, end=end, fields=fields, tags=tags,
+        notags=notags, data_format=data_format, max_retries=max_retries, timeout=timeout,
+        retry_wait=retry_wait, bearer_token=bearer_token, headers=headers,
+        parallelism=parallelism, session=session, backoff=backoff,
+        max_retry_wait=max_retry_wait, retry_budget=retry_budget,
+        retry_deadline=retry_deadline, buffer_size=buffer_size, listener=listener,
+        write_behind=write_behind, coalesce_gap=coalesce_gap)
+    await manager.run()
+    return manager.digest
+
+
+class AsyncDownloadManager(transfer.TransferManager):
+    """
+    Class implementing the GA4GH streaming API asynchronously using asyncio
+    and the aiohttp library.
+    """
+
+    def __init__(self, url, output, session=None, **kwargs):
+        if kwargs.get("regions") is not None:
+            raise ValueError("Tickets for several regions are not supported")
+        super(AsyncDownloadManager, self).__init__(url, output, **kwargs)
+        self.session = session
+        self.semaphore = None
+
+    async def _in_executor(self, function, *args):
+        """
+        Calls the specified function, which does blocking I/O on the output, in
+        the default executor so that it does not stall the event loop.
+        """
+        return await asyncio.get_running_loop().run_in_executor(None, function, *args)
+
+    async def _stream(self, url, headers, consume, retry_state=None):
+        """
+        Requests the specified URL and calls the consume function on each piece
+        of the response body as it is received, awaiting the result if it
+        returns an awaitable.
+        """
+        if retry_state is not None:
+            headers = retry_state.request_headers(headers)
+        timeout = aiohttp.ClientTimeout(
+            sock_connect=self.timeout, sock_read=self.timeout)
+        length = 0
+        try:
+            async with self.session.get(
+                    url, headers=headers, timeout=timeout) as response:
+                if retry_state is not None:
+                    retry_state.handle_response(response.status, response.headers)
+                try:
+                    response.raise_for_status()
+                except aiohttp.ClientResponseError as cre:
+                    # TODO classify other errors that we consider unrecoverable.
+                    if response.status in [400, 401, 404]:
+                        raise exceptions.ClientError(str(cre), await response.text())
+                    error = exceptions.RetryableIOError(cre)
+                    if "Retry-After" in response.headers:
+                        error.retry_after = protocol.parse_retry_after(
+                            response.headers["Retry-After"])
+                    raise error
+                async for piece in response.content.iter_chunked(self.buffer_size):
+                    length += len(piece)
+                    result = consume(piece)
+                    if result is not None:
+                        await result
+        except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+            raise exceptions.RetryableIOError(error)
+        if CONTENT_LENGTH in response.headers:
+            content_length = int(response.headers[CONTENT_LENGTH])
+            if length < content_length:
+                raise exceptions.TruncatedContentError(
+                    "Length mismatch {} != {}".format(content_length, length))
+            if content_length != length:
+                raise exceptions.ContentLengthMismatch(
+                    "Length mismatch {} != {}".format(content_length, length))
+
+    async def _retry(self, retry_state, method, *args):
+        while True:
+            retry_state.attempt_start = protocol.clock()
+            try:
+                return await method(*args)
+            except exceptions.RetryableError as re:
+                await asyncio.sleep(self._handle_retry(retry_state, re))
+
+    async def _handle_ticket_request(self, consume=None):
+        headers = self._ticket_request_headers()
+        logging.debug("handle_ticket_request(url={}, headers={})".format(
+            self.ticket_request_url, headers))
+        if consume is None:
+            decoder = protocol.TicketDecoder()
+            await self._stream(self.ticket_request_url, headers, decoder.feed)
+            self.ticket = decoder.close()
+            return
+        decoder = protocol.TicketDecoder(keep_urls=False)
+
+        async def feed(piece):
+            for url_object in decoder.feed(piece):
+                await consume(url_object)
+
+        await self._stream(self.ticket_request_url, headers, feed)
+        self.ticket = decoder.close()
+        for url_object in decoder.urls:
+            await consume(url_object)
+
+    async def _read_ticket(self, consume=None):
+        retry_state = self._retry_state(None)
+        url_objects = []
+        with self._notifying(
+                protocol.EVENT_TICKET_START, protocol.EVENT_TICKET_END,
+                url=self.ticket_request_url):
+            if consume is None:
+                await self._retry(retry_state, self._handle_ticket_request)
+            else:
+                stream = protocol.TicketStream()
+
+                async def consume_new(url_object):
+                    if stream.is_new(url_object):
+                        if self.keep_ticket:
+                            url_objects.append(url_object)
+                        await consume(url_object)
+
+                async def attempt():
+                    stream.start_attempt()
+                    await self._handle_ticket_request(consume_new)
+                    stream.end_attempt()
+
+                await self._retry(retry_state, attempt)
+                if self.keep_ticket:
+                    self.ticket["urls"] = url_objects
+        self._process_ticket()
+
+    async def _ticket_blocks(self):
+        """
+        Returns an asynchronous generator of the descriptors of the blocks in
+        the ticket, which are generated as they are received.
+        """
+        url_queue = asyncio.Queue(transfer.TICKET_QUEUE_SIZE)
+
+        async def consume(url_object):
+            if self._selects(url_object):
+                await url_queue.put((self._describe(url_object), None))
+
+        async def read():
+            try:
+                await self._read_ticket(consume)
+            except Exception as error:
+                await url_queue.put((None, error))
+            else:
+                await url_queue.put((None, None))
+
+        task = asyncio.ensure_future(read())
+        try:
+            while True:
+                descriptor, error = await url_queue.get()
+                if error is not None:
+                    raise error
+                if descriptor is None:
+                    break
+                yield descriptor
+        finally:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+    async def _handle_http_url(self, url, headers, output, retry_state):
+        logging.debug("handle_http_url(url={}, headers={}, offset={})".format(
+            url, headers, retry_state.offset))
+        before = protocol.clock()
+        sizes = []
+
+        def consume(piece):
+            sizes.append(len(piece))
+            self._received(retry_state, len(piece))
+            return self._in_executor(output.write, piece)
+
+        await self._stream(url, headers, consume, retry_state)
+        size = sum(sizes)
+        duration = protocol.clock() - before
+        rate = (size / (2 ** 20)) / duration if duration > 0 else 0
+        logging.info("Downloaded {} chunk in {:.3f} seconds @ {:.2f} MiB/s".format(
+            humanize.naturalsize(size, binary=True), duration, rate))
+
+    async def _handle_url(self, descriptor, output, block=None):
+        url = urlparse(descriptor.url)
+        if url.scheme.startswith("http"):
+            headers = descriptor.headers
+            output = self._block_output(descriptor, output)
+            retry_state = self._retry_state(output, block)
+            with self._notifying(
+                    protocol.EVENT_BLOCK_START, protocol.EVENT_BLOCK_END, block=block,
+                    url=descriptor.url) as end:
+                await self._retry(
+                    retry_state, self._handle_http_url, urlunparse(url), headers,
+                    output, retry_state)
+                end["size"] = retry_state.offset + retry_state.received
+                end["attempt"] = retry_state.num_retries + 1
+        elif url.scheme == "data":
+            with self._notifying(
+                    protocol.EVENT_BLOCK_START, protocol.EVENT_BLOCK_END,
+                    block=block) as end:
+                end["size"] = await self._in_executor(
+                    self._handle_data_uri, url, output)
+                end["attempt"] = 1
+        else:
+            raise ValueError("Unsupported URL scheme:{}".format(url.scheme))
+
+    async def _download_block(self, block, descriptor):
+        buf = tempfile.SpooledTemporaryFile(max_size=transfer.SPOOL_MAX_SIZE)
+        try:
+            async with self.semaphore:
+                await self._handle_url(descriptor, buf, block)
+        except BaseException:
+            buf.close()
+            raise
+        return buf
+
+    async def _run_parallel(self, output, blocks):
+        """
+        Downloads the blocks for the specified asynchronous iterator of block
+        descriptors concurrently, with at most parallelism requests in flight, and
+        writes them to the specified output in order.
+        """
+        pending = collections.deque()
+        block = 0
+        try:
+            async for descriptor in blocks:
+                pending.append(
+                    asyncio.ensure_future(self._download_block(block, descriptor)))
+                block += 1
+                if len(pending) == 2 * self.parallelism:
+                    break
+            while len(pending) > 0:
+                buf = await pending.popleft()
+                descriptor = await _next(blocks)
+                if descriptor is not None:
+                    pending.append(
+                        asyncio.ensure_future(self._download_block(block, descriptor)))
+                    block += 1
+                await self._in_executor(self._write_block, buf, output)
+        finally:
+            for task in pending:
+                task.cancel()
+            if len(pending) > 0:
+                await asyncio.gather(*pending, return_exceptions=True)
+
+    async def run(self):
+        spool = self._spools_blocks()
+        owns_session = self.session is None
+        if owns_session:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit_per_host=self.parallelism))
+        writer = None
+        if self.write_behind is not None:
+            writer = transfer.WriteBehindOutput(self.output, self.write_behind)
+        output = transfer.DigestOutput(self.output if writer is None else writer)
+        self.semaphore = asyncio.Semaphore(self.parallelism)
+        try:
+            with self._notifying(None, protocol.EVENT_TRANSFER_END) as end:
+                ticket_blocks = self._ticket_blocks()
+                blocks = ticket_blocks
+                if self.coalesce_gap is not None:
+                    blocks = _coalesce_blocks(ticket_blocks, self.coalesce_gap)
+                completed = False
+                try:
+                    if self.parallelism > 1:
+                        await self._run_parallel(output, blocks)
+                    else:
+                        block = 0
+                        async for descriptor in blocks:
+                            if spool:
+                                buf = await self._download_block(block, descriptor)
+                                await self._in_executor(self._write_block, buf, output)
+                            else:
+                                output.checkpoint()
+                                await self._handle_url(descriptor, output, block)
+                            block += 1
+                    completed = True
+                finally:
+                    await blocks.aclose()
+                    await ticket_blocks.aclose()
+                    end["size"] = output.size
+                    if writer is not None:
+                        await self._in_executor(writer.close, completed)
+                self._check_digest(output)
+        finally:
+            if owns_session:
+                await self.session.close()
+                self.session = None
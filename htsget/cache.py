@@ -0,0 +1,474 @@
+#
+# Copyright 2016-2017 University of Oxford
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Local caches for data retrieved from htsget servers.
+"""
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import email.utils
+import errno
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+import htsget.protocol as protocol
+
+ENTRY_SUFFIX = ".block"
+TICKET_SUFFIX = ".ticket"
+HEADER_SUFFIX = ".header"
+TEMP_PREFIX = "tmp"
+
+
+def block_key(url, headers):
+    """
+    Returns the cache key for the block with the specified URL and request
+    headers. Blocks are identified by their URL and byte range, so that
+    requests for the same range expressed differently share an entry.
+    """
+    byte_range = ""
+    range_key = protocol.get_header(headers, "Range")
+    if range_key is not None:
+        parsed = protocol.parse_range(headers[range_key])
+        if parsed is None:
+            byte_range = headers[range_key].strip()
+        else:
+            byte_range = protocol.format_range(*parsed)
+    text = "{}\n{}".format(url, byte_range)
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def ticket_key(url, headers):
+    """
+    Returns the cache key for the ticket request to the specified URL with the
+    specified headers. Requests made with different credentials have
+    different keys, since servers may return different tickets for them.
+    """
+    authorization = ""
+    authorization_key = protocol.get_header(headers, "Authorization")
+    if authorization_key is not None:
+        authorization = headers[authorization_key]
+    text = "{}\n{}".format(url, authorization)
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def response_ttl(headers, now=None):
+    """
+    Returns the number of seconds for which a response with the specified
+    headers may be used without revalidation according to its Cache-Control
+    and Expires headers, None if the headers do not specify this, or -1 if
+    the response must not be stored.
+    """
+    cache_control_key = protocol.get_header(headers, "Cache-Control")
+    if cache_control_key is not None:
+        directives = {}
+        for directive in headers[cache_control_key].split(","):
+            name, _, value = directive.strip().partition("=")
+            directives[name.strip().lower()] = value.strip().strip('"')
+        if "no-store" in directives:
+            return -1
+        if "no-cache" in directives:
+            return 0
+        for name in ["s-maxage", "max-age"]:
+            if name in directives:
+                try:
+                    return max(0, int(directives[name]))
+                except ValueError:
+                    return 0
+    expires_key = protocol.get_header(headers, "Expires")
+    if expires_key is not None:
+        expires = email.utils.parsedate_tz(headers[expires_key])
+        if expires is None:
+            # Invalid dates mean the response has already expired.
+            return 0
+        now = time.time() if now is None else now
+        date_key = protocol.get_header(headers, "Date")
+        if date_key is not None:
+            date = email.utils.parsedate_tz(headers[date_key])
+            if date is not None:
+                now = email.utils.mktime_tz(date)
+        return max(0, email.utils.mktime_tz(expires) - now)
+    return None
+
+
+class TicketCacheEntry(object):
+    """
+    A ticket stored in the cache, which may be used without contacting the
+    server until the ``expires`` time. After this, the ticket must be
+    revalidated using the ``etag`` or ``last_modified`` validators.
+    """
+    def __init__(self, ticket, expires, etag=None, last_modified=None):
+        self.ticket = ticket
+        self.expires = expires
+        self.etag = etag
+        self.last_modified = last_modified
+
+    def is_fresh(self, now=None):
+        now = time.time() if now is None else now
+        return now < self.expires
+
+    def conditional_headers(self):
+        """
+        Returns the headers used to revalidate this entry.
+        """
+        headers = {}
+        if self.etag is not None:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified is not None:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+    def to_json(self):
+        return json.dumps({
+            "ticket": self.ticket, "expires": self.expires, "etag": self.etag,
+            "last_modified": self.last_modified})
+
+    @staticmethod
+    def from_json(text):
+        d = json.loads(text)
+        return TicketCacheEntry(
+            d["ticket"], d["expires"], etag=d["etag"], last_modified=d["last_modified"])
+
+
+class TicketCache(object):
+    """
+    A cache of ticket responses, keyed by the ticket request URL and the
+    credentials presented to the server. Tickets are reused for the time
+    allowed by the Cache-Control or Expires headers of the ticket response,
+    up to a maximum of ``max_ttl`` seconds; if the server does not specify a
+    lifetime, ``max_ttl`` is used. Expired tickets are revalidated with a
+    conditional request where the server provided an ETag or Last-Modified
+    header. Up to ``max_entries`` tickets are held in memory. If ``path`` is
+    specified, tickets are also stored in this directory, so that they can be
+    shared between processes.
+    """
+    def __init__(self, max_ttl=60, max_entries=1024, path=None):
+        self.max_ttl = max_ttl
+        self.max_entries = max_entries
+        self.path = path
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        if path is not None:
+            try:
+                os.makedirs(path)
+            except OSError as ose:
+                if ose.errno != errno.EEXIST:
+                    raise
+
+    def __entry_path(self, key):
+        return os.path.join(self.path, key + TICKET_SUFFIX)
+
+    def __store(self, key, entry):
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        if self.path is not None:
+            fd, temp_path = tempfile.mkstemp(prefix=TEMP_PREFIX, dir=self.path)
+            with os.fdopen(fd, "w") as f:
+                f.write(entry.to_json())
+            os.replace(temp_path, self.__entry_path(key))
+
+    def get(self, url, headers):
+        """
+        Returns the :class:`.TicketCacheEntry` for the ticket request with the
+        specified URL and headers, which may have expired, or None if there is
+        no entry.
+        """
+        key = ticket_key(url, headers)
+        with self.lock:
+            entry = self.entries.get(key, None)
+            if entry is not None:
+                self.entries.move_to_end(key)
+        if entry is None and self.path is not None:
+            try:
+                with open(self.__entry_path(key)) as f:
+                    entry = TicketCacheEntry.from_json(f.read())
+            except (IOError, OSError, ValueError, KeyError):
+                return None
+            with self.lock:
+                self.entries[key] = entry
+        return entry
+
+    def put(self, url, headers, ticket, response_headers):
+        """
+        Stores the specified ticket, received in a response with the specified
+        headers to a request with the specified URL and headers.
+        """
+        ttl = response_ttl(response_headers)
+        if ttl is not None and ttl < 0:
+            return
+        ttl = self.max_ttl if ttl is None else min(ttl, self.max_ttl)
+        etag_key = protocol.get_header(response_headers, "ETag")
+        last_modified_key = protocol.get_header(response_headers, "Last-Modified")
+        entry = TicketCacheEntry(
+            ticket, time.time() + ttl,
+            etag=None if etag_key is None else response_headers[etag_key],
+            last_modified=(
+                None if last_modified_key is None
+                else response_headers[last_modified_key]))
+        self.__store(ticket_key(url, headers), entry)
+
+    def refresh(self, url, headers, entry, response_headers):
+        """
+        Updates the specified entry after the server confirmed, in a
+        response with the specified headers, that it is still valid.
+        """
+        response_headers = dict(response_headers)
+        validators = [("ETag", entry.etag), ("Last-Modified", entry.last_modified)]
+        for name, value in validators:
+            if value is not None and protocol.get_header(response_headers, name) is None:
+                response_headers[name] = value
+        self.put(url, headers, entry.ticket, response_headers)
+
+    def clear(self):
+        """
+        Removes all entries from the cache.
+        """
+        with self.lock:
+            self.entries.clear()
+        if self.path is not None:
+            for name in os.listdir(self.path):
+                if name.endswith(TICKET_SUFFIX):
+                    try:
+                        os.unlink(os.path.join(self.path, name))
+                    except OSError:
+                        pass
+
+
+class HeaderCache(object):
+    """
+    A cache of file headers, as returned by :func:`htsget.get_header`, keyed
+    by the ticket request URL and the credentials presented to the server.
+    Headers do not expire, so :meth:`clear` must be called if the data may
+    have changed. Up to ``max_entries`` headers are held in memory. If
+    ``path`` is specified, headers are also stored in this directory, so
+    that they can be shared between processes.
+    """
+    def __init__(self, max_entries=256, path=None):
+        self.max_entries = max_entries
+        self.path = path
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        if path is not None:
+            try:
+                os.makedirs(path)
+            except OSError as ose:
+                if ose.errno != errno.EEXIST:
+                    raise
+
+    def __entry_path(self, key):
+        return os.path.join(self.path, key + HEADER_SUFFIX)
+
+    def __store_in_memory(self, key, data):
+        with self.lock:
+            self.entries[key] = data
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def get(self, url, headers):
+        """
+        Returns the header for the ticket request with the specified URL and
+        headers as bytes, or None if there is no entry.
+        """
+        key = ticket_key(url, headers)
+        with self.lock:
+            data = self.entries.get(key, None)
+            if data is not None:
+                self.entries.move_to_end(key)
+        if data is None and self.path is not None:
+            try:
+                with open(self.__entry_path(key), "rb") as f:
+                    data = f.read()
+            except (IOError, OSError):
+                return None
+            self.__store_in_memory(key, data)
+        return data
+
+    def put(self, url, headers, data):
+        """
+        Stores the specified header, the data returned for a ticket request
+        with the specified URL and headers.
+        """
+        key = ticket_key(url, headers)
+        self.__store_in_memory(key, data)
+        if self.path is not None:
+            fd, temp_path = tempfile.mkstemp(prefix=TEMP_PREFIX, dir=self.path)
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(temp_path, self.__entry_path(key))
+
+    def clear(self):
+        """
+        Removes all entries from the cache.
+        """
+        with self.lock:
+            self.entries.clear()
+        if self.path is not None:
+            for name in os.listdir(self.path):
+                if name.endswith(HEADER_SUFFIX):
+                    try:
+                        os.unlink(os.path.join(self.path, name))
+                    except OSError:
+                        pass
+
+
+class BlockCacheEntry(object):
+    """
+    A block stored in the cache. The data for the block can be read from
+    ``file``, which must be closed after use.
+    """
+    def __init__(self, etag, file):
+        self.etag = etag
+        self.file = file
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.file.close()
+
+
+class BlockCacheWriter(object):
+    """
+    Writes a new entry to the cache. The entry only becomes visible to readers
+    when :meth:`commit` is called.
+    """
+    def __init__(self, cache, key, etag):
+        self.cache = cache
+        self.key = key
+        self.size = 0
+        fd, self.temp_path = tempfile.mkstemp(prefix=TEMP_PREFIX, dir=cache.path)
+        self.file = os.fdopen(fd, "wb")
+        self.file.write(json.dumps({"etag": etag}).encode("utf-8") + b"\n")
+
+    def write(self, data):
+        self.size += len(data)
+        if self.size > self.cache.max_size:
+            self.abort()
+        elif self.file is not None:
+            self.file.write(data)
+
+    def commit(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+            os.replace(self.temp_path, self.cache.entry_path(self.key))
+            self.cache.evict()
+
+    def abort(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+            try:
+                os.unlink(self.temp_path)
+            except OSError:
+                pass
+
+
+class BlockCache(object):
+    """
+    An on-disk cache of the blocks downloaded from htsget data servers, stored
+    in the directory with the specified path. Entries are keyed by the block's
+    URL and byte range and are only used after the server confirms, using
+    the block's ETag, that they are still current. When the total size of the
+    entries exceeds ``max_size`` bytes, the least recently used entries are
+    evicted.
+
+    Entries are written to temporary files and atomically renamed into place,
+    so a cache directory can be safely shared by multiple processes.
+    """
+    def __init__(self, path, max_size=2**30):
+        self.path = path
+        self.max_size = max_size
+        try:
+            os.makedirs(path)
+        except OSError as ose:
+            if ose.errno != errno.EEXIST:
+                raise
+
+    def entry_path(self, key):
+        return os.path.join(self.path, key + ENTRY_SUFFIX)
+
+    def get(self, url, headers):
+        """
+        Returns the :class:`.BlockCacheEntry` for the specified block, or None
+        if it is not in the cache.
+        """
+        path = self.entry_path(block_key(url, headers))
+        try:
+            f = open(path, "rb")
+        except (IOError, OSError):
+            return None
+        try:
+            metadata = json.loads(f.readline().decode("utf-8"))
+            # Using the entry makes it the most recently used.
+            os.utime(path, None)
+        except (ValueError, OSError):
+            f.close()
+            return None
+        return BlockCacheEntry(metadata["etag"], f)
+
+    def put(self, url, headers, etag):
+        """
+        Returns a :class:`.BlockCacheWriter` for a new entry for the specified
+        block, which has the specified ETag.
+        """
+        return BlockCacheWriter(self, block_key(url, headers), etag)
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the total size of the
+        cache is within the limit.
+        """
+        entries = []
+        total_size = 0
+        for name in os.listdir(self.path):
+            if not name.endswith(ENTRY_SUFFIX):
+                continue
+            path = os.path.join(self.path, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                # The entry has been removed by another process.
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total_size += stat.st_size
+        entries.sort()
+        for _, size, path in entries:
+            if total_size <= self.max_size:
+                break
+            logging.debug("Evicting {} from block cache".format(path))
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+            total_size -= size
+
+    def clear(self):
+        """
+        Removes all entries from the cache.
+        """
+        shutil.rmtree(self.path, ignore_errors=True)
+        os.makedirs(self.path)
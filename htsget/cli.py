@@ -20,6 +20,7 @@ from __future__ import division
 from __future__ import print_function
 
 import argparse
+import hashlib
 import json
 import logging
 import os
@@ -29,7 +30,10 @@ import sys
 from json import JSONDecodeError
 
 import htsget
+import htsget.cache
+import htsget.stats
 import htsget.exceptions as exceptions
+import htsget.protocol as protocol
 
 
 def error_message(message):
@@ -39,6 +43,58 @@ def error_message(message):
     print("{}: error: {}".format(sys.argv[0], message), file=sys.stderr)
 
 
+def write_stats(stats, path):
+    """
+    Writes the summary of the specified transfer statistics as JSON to the
+    specified path.
+    """
+    try:
+        with open(path, "w") as f:
+            json.dump(stats.summary(), f, indent=2)
+    except (IOError, OSError) as e:
+        error_message("Cannot write statistics to {}: {}".format(path, e))
+
+
+def comma_list(value):
+    """
+    Returns the list of the comma separated values in the specified string,
+    which is empty for the empty string.
+    """
+    return [] if value == "" else value.split(",")
+
+
+def read_regions(path):
+    """
+    Returns the list of (reference_name, start, end) regions in the specified
+    manifest file, which lists one region per line as a reference name,
+    optionally followed by start and end positions, as in BED files. Blank
+    lines, comments and BED track and browser lines are ignored. Raises
+    ValueError if the manifest cannot be read or a region is invalid.
+    """
+    try:
+        with open(path) as f:
+            lines = f.readlines()
+    except (IOError, OSError) as e:
+        raise ValueError("Cannot read regions from {}: {}".format(path, e))
+    regions = []
+    for line in lines:
+        fields = line.split()
+        if len(fields) == 0 or fields[0].startswith("#") or fields[0] in [
+                "track", "browser"]:
+            continue
+        try:
+            start = end = None
+            if len(fields) > 1:
+                start, end = int(fields[1]), int(fields[2])
+        except (IndexError, ValueError):
+            raise ValueError("Invalid region: {}".format(line.strip()))
+        region = (fields[0], start, end)
+        if region in regions:
+            raise ValueError("Duplicate region: {}".format(line.strip()))
+        regions.append(region)
+    return regions
+
+
 def run(args):
     log_level = logging.WARNING
     if args.verbose == 1:
@@ -47,7 +103,9 @@ def run(args):
         log_level = logging.DEBUG
     logging.basicConfig(format='%(asctime)s %(message)s', level=log_level)
 
-    if args.output is not None:
+    if args.regions is not None and not args.merge_regions:
+        output = None
+    elif args.output is not None:
         output = open(args.output, "wb")
     else:
         # This is an awkard hack to get things to work on Python 2 and 3. In Python 3,
@@ -59,22 +117,69 @@ def run(args):
             output = sys.stdout.buffer
         except AttributeError:
             output = sys.stdout
-        if args.max_retries != 0:
-            logging.warn(
-                "Cannot retry failed transfers when writing to stdout. Setting "
-                "max_retries to zero")
-            args.max_retries = 0
 
     exit_status = 1
+    stats = None
+    if args.stats_json is not None:
+        stats = htsget.stats.TransferStats()
 
     try:
+        block_cache = None
+        if args.block_cache is not None:
+            block_cache = htsget.cache.BlockCache(
+                args.block_cache, max_size=args.block_cache_size * 2**20)
+        ticket_cache = None
+        if args.ticket_cache is not None:
+            ticket_cache = htsget.cache.TicketCache(
+                max_ttl=args.ticket_cache_ttl, path=args.ticket_cache)
+        regions = None
+        if args.regions is not None:
+            if args.header_only:
+                raise ValueError("--header-only cannot be used with --regions")
+            if args.output is not None and not args.merge_regions:
+                raise ValueError("--output cannot be used with --regions")
+            regions = read_regions(args.regions)
         headers = json.loads(args.headers) if args.headers else None
-        htsget.get(
-            args.url, output, reference_name=args.reference_name,
-            reference_md5=args.reference_md5, start=args.start,
-            end=args.end, data_format=args.format, max_retries=args.max_retries,
+        write_behind = None
+        if args.write_behind is not None:
+            write_behind = args.write_behind * 2**20
+        kwargs = dict(
+            data_format=args.format, fields=args.fields, tags=args.tags,
+            notags=args.notags, max_retries=args.max_retries,
             retry_wait=args.retry_wait, timeout=args.timeout,
-            bearer_token=args.bearer_token, headers=headers)
+            bearer_token=args.bearer_token, headers=headers,
+            parallelism=1 if args.parallel is None else args.parallel,
+            backoff=args.backoff,
+            max_retry_wait=args.max_retry_wait, retry_budget=args.retry_budget,
+            retry_deadline=args.retry_deadline, block_cache=block_cache,
+            ticket_cache=ticket_cache, bypass_ticket_cache=args.refresh_ticket,
+            buffer_size=args.buffer_size * 1024, listener=stats,
+            write_behind=write_behind, coalesce_gap=args.coalesce_gap,
+            hedge_percentile=args.hedge)
+        if args.header_only:
+            header_cache = None
+            if args.header_cache is not None:
+                header_cache = htsget.cache.HeaderCache(path=args.header_cache)
+            header = htsget.get_header(
+                args.url, header_cache=header_cache, **kwargs)
+            output.write(header)
+            digests = [hashlib.md5(header).hexdigest()]
+        elif regions is not None and args.merge_regions:
+            digests = [htsget.get(
+                args.url, output, regions=regions, preallocate=args.preallocate,
+                **kwargs)]
+        elif regions is not None:
+            kwargs["parallelism"] = args.parallel
+            digests = htsget.get_regions(
+                args.url, regions, output_dir=args.output_dir, **kwargs)
+        else:
+            digests = [htsget.get(
+                args.url, output, reference_name=args.reference_name,
+                reference_md5=args.reference_md5, start=args.start, end=args.end,
+                preallocate=args.preallocate, **kwargs)]
+        if args.print_md5:
+            for digest in digests:
+                print(digest, file=sys.stderr)
         exit_status = 0
     except JSONDecodeError as json_decode_error:
         error_message(
@@ -83,11 +188,15 @@ def run(args):
         error_message(str(ew))
     except exceptions.HtsgetException as he:
         error_message(str(he))
+    except ValueError as ve:
+        error_message(str(ve))
     except KeyboardInterrupt:
         error_message("interrupted")
     finally:
-        if output is not sys.stdout:
+        if output is not None and output is not sys.stdout:
             output.close()
+    if stats is not None:
+        write_stats(stats, args.stats_json)
     sys.exit(exit_status)
 
 
@@ -129,18 +238,80 @@ def get_htsget_parser():
         help=(
             "The end position of the range on the reference, 0-based exclusive. If "
             "specified, reference-name or reference-md5 must also be specified."))
+    parser.add_argument(
+        "--fields", type=comma_list, default=None,
+        help=(
+            "A comma separated list of the fields of read records to request, "
+            "such as QNAME,FLAG,POS. By default all fields are returned."))
+    parser.add_argument(
+        "--tags", type=comma_list, default=None,
+        help=(
+            "A comma separated list of the tags of read records to include. "
+            "By default all tags are returned; an empty value requests none."))
+    parser.add_argument(
+        "--notags", type=comma_list, default=None,
+        help="A comma separated list of the tags of read records to omit.")
     parser.add_argument(
         "--output", "-O", type=str, default=None,
         help=(
-            "The output file path. Defaults to stdout. If output is to stdout, the "
-            "max-retries is set to zero, since retries are not supported when writing "
-            "to this stream"))
+            "The output file path. Defaults to stdout. If the output cannot be "
+            "rewound, as for stdout or a pipe, each block is spooled to a temporary "
+            "file and written once it is complete, so that failed blocks can be "
+            "retried"))
+    parser.add_argument(
+        "--regions", type=str, default=None, metavar="MANIFEST",
+        help=(
+            "A file listing regions to retrieve, one per line as a reference "
+            "name optionally followed by start and end positions, as in BED "
+            "files. The data for each region is written to its own file in "
+            "the output directory, and blocks shared between regions are "
+            "downloaded once."))
+    parser.add_argument(
+        "--merge-regions", action="store_true",
+        help=(
+            "Write the data for all the regions given by --regions to a single "
+            "output, requesting one ticket for all of them where the server "
+            "supports POST requests."))
+    parser.add_argument(
+        "--output-dir", type=str, default=".",
+        help="The directory in which to write the data for each of the regions.")
+    parser.add_argument(
+        "--header-only", action="store_true",
+        help=(
+            "Retrieve only the header of the data, such as the SAM header of "
+            "a BAM file. Headers are cached in the directory given by "
+            "--header-cache, if any."))
+    parser.add_argument(
+        "--header-cache", type=str, default=None, metavar="DIR",
+        help=(
+            "A directory in which to cache headers retrieved with "
+            "--header-only, so that later requests for the same header do "
+            "not contact the server."))
     parser.add_argument(
         "--max-retries", "-M", type=int, default=5,
         help="The maximum number of times to retry a failed transfer.")
     parser.add_argument(
         "--retry-wait", "-W", type=float, default=5,
-        help="The number of seconds to wait before retrying a failed transfer.")
+        help=(
+            "The number of seconds to wait before retrying a failed transfer for "
+            "the first time."))
+    parser.add_argument(
+        "--backoff", choices=protocol.BACKOFF_POLICIES,
+        default=protocol.BACKOFF_EXPONENTIAL,
+        help="The policy for increasing the wait between successive retries.")
+    parser.add_argument(
+        "--max-retry-wait", type=float, default=60,
+        help=(
+            "The maximum number of seconds to wait before retrying, unless the "
+            "server requests a longer wait."))
+    parser.add_argument(
+        "--retry-budget", type=int, default=None,
+        help="The maximum total number of retries across all requests.")
+    parser.add_argument(
+        "--retry-deadline", type=float, default=None,
+        help=(
+            "The number of seconds after the start of the transfer beyond which "
+            "failed requests are no longer retried."))
     parser.add_argument(
         "--timeout", "-T", type=float, default=120,
         help="The socket timeout for transfers.")
@@ -150,6 +321,69 @@ def get_htsget_parser():
     parser.add_argument(
         "--headers", "-H", type=str, default=None,
         help="The stringified JSON of HTTP header name-value mappings.")
+    parser.add_argument(
+        "--parallel", "-p", type=int, default=None,
+        help=(
+            "The number of blocks to download concurrently. Blocks are written "
+            "to the output in order. With --regions, the number of regions "
+            "transferred concurrently, by default all of them up to {}.".format(
+                htsget.io.POOL_MAXSIZE)))
+    parser.add_argument(
+        "--buffer-size", type=int, default=protocol.BUFFER_SIZE // 1024,
+        help="The size in KiB of the buffer into which downloaded data is read.")
+    parser.add_argument(
+        "--write-behind", type=int, default=None, metavar="SIZE",
+        help=(
+            "Write to the output on a separate thread, queueing at most this "
+            "many MiB of data, so that slow writes do not stall downloads."))
+    parser.add_argument(
+        "--preallocate", action="store_true",
+        help=(
+            "When downloading blocks in parallel to a file, preallocate the "
+            "file and write each block directly at its offset, if the sizes "
+            "of the blocks can be found in advance."))
+    parser.add_argument(
+        "--coalesce-gap", type=int, default=None, metavar="BYTES",
+        help=(
+            "Download consecutive blocks with byte ranges of the same URL "
+            "separated by at most this many bytes using a single request, "
+            "discarding the bytes between them."))
+    parser.add_argument(
+        "--hedge", type=float, default=None, metavar="PERCENTILE",
+        help=(
+            "Make a duplicate request for a block that receives no data "
+            "within this percentile of the first byte latencies of earlier "
+            "blocks, using whichever request completes first."))
+    parser.add_argument(
+        "--block-cache", type=str, default=None,
+        help=(
+            "A directory in which to cache downloaded blocks, so that blocks "
+            "requested again are read from local disk."))
+    parser.add_argument(
+        "--block-cache-size", type=int, default=1024,
+        help="The maximum size of the block cache in MiB.")
+    parser.add_argument(
+        "--ticket-cache", type=str, default=None,
+        help=(
+            "A directory in which to cache tickets, so that repeated requests "
+            "for the same data reuse the ticket while it is fresh."))
+    parser.add_argument(
+        "--ticket-cache-ttl", type=float, default=60,
+        help="The maximum time in seconds for which a cached ticket is used.")
+    parser.add_argument(
+        "--print-md5", action="store_true",
+        help=(
+            "Print the MD5 digest of the downloaded data to stderr. The digest "
+            "is always checked against the MD5 given in the ticket, if any."))
+    parser.add_argument(
+        "--stats-json", type=str, default=None, metavar="PATH",
+        help=(
+            "Write statistics about the transfer as JSON to this file, including "
+            "the latency of the ticket request and the size, duration, "
+            "throughput and retries of each block."))
+    parser.add_argument(
+        "--refresh-ticket", action="store_true",
+        help="Always request a new ticket, bypassing the ticket cache.")
     return parser
 
 
@@ -80,6 +80,28 @@ class EmptyTicketError(ProtocolError):
             "The server returned an empty JSON ticket")
 
 
+class MD5MismatchError(HtsgetException):
+    """
+    The MD5 digest of the downloaded data is not the same as the digest given
+    in the ticket.
+    """
+    def __init__(self, md5, digest):
+        super(MD5MismatchError, self).__init__(
+            "MD5 of downloaded data {} != {} given in ticket".format(digest, md5))
+        self.md5 = md5
+        self.digest = digest
+
+
+class TicketChangedError(ProtocolError):
+    """
+    The server returned a different ticket when the ticket request was
+    retried, after downloads of the blocks in the original ticket had started.
+    """
+    def __init__(self):
+        super(TicketChangedError, self).__init__(
+            "The ticket changed when the ticket request was retried")
+
+
 class ClientError(HtsgetException):
     """
     The exception raised when a client error is returned by the server.
@@ -106,8 +128,11 @@ class ExceptionWrapper(HtsgetException):
 
 class RetryableError(HtsgetException):
     """
-    The superclass of all errors that we think are worth retrying.
+    The superclass of all errors that we think are worth retrying. If the
+    server asked us to wait before retrying using the Retry-After header, the
+    number of seconds to wait is stored in the ``retry_after`` instance variable.
     """
+    retry_after = None
 
 
 class RetryableIOError(RetryableError, ExceptionWrapper):
@@ -122,3 +147,21 @@ class ContentLengthMismatch(RetryableError):
     The length of the downloaded content is not the same as the
     length reported in the header.
     """
+
+
+class TruncatedContentError(ContentLengthMismatch):
+    """
+    The downloaded content is shorter than the length reported in the header,
+    because the connection was closed before the transfer completed.
+    """
+
+
+class ResourceChangedError(RetryableError):
+    """
+    The resource being downloaded changed while resuming an interrupted
+    transfer, so the transfer must be restarted.
+    """
+    def __init__(self, validator, new_validator):
+        super(ResourceChangedError, self).__init__(
+            "Resource changed while resuming transfer: ETag {} != {}".format(
+                new_validator, validator))
@@ -19,34 +19,99 @@ Main interface for the htsget library.
 from __future__ import division
 from __future__ import print_function
 
+import concurrent.futures
+import itertools
 import logging
-import time
+import os
+import socket
+import threading
+
+from six import BytesIO
+from six.moves import http_client
+from six.moves import http_cookiejar
 
 import htsget.protocol as protocol
+import htsget.transfer as transfer
 import htsget.exceptions as exceptions
 
 import requests
+import requests.adapters
 import humanize
 
 CONTENT_LENGTH = "Content-Length"
 
+# The default number of per-host connection pools to cache, and the default
+# maximum number of connections kept alive in each pool.
+POOL_CONNECTIONS = 10
+POOL_MAXSIZE = 10
+
+_shared_sessions = {}
+_shared_sessions_lock = threading.Lock()
+
+
+def create_session(
+        pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE, pool_block=False):
+    """
+    Returns a new :class:`requests.Session` whose connections are kept alive
+    and reused across requests, suitable for passing as the ``session``
+    argument to :func:`.get`.
+
+    :param int pool_connections: The number of per-host connection pools to cache.
+    :param int pool_maxsize: The maximum number of connections to keep alive to
+        any single host.
+    :param bool pool_block: If True, never open more than ``pool_maxsize``
+        connections to a single host, blocking until a connection is free.
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=pool_connections, pool_maxsize=pool_maxsize,
+        pool_block=pool_block)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def get_shared_session(pool_maxsize=POOL_MAXSIZE):
+    """
+    Returns the session shared by all transfers in this process that use
+    connection pools of the specified size, creating it if necessary. The
+    session stores no cookies, so that cookies set by the servers for one
+    caller are not sent with the requests of another.
+    """
+    with _shared_sessions_lock:
+        session = _shared_sessions.get(pool_maxsize, None)
+        if session is None:
+            session = create_session(pool_maxsize=pool_maxsize)
+            session.cookies.set_policy(
+                http_cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+            _shared_sessions[pool_maxsize] = session
+    return session
+
 
 def get(
         url, output, reference_name=None, reference_md5=None,
         start=None, end=None, fields=None, tags=None, notags=None,
         data_format=None, max_retries=5, retry_wait=5, timeout=120,
-        bearer_token=None, headers=None):
+        bearer_token=None, headers=None, parallelism=1, session=None,
+        backoff=protocol.BACKOFF_EXPONENTIAL, max_retry_wait=60, retry_budget=None,
+        retry_deadline=None, block_cache=None, ticket_cache=None,
+        bypass_ticket_cache=False, buffer_size=protocol.BUFFER_SIZE, listener=None,
+        write_behind=None, preallocate=False, coalesce_gap=None,
+        hedge_percentile=None, regions=None, request_class=None):
     """
     Runs a request to the specified URL and write the resulting data to
-    the specified file-like object.
+    the specified file-like object. The MD5 digest of the data is computed as
+    it is written and checked against the digest given in the ticket, if
+    any; :class:`htsget.exceptions.MD5MismatchError` is raised if they differ.
 
     :param str url: The URL of the data to retrieve. This may be composed of a prefix
         such as ``http://example.com/reads/`` and an ID suffix such as
         ``NA12878``. The full URL must be supplied here, i.e., in this example
         ``http://example.com/reads/NA12878``.
-    :param file output: A file-like object to write the downloaded data to. To support
-       retrying of failed transfers, this file must be seekable. For this reason,
-       retry will fail if ``stdout`` is provided.
+    :param file output: A file-like object to write the downloaded data to. If
+       this is not seekable, as for ``stdout`` when it is a pipe, each block is
+       buffered until it is complete before it is written, so that failed
+       transfers can still be retried.
     :param str reference_name: The reference sequence name, for example "chr1",
         "1", or "chrX". If unspecified, all data is returned.
     :param str reference_md5: The MD5 checksum uniquely representing the reference
@@ -58,11 +123,20 @@ def get(
         be specified.
     :param int end: The end position of the range on the reference, 0-based exclusive.
         If specified, ``reference_name`` or ``reference_md5`` must also be specified.
+    :param list fields: If specified, the fields of each read record to
+        request, such as ``["QNAME", "FLAG", "POS"]``; the server may omit
+        the other fields. Field names are not case sensitive.
+    :param list tags: If specified, the two character tags of each read
+        record to include; an empty list requests no tags.
+    :param list notags: If specified, the tags of each read record to omit.
+        Tags cannot be both included and excluded, and fields and tags
+        cannot be requested for variant data; ValueError is raised in either
+        case.
     :param str data_format: The requested format of the returned data.
     :param int max_retries: The maximum number of times that an individual transfer
         will be retried.
     :param float retry_wait: The amount of time in seconds to wait before retrying
-        a failed transfer.
+        a failed transfer for the first time.
     :param float timeout: The socket timeout for I/O operations.
     :param bearer_token: The OAuth2 Bearer token to present to the htsget ticket server.
         If this value is specified, the token is provided to the ticket server using
@@ -72,100 +146,629 @@ def get(
         for your server for information on authentication and how to obtain a
         valid token.
     :param headers: Additional headers needed for the requests to the htsget service.
+    :param int parallelism: The number of blocks in the ticket to download
+        concurrently. Blocks are buffered as required and written to ``output``
+        in ticket order.
+    :param requests.Session session: The session used to make all HTTP requests
+        for this transfer. If not specified, a session shared by all transfers
+        in this process is used, so that connections to the ticket and data
+        servers are kept alive and reused. See :func:`.create_session`.
+    :param str backoff: The policy used to increase the time waited between
+        successive retries of a failed transfer. One of ``fixed``, which always
+        waits ``retry_wait`` seconds; ``exponential``, which doubles the wait
+        each time; or ``decorrelated``, which chooses each wait at random between
+        ``retry_wait`` and three times the previous wait. Waits are extended if
+        the server requests it using the ``Retry-After`` header.
+    :param float max_retry_wait: The maximum time in seconds to wait before
+        retrying, unless the server requests a longer wait.
+    :param int retry_budget: The maximum total number of retries across all the
+        requests made for this transfer. If None, this is unlimited.
+    :param float retry_deadline: The time in seconds after the start of the
+        transfer beyond which no further retries are made. If None, retries are
+        made regardless of how long the transfer has taken.
+    :param htsget.cache.BlockCache block_cache: If specified, blocks are stored
+        in this cache as they are downloaded, and cached blocks are read from it
+        rather than downloaded again if the server confirms they are current.
+    :param htsget.cache.TicketCache ticket_cache: If specified, tickets are
+        stored in this cache and reused by later requests for the same data
+        while they are fresh.
+    :param bool bypass_ticket_cache: If True, a new ticket is always requested
+        from the server, even if a fresh ticket is in ``ticket_cache``. The new
+        ticket is still stored in the cache.
+    :param int buffer_size: The size in bytes of the buffer into which response
+        bodies are read. Each concurrent transfer reuses a single buffer of this
+        size, so larger values reduce the per-read overhead of fast transfers.
+    :param listener: A function called with a :class:`htsget.protocol.TransferEvent`
+        for each event in the transfer, such as the start and end of the
+        ticket request and of each block, the receipt of data and retries.
+        When blocks are downloaded in parallel, this is called concurrently
+        from multiple threads.
+    :param int write_behind: If specified, data is written to ``output`` on a
+        separate thread, with at most this many bytes queued, so that slow
+        writes do not stall the reception of data from the network.
+    :param bool preallocate: If True, ``parallelism`` is greater than one and
+        ``output`` is a regular file, the sizes of the blocks are found from
+        their Range headers, data URIs or HEAD requests, the space for the
+        data is preallocated, and each block is written directly at its offset
+        in the file rather than buffered and written in order. If the size of
+        any block is unknown, blocks are written in order as usual. The MD5
+        digest is then only computed, by reading back the data, if the ticket
+        gives one to check.
+    :param int coalesce_gap: If specified, consecutive blocks requesting byte
+        ranges of the same URL with the same headers, separated by at most
+        this many bytes, are downloaded using a single request, discarding the
+        bytes between them. Zero merges only contiguous ranges.
+    :param float hedge_percentile: If specified, a duplicate request is made
+        for an HTTP block that receives no data within this percentile of the
+        first byte latencies of earlier blocks, and the data of whichever
+        request completes first is used. Requests are hedged only once enough
+        latencies have been recorded, and not when writing at block offsets
+        with ``preallocate``.
+    :param list regions: If specified, the data for all of these regions,
+        given as (reference_name, start, end) tuples where start and end may
+        be None, is written to ``output``, in place of the single region given
+        by ``reference_name``, ``start`` and ``end``. The ticket is requested
+        using a single POST request. If the server does not support POST
+        requests, a ticket is requested for each region and their blocks are
+        downloaded in turn, omitting blocks repeated from earlier regions; in
+        this case records overlapping several regions may be repeated, and
+        the MD5 digest is not checked. Tickets for several regions are not
+        stored in ``ticket_cache``.
+    :param str request_class: If specified, only this class of data is
+        requested: ``header`` for the file header, or ``body`` for the rest
+        of the data. See :func:`.get_header`.
+    :return: The MD5 digest of the data written to ``output`` as a hexadecimal
+        string, or None if it could not be computed.
     """
     manager = SynchronousDownloadManager(
         url, output, reference_name=reference_name,
         reference_md5=reference_md5, start=start, end=end, fields=fields, tags=tags,
         notags=notags, data_format=data_format, max_retries=max_retries, timeout=timeout,
-        retry_wait=retry_wait, bearer_token=bearer_token, headers=headers)
+        retry_wait=retry_wait, bearer_token=bearer_token, headers=headers,
+        parallelism=parallelism, session=session, backoff=backoff,
+        max_retry_wait=max_retry_wait, retry_budget=retry_budget,
+        retry_deadline=retry_deadline, block_cache=block_cache,
+        ticket_cache=ticket_cache, bypass_ticket_cache=bypass_ticket_cache,
+        buffer_size=buffer_size, listener=listener, write_behind=write_behind,
+        preallocate=preallocate, coalesce_gap=coalesce_gap,
+        hedge_percentile=hedge_percentile, regions=regions,
+        request_class=request_class)
     manager.run()
+    return manager.digest
+
+
+def get_header(
+        url, data_format=None, headers=None, bearer_token=None, header_cache=None,
+        **kwargs):
+    """
+    Returns the header of the data at the specified URL as bytes, such as the
+    SAM header of a BAM file, requesting only the blocks for the header. If
+    ``header_cache`` is specified, the header is stored in it, and later calls
+    for the same URL, format and credentials return the cached header without
+    contacting the server.
+
+    :param str url: The URL of the data, as for :func:`.get`.
+    :param str data_format: The requested format of the data.
+    :param headers: Additional headers needed for the ticket request.
+    :param bearer_token: The OAuth2 Bearer token to present to the htsget
+        ticket server.
+    :param htsget.cache.HeaderCache header_cache: The cache of headers to use,
+        if any.
+    :param kwargs: The other arguments to :func:`.get`, except for those
+        specifying the region.
+    """
+    ticket_url = protocol.ticket_request_url(
+        url, data_format=data_format, request_class=protocol.CLASS_HEADER)
+    request_headers = dict(headers or {})
+    if bearer_token is not None:
+        request_headers["Authorization"] = "Bearer {}".format(bearer_token)
+    data = None
+    if header_cache is not None:
+        data = header_cache.get(ticket_url, request_headers)
+    if data is None:
+        output = BytesIO()
+        get(
+            url, output, data_format=data_format, headers=headers,
+            bearer_token=bearer_token, request_class=protocol.CLASS_HEADER, **kwargs)
+        data = output.getvalue()
+        if header_cache is not None:
+            header_cache.put(ticket_url, request_headers, data)
+    return data
 
 
-class SynchronousDownloadManager(protocol.DownloadManager):
+def region_filename(region, data_format=None):
+    """
+    Returns the name of the file to which :func:`get_regions` writes the data
+    for the specified (reference_name, start, end) region, such as
+    ``chr1_100_200.bam``.
+    """
+    parts = [str(value) for value in region if value is not None]
+    if len(parts) == 0:
+        parts = ["all"]
+    extension = "bam" if data_format is None else data_format.lower()
+    return "{}.{}".format("_".join(parts), extension)
+
+
+def get_regions(
+        url, regions, outputs=None, output_dir=None, parallelism=None, session=None,
+        **kwargs):
+    """
+    Runs requests for several regions of the data at the specified URL, and
+    writes the data for each region to its own output. The tickets for the
+    regions are requested concurrently, and blocks with the same URL, headers
+    and byte ranges in several tickets, such as the file header, are
+    downloaded only once and written to every output needing them. Returns
+    the list of the MD5 digests of the data written for each region.
+
+    :param str url: The URL of the data to retrieve, as for :func:`.get`.
+    :param list regions: The regions to retrieve, as a list of
+        (reference_name, start, end) tuples, where start and end may be None.
+    :param list outputs: The file-like objects to write the data for each
+        region to, in the same order as ``regions``.
+    :param str output_dir: If ``outputs`` is not specified, the directory in
+        which to write the data for each region to the file named by
+        :func:`.region_filename`.
+    :param int parallelism: The number of regions whose tickets are requested
+        and blocks downloaded concurrently. If not specified, all the regions
+        are transferred concurrently, up to :data:`POOL_MAXSIZE` at a time.
+    :param requests.Session session: The session used to make all HTTP
+        requests. If not specified, a session shared by all transfers in this
+        process is used.
+    :param kwargs: The other arguments to :func:`.get`, except for those
+        specifying the region, which apply to every region. The events passed
+        to the ``listener`` give the index of their region as ``transfer``.
+    """
+    regions = [tuple(region) for region in regions]
+    if (outputs is None) == (output_dir is None):
+        raise ValueError("Exactly one of outputs and output_dir must be specified")
+    if outputs is not None and len(outputs) != len(regions):
+        raise ValueError("The number of outputs must equal the number of regions")
+    if parallelism is None:
+        parallelism = min(len(regions), POOL_MAXSIZE)
+    parallelism = max(1, parallelism)
+    if session is None:
+        session = get_shared_session(max(POOL_MAXSIZE, parallelism))
+    filenames = []
+    if outputs is None:
+        filenames = [
+            region_filename(region, kwargs.get("data_format")) for region in regions]
+        if len(set(filenames)) != len(filenames):
+            raise ValueError("Regions must be distinct")
+    files = []
+    try:
+        for filename in filenames:
+            files.append(open(os.path.join(output_dir, filename), "wb"))
+        if outputs is None:
+            outputs = files
+        managers = [
+            SynchronousDownloadManager(
+                url, output, session=session, reference_name=reference_name,
+                start=start, end=end, **kwargs)
+            for (reference_name, start, end), output in zip(regions, outputs)]
+        for index, manager in enumerate(managers):
+            manager.transfer = index
+        with concurrent.futures.ThreadPoolExecutor(parallelism) as executor:
+            plans = list(executor.map(lambda manager: manager._plan(), managers))
+            shared_blocks = transfer.SharedBlocks(itertools.chain(*plans))
+            try:
+                list(executor.map(
+                    lambda manager, plan: manager._run_shared(plan, shared_blocks),
+                    managers, plans))
+            finally:
+                shared_blocks.close()
+        logging.info("Downloaded {} distinct blocks for {} regions".format(
+            shared_blocks.num_downloads, len(regions)))
+    finally:
+        for f in files:
+            f.close()
+    return [manager.digest for manager in managers]
+
+
+# The arguments to get() for which a Client may hold defaults.
+CLIENT_OPTIONS = frozenset([
+    "data_format", "max_retries", "retry_wait", "timeout", "bearer_token",
+    "parallelism", "backoff", "max_retry_wait", "retry_budget", "retry_deadline",
+    "bypass_ticket_cache", "buffer_size", "listener", "write_behind", "preallocate",
+    "coalesce_gap", "hedge_percentile"])
+
+
+class Client(object):
+    """
+    A reusable client for htsget transfers, holding the session, caches and
+    default options used by all the transfers made with :meth:`get`, so that
+    connections and cached tickets and blocks are shared between them. A
+    client may be used by many threads concurrently.
+
+    :param requests.Session session: The session used for all requests. If
+        not specified, a new session is created with connection pools of size
+        ``pool_maxsize``, or ``parallelism`` if larger, and closed by
+        :meth:`close`.
+    :param dict headers: Headers sent with every ticket request, updated by
+        any headers passed to :meth:`get`.
+    :param htsget.cache.BlockCache block_cache: The block cache for all
+        transfers, if any.
+    :param htsget.cache.TicketCache ticket_cache: The ticket cache for all
+        transfers, if any.
+    :param htsget.cache.HeaderCache header_cache: The header cache used by
+        :meth:`get_header`, if any.
+    :param int pool_maxsize: The maximum number of connections to keep alive
+        to any single host, if the session is created by the client.
+    :param options: Defaults for the other arguments of :func:`htsget.get`,
+        such as ``bearer_token``, ``max_retries`` or ``parallelism``, which
+        may be overridden for each transfer.
+    """
+    def __init__(
+            self, session=None, headers=None, block_cache=None, ticket_cache=None,
+            header_cache=None, pool_maxsize=POOL_MAXSIZE, **options):
+        unknown = set(options) - CLIENT_OPTIONS
+        if len(unknown) > 0:
+            raise TypeError("Unknown client options: {}".format(
+                ", ".join(sorted(unknown))))
+        self.owns_session = session is None
+        if session is None:
+            session = create_session(
+                pool_maxsize=max(pool_maxsize, options.get("parallelism", 1)))
+        self.session = session
+        self.headers = dict(headers or {})
+        self.block_cache = block_cache
+        self.ticket_cache = ticket_cache
+        self.header_cache = header_cache
+        self.options = options
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """
+        Closes the client's session if it was created by the client.
+        """
+        if self.owns_session:
+            self.session.close()
+
+    def _arguments(self, headers, kwargs):
+        """
+        Returns the keyword arguments for a transfer with the specified
+        headers and arguments, using the client's defaults.
+        """
+        request_headers = dict(self.headers)
+        request_headers.update(headers or {})
+        arguments = {
+            "session": self.session, "block_cache": self.block_cache,
+            "ticket_cache": self.ticket_cache, "headers": request_headers}
+        arguments.update(self.options)
+        arguments.update(kwargs)
+        return arguments
+
+    def get(self, url, output, headers=None, **kwargs):
+        """
+        Runs a transfer as :func:`htsget.get` using the client's session,
+        caches and default options, and returns the MD5 digest of the data
+        written to ``output``. Any of the arguments of :func:`htsget.get` may
+        be specified, overriding the client's defaults, and ``headers`` are
+        added to the client's headers.
+        """
+        return get(url, output, **self._arguments(headers, kwargs))
+
+    def get_header(self, url, headers=None, **kwargs):
+        """
+        Returns the header of the data at the specified URL as
+        :func:`htsget.get_header`, using the client's session, caches and
+        default options.
+        """
+        kwargs.setdefault("header_cache", self.header_cache)
+        return get_header(url, **self._arguments(headers, kwargs))
+
+    def get_regions(self, url, regions, headers=None, **kwargs):
+        """
+        Runs the requests for several regions as :func:`htsget.get_regions`
+        using the client's session, caches and default options, and returns
+        the list of MD5 digests of the data written for each region.
+        """
+        return get_regions(url, regions, **self._arguments(headers, kwargs))
+
+
+class SynchronousDownloadManager(transfer.TransferManager):
     """
     Class implementing the GA4GH streaming API synchronously using the
     requests library.
     """
 
-    def __get(self, *args, **kwargs):
+    def __init__(
+            self, url, output, session=None, block_cache=None, ticket_cache=None,
+            bypass_ticket_cache=False, **kwargs):
+        super(SynchronousDownloadManager, self).__init__(url, output, **kwargs)
+        if session is None:
+            session = get_shared_session(max(POOL_MAXSIZE, self.parallelism))
+        self.session = session
+        self.block_cache = block_cache
+        self.ticket_cache = ticket_cache
+        self.bypass_ticket_cache = bypass_ticket_cache
+        self.__buffers = threading.local()
+
+    def __get(self, url, retry_state=None, **kwargs):
         try:
-            response = requests.get(*args, **kwargs)
+            response = self.session.get(url, **kwargs)
         except requests.RequestException as re:
             raise exceptions.RetryableIOError(re)
+        return self.__check(response, retry_state)
+
+    def __check(self, response, retry_state=None):
+        """
+        Returns the specified response, raising the appropriate exception if
+        it is an error. The response is closed before any exception is raised.
+        """
         try:
+            if retry_state is not None:
+                retry_state.handle_response(response.status_code, response.headers)
             response.raise_for_status()
         except requests.HTTPError as he:
             # TODO classify other errors that we consider unrecoverable.
             if response.status_code in [400, 401, 404]:
-                raise exceptions.ClientError(str(he), response.text)
+                text = response.text
+                response.close()
+                raise exceptions.ClientError(str(he), text)
             else:
-                raise exceptions.RetryableIOError(he)
+                response.close()
+                error = exceptions.RetryableIOError(he)
+                if "Retry-After" in response.headers:
+                    error.retry_after = protocol.parse_retry_after(
+                        response.headers["Retry-After"])
+                raise error
+        except Exception:
+            response.close()
+            raise
         return response
 
-    def _stream(self, url, headers={}):
+    def _request(self, url, headers, retry_state=None):
+        if retry_state is not None:
+            headers = retry_state.request_headers(headers)
+        return self.__get(
+            url, retry_state=retry_state, headers=headers, stream=True,
+            timeout=self.timeout)
+
+    def _post_ticket_request(self, headers):
+        """
+        Makes the POST ticket request for the manager's regions, returning the
+        response, or None if the server does not support POST requests.
+        """
+        try:
+            response = self.session.post(
+                self.ticket_post_url, json=self.ticket_request_body, headers=headers,
+                stream=True, timeout=self.timeout)
+        except requests.RequestException as re:
+            raise exceptions.RetryableIOError(re)
+        if response.status_code in protocol.POST_UNSUPPORTED_STATUSES:
+            response.close()
+            return None
+        return self.__check(response)
+
+    def _head_size(self, url, headers):
+        try:
+            response = self.session.head(
+                url, headers=headers, timeout=self.timeout, allow_redirects=True)
+        except requests.RequestException as re:
+            logging.info("HEAD request to find block size failed: {}".format(re))
+            return None
+        encoding = response.headers.get("Content-Encoding", "identity")
+        if (not response.ok or CONTENT_LENGTH not in response.headers or
+                encoding.strip().lower() != "identity"):
+            return None
+        return int(response.headers[CONTENT_LENGTH])
+
+    def __buffer(self):
+        """
+        Returns the read buffer for the current thread, which is reused by
+        all the transfers the thread makes.
+        """
+        buf = getattr(self.__buffers, "buf", None)
+        if buf is None:
+            buf = memoryview(bytearray(self.buffer_size))
+            self.__buffers.buf = buf
+        return buf
+
+    def __readinto_pieces(self, response, fp):
+        """
+        Reads the body of the specified response directly into the buffer
+        for this thread and yields views of the data read. Each view is only
+        valid until the next piece is requested.
+        """
+        buf = self.__buffer()
+        completed = False
+        try:
+            while True:
+                try:
+                    num_bytes = fp.readinto(buf)
+                except (http_client.HTTPException, socket.error) as error:
+                    raise exceptions.RetryableIOError(error)
+                if num_bytes == 0:
+                    break
+                yield buf[:num_bytes]
+            completed = True
+        finally:
+            if completed:
+                response.raw.release_conn()
+            else:
+                response.close()
 
-        response = self.__get(url, headers=headers, stream=True, timeout=self.timeout)
+    def _iter_response(self, response):
+        """
+        Yields the pieces of the body of the specified response. Where the body
+        is not encoded, it is read directly into a reused buffer, and the pieces
+        are views that are only valid until the next piece is requested.
+        """
+        fp = getattr(getattr(response, "raw", None), "_fp", None)
+        encoding = response.headers.get("Content-Encoding", "identity")
+        if hasattr(fp, "readinto") and encoding.strip().lower() == "identity":
+            pieces = self.__readinto_pieces(response, fp)
+        else:
+            pieces = response.iter_content(self.buffer_size)
         length = 0
-        piece_size = 65536
         try:
-            for piece in response.iter_content(piece_size):
+            for piece in pieces:
                 length += len(piece)
                 yield piece
         except requests.RequestException as re:
             raise exceptions.RetryableIOError(re)
         if CONTENT_LENGTH in response.headers:
             content_length = int(response.headers[CONTENT_LENGTH])
+            if length < content_length:
+                raise exceptions.TruncatedContentError(
+                    "Length mismatch {} != {}".format(content_length, length))
             if content_length != length:
                 raise exceptions.ContentLengthMismatch(
                     "Length mismatch {} != {}".format(content_length, length))
 
-    def _handle_ticket_request(self):
-        # TODO Add some mechanism for checking the content type here. Possibly a
-        # callback that checks the headers on the ticket response?
-        # TODO Check the Content-Type for encoding and use it here, if provided.
-        encoding = "utf-8"
+    def _stream(self, url, headers={}, retry_state=None):
+        response = self._request(url, headers, retry_state)
+        for piece in self._iter_response(response):
+            yield piece
 
-        headers = self.headers if self.headers else {}
+    def _streams_ticket(self):
+        # Cached tickets are stored whole, so are not streamed.
+        return self.ticket_cache is None
 
-        if self.bearer_token is not None and "Authorization" in headers:
-            logging.warning("Both the bearer_token and Authorization header have values,"
-                            "the bearer_token will take precedence")
+    def _decode_ticket(self, response, consume=None):
+        """
+        Decodes the ticket in the specified response, storing it in the
+        manager and calling the consume function, if specified, with each URL
+        object as it is received.
+        """
+        if consume is None:
+            decoder = protocol.TicketDecoder()
+            for piece in self._iter_response(response):
+                decoder.feed(piece)
+            self.ticket = decoder.close()
+        else:
+            decoder = protocol.TicketDecoder(keep_urls=False)
+            for piece in self._iter_response(response):
+                for url_object in decoder.feed(piece):
+                    consume(url_object)
+            self.ticket = decoder.close()
+            for url_object in decoder.urls:
+                consume(url_object)
 
-        if self.bearer_token is not None:
-            headers["Authorization"] = "Bearer {}".format(self.bearer_token)
+    def _handle_regions_ticket_request(self, consume=None):
+        """
+        Requests the ticket for the manager's regions using a single POST
+        request, or GET requests for each region if the server does not
+        support POST, merging the tickets.
+        """
+        headers = self._ticket_request_headers()
+        if self.post_supported:
+            logging.debug("handle_regions_ticket_request(url={}, body={})".format(
+                self.ticket_post_url, self.ticket_request_body))
+            response = self._post_ticket_request(headers)
+            if response is not None:
+                self._decode_ticket(response, consume)
+                return
+            logging.info("POST ticket requests not supported; using GET for each region")
+            self.post_supported = False
+        tickets = []
+        for url in self.region_request_urls:
+            self.ticket = None
+            self._decode_ticket(self._request(url, headers))
+            tickets.append(self.ticket)
+        self.ticket = protocol.merge_tickets(tickets)
+        if consume is not None:
+            for url_object in self.ticket.pop("urls"):
+                consume(url_object)
 
+    def _handle_ticket_request(self, consume=None):
+        if self.ticket_request_body is not None:
+            # Tickets for several regions are not cached.
+            self._handle_regions_ticket_request(consume)
+            return
+        # TODO Add some mechanism for checking the content type here. Possibly a
+        # callback that checks the headers on the ticket response?
+        # TODO Check the Content-Type for encoding and use it here, if provided.
+        headers = self._ticket_request_headers()
         # TODO should we XXXX out the actual token here in case someone leaks
         # the bearer token to logs??
         logging.debug("handle_ticket_request(url={}, headers={})".format(
             self.ticket_request_url, headers))
-        stream = iter(self._stream(self.ticket_request_url, headers=headers))
-        # Peek at the first few bytes of the result to see if it is probably JSON.
-        # If not we can end the transfer early. This is useful when the user mistakenly
-        # points to a URL for a very large file. In practise, we will often get
-        # UnicodeDecodeError when we do this.
-        try:
-            first_piece = next(stream, "").decode(encoding)
-        except UnicodeDecodeError as ude:
-            raise exceptions.TicketDecodeError(ude)
-        if len(first_piece) == 0:
-            raise exceptions.EmptyTicketError()
-        stripped = first_piece.lstrip()
-        if stripped[0] != '{':
-            raise exceptions.InvalidLeadingJsonError(stripped[0])
-        text = "".join([first_piece] + [piece.decode(encoding) for piece in stream])
-        self.ticket = protocol.parse_ticket(text)
-
-    def _handle_http_url(self, url, headers):
-        logging.debug("handle_http_url(url={}, headers={})".format(url, headers))
-        before = time.time()
+        entry = None
+        request_headers = headers
+        if self.ticket_cache is not None and not self.bypass_ticket_cache:
+            entry = self.ticket_cache.get(self.ticket_request_url, headers)
+            if entry is not None:
+                if entry.is_fresh():
+                    logging.info("Using cached ticket")
+                    self.ticket = entry.ticket
+                    return
+                request_headers = dict(headers)
+                request_headers.update(entry.conditional_headers())
+        response = self._request(self.ticket_request_url, request_headers)
+        if entry is not None and response.status_code == 304:
+            response.close()
+            logging.info("Using revalidated cached ticket")
+            self.ticket_cache.refresh(
+                self.ticket_request_url, headers, entry, response.headers)
+            self.ticket = entry.ticket
+            return
+        self._decode_ticket(response, consume)
+        if self.ticket_cache is not None and consume is None:
+            self.ticket_cache.put(
+                self.ticket_request_url, headers, self.ticket, response.headers)
+
+    def _handle_cached_block(self, url, headers, output, retry_state):
+        """
+        Writes the specified block to the output from the block cache if the
+        server confirms that the cached entry is current, and returns the
+        response to the conditional request, or None if the block is not in
+        the cache.
+        """
+        if retry_state.offset > 0:
+            return None
+        entry = self.block_cache.get(url, headers)
+        if entry is None:
+            return None
+        with entry:
+            conditional_headers = dict(headers)
+            conditional_headers["If-None-Match"] = entry.etag
+            response = self._request(url, conditional_headers, retry_state)
+            if response.status_code == 304:
+                response.close()
+                for piece in iter(lambda: entry.file.read(self.buffer_size), b""):
+                    self._received(retry_state, len(piece))
+                    output.write(piece)
+        return response
+
+    def _handle_http_url(self, url, headers, output, retry_state):
+        logging.debug("handle_http_url(url={}, headers={}, offset={})".format(
+            url, headers, retry_state.offset))
+        before = protocol.clock()
+        response = None
+        if self.block_cache is not None:
+            response = self._handle_cached_block(url, headers, output, retry_state)
+            if response is not None and response.status_code == 304:
+                logging.info("Using cached block for {}".format(url))
+                return
+        if response is None:
+            response = self._request(url, headers, retry_state)
+        cache_writer = None
+        etag = response.headers.get("ETag")
+        if (self.block_cache is not None and retry_state.offset == 0 and
+                response.status_code in [200, 206] and etag is not None and
+                not etag.startswith("W/")):
+            cache_writer = self.block_cache.put(url, headers, etag)
         size = 0
-        for piece in self._stream(url, headers):
-            size += len(piece)
-            self.output.write(piece)
-        duration = time.time() - before
-        # On Windows we seem to get 0 values for duration. Just round up to one second.
-        # Rates over intervals less than this are meaningless anyway.
-        duration = max(1, duration)
-        rate = (size / (2 ** 20)) / duration
-        logging.info("Downloaded {} chunk in {:.2f} seconds @ {:.2f} MiB/s".format(
+        try:
+            for piece in self._iter_response(response):
+                size += len(piece)
+                self._received(retry_state, len(piece))
+                output.write(piece)
+                if cache_writer is not None:
+                    cache_writer.write(piece)
+        except Exception:
+            if cache_writer is not None:
+                cache_writer.abort()
+            raise
+        if cache_writer is not None:
+            cache_writer.commit()
+        duration = protocol.clock() - before
+        rate = (size / (2 ** 20)) / duration if duration > 0 else 0
+        logging.info("Downloaded {} chunk in {:.3f} seconds @ {:.2f} MiB/s".format(
             humanize.naturalsize(size, binary=True), duration, rate))
@@ -14,30 +14,137 @@
 # limitations under the License.
 #
 """
-Sans IO protocol handling code to the GA4GH streaming API.
+Sans IO protocol handling code to the GA4GH streaming API: ticket requests
+and responses, byte ranges, retries and data URIs. The blocks of a transfer
+are scheduled and written to the output by :mod:`htsget.transfer`.
 """
 from __future__ import division
 from __future__ import print_function
 
-import base64
+import binascii
+import codecs
+import contextlib
+import email.utils
+import hashlib
 import json
 import logging
+import random
+import re
+import threading
 import time
 
+import six
+from six.moves import intern
 from six.moves.urllib.parse import urlencode
 from six.moves.urllib.parse import urlunparse
 from six.moves.urllib.parse import urlparse
 from six.moves.urllib.parse import parse_qs
+from six.moves.urllib.parse import unquote
+from six.moves.urllib.parse import unquote_to_bytes
 
 import htsget.exceptions as exceptions
 
 TICKET_ROOT_KEY = "htsget"
 
+JSON_WHITESPACE = " \t\n\r"
+# Matches the characters that can end a JSON value, or follow one.
+JSON_VALUE_END = re.compile(r'[\]}",\s]')
+# The size of an incomplete value in a ticket above which it is only parsed
+# again once the text received has doubled, so that decoding stays linear.
+JSON_REPARSE_SIZE = 65536
+
+BACKOFF_FIXED = "fixed"
+BACKOFF_EXPONENTIAL = "exponential"
+BACKOFF_DECORRELATED = "decorrelated"
+BACKOFF_POLICIES = [BACKOFF_FIXED, BACKOFF_EXPONENTIAL, BACKOFF_DECORRELATED]
+
+# A high resolution clock that is not affected by changes to the system time,
+# where available.
+clock = getattr(time, "perf_counter", time.time)
+
+# The maximum size in bytes of a request made by coalescing the byte ranges of
+# consecutive blocks.
+COALESCE_MAX_SIZE = 64 * 2**20
+
+# The default size in bytes of the buffer into which response bodies are read.
+BUFFER_SIZE = 65536
+
+# The types of the events passed to transfer listeners.
+EVENT_TICKET_START = "ticket_start"
+EVENT_TICKET_END = "ticket_end"
+EVENT_BLOCK_START = "block_start"
+EVENT_FIRST_BYTE = "first_byte"
+EVENT_PROGRESS = "progress"
+EVENT_RETRY = "retry"
+EVENT_BLOCK_END = "block_end"
+EVENT_TRANSFER_END = "transfer_end"
+EVENT_HEDGE = "hedge"
+
+# The classes of data that can be requested.
+CLASS_HEADER = "header"
+CLASS_BODY = "body"
+REQUEST_CLASSES = [CLASS_HEADER, CLASS_BODY]
+
+# The fields of read records that can be requested, the pattern that tags
+# must match, and the formats of variant data, which cannot be filtered.
+READ_FIELDS = [
+    "QNAME", "FLAG", "RNAME", "POS", "MAPQ", "CIGAR", "RNEXT", "PNEXT", "TLEN",
+    "SEQ", "QUAL"]
+TAG_PATTERN = re.compile(r"^[A-Za-z][A-Za-z0-9]$")
+VARIANT_FORMATS = ["VCF", "BCF"]
+
+# The statuses of the responses to POST ticket requests from servers that do
+# not support them, for which tickets are requested for each region by GET.
+POST_UNSUPPORTED_STATUSES = [404, 405, 501]
+
+
+def check_request_class(request_class):
+    """
+    Raises ValueError if the specified class of data cannot be requested.
+    """
+    if request_class is not None and request_class not in REQUEST_CLASSES:
+        raise ValueError("Unknown class {}; must be one of {}".format(
+            request_class, ", ".join(REQUEST_CLASSES)))
+
+
+def check_filters(fields=None, tags=None, notags=None, data_format=None):
+    """
+    Returns the specified lists of the read fields to request and of the tags
+    to include and exclude, with the fields in upper case. Raises ValueError
+    if any are invalid, if a tag is both included and excluded, or if they
+    are specified for variant data.
+    """
+    specified = [values for values in [fields, tags, notags] if values is not None]
+    if any(isinstance(values, six.string_types) for values in specified):
+        raise ValueError("Fields and tags must be given as lists of strings")
+    if (len(specified) > 0 and data_format is not None and
+            data_format.upper() in VARIANT_FORMATS):
+        raise ValueError("Fields and tags cannot be requested for {} data".format(
+            data_format.upper()))
+    if fields is not None:
+        fields = [str(field).upper() for field in fields]
+        for field in fields:
+            if field not in READ_FIELDS:
+                raise ValueError("Unknown field {}; must be one of {}".format(
+                    field, ", ".join(READ_FIELDS)))
+    for values in [tags, notags]:
+        for tag in values or []:
+            if not isinstance(tag, six.string_types) or TAG_PATTERN.match(tag) is None:
+                raise ValueError("Invalid tag {}".format(tag))
+    if tags is not None and notags is not None:
+        both = set(tags) & set(notags)
+        if len(both) > 0:
+            raise ValueError("Tags cannot be both included and excluded: {}".format(
+                ", ".join(sorted(both))))
+    return fields, tags, notags
+
 
 def ticket_request_url(
         url, fmt=None, reference_name=None, reference_md5=None,
         start=None, end=None, fields=None, tags=None, notags=None,
-        data_format=None):
+        data_format=None, request_class=None):
+    check_request_class(request_class)
+    fields, tags, notags = check_filters(fields, tags, notags, data_format)
     parsed_url = urlparse(url)
     get_vars = parse_qs(parsed_url.query)
     # TODO error checking
@@ -51,17 +158,89 @@ def ticket_request_url(
         get_vars["end"] = int(end)
     if data_format is not None:
         get_vars["format"] = data_format.upper()
-    # if fields is not None:
-    #     get_vars["fields"] = ",".join(fields)
-    # if tags is not None:
-    #     get_vars["tags"] = ",".join(tags)
-    # if notags is not None:
-    #     get_vars["notags"] = ",".join(notags)
+    if request_class is not None:
+        get_vars["class"] = request_class
+    # An empty list of tags is sent as an empty value, requesting no tags.
+    if fields is not None:
+        get_vars["fields"] = ",".join(fields)
+    if tags is not None:
+        get_vars["tags"] = ",".join(tags)
+    if notags is not None:
+        get_vars["notags"] = ",".join(notags)
     new_url = list(parsed_url)
     new_url[4] = urlencode(get_vars, doseq=True)
     return urlunparse(new_url)
 
 
+def ticket_request_body(
+        regions, data_format=None, request_class=None, fields=None, tags=None,
+        notags=None):
+    """
+    Returns the JSON body of a POST ticket request for the specified list of
+    (reference_name, start, end) regions, where start and end may be None.
+    """
+    check_request_class(request_class)
+    fields, tags, notags = check_filters(fields, tags, notags, data_format)
+    body = {}
+    if data_format is not None:
+        body["format"] = data_format.upper()
+    if request_class is not None:
+        body["class"] = request_class
+    for key, values in [("fields", fields), ("tags", tags), ("notags", notags)]:
+        if values is not None:
+            body[key] = list(values)
+    body["regions"] = []
+    for reference_name, start, end in regions:
+        if reference_name is None:
+            raise ValueError("Each region must have a reference name")
+        region = {"referenceName": reference_name}
+        if start is not None:
+            region["start"] = int(start)
+        if end is not None:
+            region["end"] = int(end)
+        body["regions"].append(region)
+    return body
+
+
+def merge_tickets(tickets):
+    """
+    Returns a single ticket for the data in the specified tickets for
+    separate regions, for use when a server does not support POST requests.
+    URL objects repeated from earlier tickets, such as the file header, are
+    omitted. The trailing URL objects that every ticket ends with, such as
+    an EOF marker, are placed at the end of the merged ticket. Blocks that
+    differ but contain the same records are not detected, so records
+    overlapping several regions may be repeated. The merged ticket has no MD5.
+    """
+    merged = {"urls": []}
+    keys = [
+        [json.dumps(url_object, sort_keys=True) for url_object in ticket["urls"]]
+        for ticket in tickets]
+    # The trailer never includes the first URL object of a ticket.
+    num_trailing = 0
+    if len(keys) > 1:
+        max_trailing = min(len(ticket_keys) for ticket_keys in keys) - 1
+        while (num_trailing < max_trailing and len(set(
+                ticket_keys[-num_trailing - 1] for ticket_keys in keys)) == 1):
+            num_trailing += 1
+    seen = set()
+    for ticket, ticket_keys in zip(tickets, keys):
+        if "format" in ticket:
+            merged.setdefault("format", ticket["format"])
+        num_urls = len(ticket_keys) - num_trailing
+        for url_object, key in zip(ticket["urls"][:num_urls], ticket_keys):
+            if key not in seen:
+                seen.add(key)
+                merged["urls"].append(url_object)
+    if num_trailing > 0:
+        for url_object, key in zip(
+                tickets[0]["urls"][-num_trailing:], keys[0][-num_trailing:]):
+            if key not in seen:
+                seen.add(key)
+                merged["urls"].append(url_object)
+    return merged
+
+
 def parse_ticket(json_text):
     """
     Parses the specified ticket response and returns a dictionary of the
@@ -76,6 +255,869 @@ def parse_ticket(json_text):
     return parsed[TICKET_ROOT_KEY]
 
 
+def parse_range(value):
+    """
+    Parses the specified value of an HTTP Range header and returns the tuple
+    (start, end), where end is inclusive and None if the range is open ended.
+    Returns None if the value is not a single byte range with a start offset.
+    """
+    unit, _, byte_range = value.partition("=")
+    start, sep, end = byte_range.strip().partition("-")
+    if unit.strip().lower() != "bytes" or sep != "-" or "," in end:
+        return None
+    try:
+        start = int(start)
+        end = int(end) if end.strip() != "" else None
+    except ValueError:
+        return None
+    return start, end
+
+
+class DataUri(object):
+    """
+    A data URI, as defined in RFC 2397. The media type is stored in
+    ``media_type`` and its parameters in the dictionary ``parameters``, with
+    lower case names. The payload is decoded, from base64 if the URI has the
+    ``;base64`` parameter and otherwise from percent-encoded bytes, in pieces
+    by :meth:`pieces`, so that large payloads are not decoded all at once.
+    Raises ValueError if the URI is not a valid data URI.
+    """
+    def __init__(self, uri):
+        if uri[:5].lower() != "data:":
+            raise ValueError("Not a data URI")
+        comma = uri.find(",")
+        if comma == -1:
+            raise ValueError("No ',' in data URI")
+        self.uri = uri
+        self.start = comma + 1
+        parts = uri[5:comma].split(";")
+        self.base64 = len(parts) > 1 and parts[-1].strip().lower() == "base64"
+        if self.base64:
+            parts.pop()
+        self.media_type = unquote(parts[0]).strip().lower()
+        self.parameters = {}
+        for part in parts[1:]:
+            name, _, value = unquote(part).partition("=")
+            self.parameters[name.strip().lower()] = value.strip().strip('"')
+        if self.media_type == "":
+            self.media_type = "text/plain"
+            self.parameters.setdefault("charset", "US-ASCII")
+
+    def __text_pieces(self, piece_size):
+        """
+        Returns the payload as pieces of at most the specified size, which do
+        not split percent-encoded octets.
+        """
+        end = len(self.uri)
+        position = self.start
+        while position < end:
+            text = self.uri[position: position + piece_size]
+            position += len(text)
+            escape = text.find("%", len(text) - 2)
+            if escape > 0 and position < end:
+                position -= len(text) - escape
+                text = text[:escape]
+            yield text
+
+    def pieces(self, piece_size=BUFFER_SIZE):
+        """
+        Returns an iterator over the decoded payload, in pieces decoded from
+        at most piece_size characters of the URI.
+        """
+        piece_size = max(4, piece_size)
+        remainder = b""
+        for text in self.__text_pieces(piece_size):
+            data = unquote_to_bytes(text)
+            if not self.base64:
+                yield data
+                continue
+            data = remainder + data.translate(None, b" \t\r\n")
+            length = len(data) - len(data) % 4
+            remainder = data[length:]
+            if length > 0:
+                yield binascii.a2b_base64(data[:length])
+        if len(remainder) > 0:
+            raise ValueError("Incorrect padding in base64 data URI")
+
+    def size(self, piece_size=BUFFER_SIZE):
+        """
+        Returns the length of the decoded payload.
+        """
+        return sum(len(piece) for piece in self.pieces(piece_size))
+
+
+def format_range(start, end=None):
+    """
+    Returns the value of an HTTP Range header for the specified byte range.
+    """
+    return "bytes={}-{}".format(start, "" if end is None else end)
+
+
+def get_header(headers, name):
+    """
+    Returns the key for the specified header in the specified dictionary,
+    ignoring case, or None if it is not present.
+    """
+    name = name.lower()
+    for key in headers:
+        if key.lower() == name:
+            return key
+    return None
+
+
+def resume_headers(headers, offset, validator=None):
+    """
+    Returns a copy of the specified block request headers, modified to request
+    only the data after the first offset bytes of the block. If the validator
+    is specified, it is sent as If-Range so that the server returns the full
+    block if it has changed since the first request. Returns None if the
+    existing Range header cannot be resumed.
+    """
+    resumed = dict(headers)
+    start, end = 0, None
+    range_key = get_header(headers, "Range")
+    if range_key is not None:
+        byte_range = parse_range(headers[range_key])
+        if byte_range is None:
+            return None
+        start, end = byte_range
+        del resumed[range_key]
+    resumed["Range"] = format_range(start + offset, end)
+    if validator is not None:
+        resumed["If-Range"] = validator
+    return resumed
+
+
+def parse_retry_after(value, now=None):
+    """
+    Parses the specified value of an HTTP Retry-After header, which may either
+    be a number of seconds or an HTTP date, and returns the number of seconds
+    to wait. Returns None if the value cannot be parsed.
+    """
+    try:
+        return max(0, float(value))
+    except ValueError:
+        pass
+    parsed = email.utils.parsedate_tz(value)
+    if parsed is None:
+        return None
+    now = time.time() if now is None else now
+    return max(0, email.utils.mktime_tz(parsed) - now)
+
+
+class RetryPolicy(object):
+    """
+    The policy deciding whether failed requests within a single htsget transfer
+    are retried, and how long to wait before doing so. Waits grow according to
+    the backoff policy from ``retry_wait`` seconds up to ``max_retry_wait``
+    seconds; ``fixed`` always waits ``retry_wait`` seconds, ``exponential``
+    doubles the wait after each attempt and ``decorrelated`` chooses each wait
+    at random between ``retry_wait`` and three times the previous wait. Waits
+    are extended to honour any Retry-After value returned by the server.
+
+    Each request is retried at most ``max_retries`` times. If ``retry_budget``
+    is specified, at most this many retries are made in total across all the
+    requests of the transfer, and if ``retry_deadline`` is specified, no retry
+    is made that would start more than this many seconds after the policy was
+    created. A policy is safe to use from multiple threads.
+    """
+    def __init__(
+            self, max_retries=5, retry_wait=5, backoff=BACKOFF_EXPONENTIAL,
+            max_retry_wait=60, retry_budget=None, retry_deadline=None):
+        if backoff not in BACKOFF_POLICIES:
+            raise ValueError("Unknown backoff policy: {}".format(backoff))
+        self.max_retries = max_retries
+        self.retry_wait = retry_wait
+        self.backoff = backoff
+        self.max_retry_wait = max_retry_wait
+        self.retry_budget = retry_budget
+        self.retry_deadline = retry_deadline
+        self.start_time = clock()
+        self.num_retries = 0
+        self.lock = threading.Lock()
+        self.random = random.Random()
+
+    def _backoff_wait(self, num_retries, previous_wait):
+        if self.backoff == BACKOFF_FIXED:
+            wait = self.retry_wait
+        elif self.backoff == BACKOFF_EXPONENTIAL:
+            wait = self.retry_wait * 2 ** (num_retries - 1)
+        else:
+            previous_wait = self.retry_wait if previous_wait is None else previous_wait
+            wait = self.random.uniform(self.retry_wait, 3 * previous_wait)
+        return min(self.max_retry_wait, wait)
+
+    def wait_time(self, num_retries, previous_wait=None, retry_after=None):
+        """
+        Returns the number of seconds to wait before making the specified retry
+        of a request, where the previous wait for the request was previous_wait
+        seconds, or None if the request should not be retried.
+        """
+        if num_retries > self.max_retries:
+            return None
+        wait = self._backoff_wait(num_retries, previous_wait)
+        if retry_after is not None:
+            wait = max(wait, retry_after)
+        with self.lock:
+            if self.retry_budget is not None and self.num_retries >= self.retry_budget:
+                logging.warning("Retry budget of {} exhausted".format(self.retry_budget))
+                return None
+            if self.retry_deadline is not None:
+                if clock() + wait - self.start_time > self.retry_deadline:
+                    logging.warning("Retry deadline of {}s exceeded".format(
+                        self.retry_deadline))
+                    return None
+            self.num_retries += 1
+        return wait
+
+
+class TicketDecoder(object):
+    """
+    Incrementally decodes the body of a ticket response. Pieces of the body
+    are passed to :meth:`feed` as they are received, which returns the URL
+    objects in the ticket decoded so far, so that they can be downloaded while
+    the rest of the ticket is still arriving. The parsed ticket is returned by
+    :meth:`close`; if ``keep_urls`` is False, the URL objects are not retained
+    and are omitted from it, so that memory usage does not grow with the size
+    of the ticket. The leading bytes of the response are checked to see if it
+    is probably JSON, so that the transfer can be abandoned early if the user
+    mistakenly points to a URL for a very large file.
+    """
+    # The states of the parser, which expects the next token to be:
+    ROOT_START = "root_start"  # The '{' starting the response.
+    MEMBER_FIRST = "member_first"  # The first key in an object, or '}'.
+    MEMBER_NEXT = "member_next"  # The ',' before the next key in an object, or '}'.
+    KEY = "key"  # The key of an object member.
+    COLON = "colon"  # The ':' after a key.
+    VALUE = "value"  # The value of an object member.
+    TICKET_START = "ticket_start"  # The '{' starting the ticket.
+    URLS_START = "urls_start"  # The '[' starting the list of URLs.
+    URL_FIRST = "url_first"  # The first URL object, or ']'.
+    URL_NEXT = "url_next"  # The ',' before the next URL object, or ']'.
+    URL = "url"  # A URL object.
+    DONE = "done"  # Nothing but whitespace.
+
+    def __init__(self, encoding="utf-8", keep_urls=True):
+        self.decoder = codecs.getincrementaldecoder(encoding)()
+        self.json_decoder = json.JSONDecoder()
+        self.keep_urls = keep_urls
+        self.leading_checked = False
+        self.buffer = ""
+        # The text received since the buffer was last parsed, which is joined
+        # to it only when parsing, as appending each piece is quadratic.
+        self.pending = []
+        self.pending_size = 0
+        # Whether a delimiter that may complete the awaited value is pending.
+        self.value_ended = False
+        self.state = self.ROOT_START
+        # Whether we are parsing the members of the ticket or of the root.
+        self.in_ticket = False
+        self.key = None
+        # Whether a value could not be parsed until more data arrives.
+        self.waiting = False
+        self.closed = False
+        self.ticket = None
+        self.urls = []
+        self.num_urls = 0
+
+    def __check_leading(self, text):
+        stripped = text.lstrip()
+        if len(stripped) > 0:
+            if stripped[0] != '{':
+                raise exceptions.InvalidLeadingJsonError(stripped[0])
+            self.leading_checked = True
+
+    def __invalid(self, message):
+        return exceptions.InvalidJsonError(ValueError(message))
+
+    def __skip_whitespace(self, pos):
+        while pos < len(self.buffer) and self.buffer[pos] in JSON_WHITESPACE:
+            pos += 1
+        return pos
+
+    def __expect(self, pos, chars, malformed=False):
+        """
+        Returns the position of the next token, which must be one of the
+        specified characters, or None if more data is needed. If ``malformed``
+        is True, other characters are valid JSON but not a valid ticket.
+        """
+        pos = self.__skip_whitespace(pos)
+        if pos == len(self.buffer):
+            if self.closed:
+                raise self.__invalid("Unexpected end of ticket")
+            return None
+        if self.buffer[pos] not in chars:
+            if malformed:
+                raise exceptions.MalformedJsonError()
+            raise self.__invalid("Unexpected '{}' at position {} in ticket".format(
+                self.buffer[pos], pos))
+        return pos
+
+    def __value(self, pos):
+        """
+        Returns the tuple (value, end) for the JSON value at the specified
+        position, or None if more data is needed.
+        """
+        try:
+            value, end = self.json_decoder.raw_decode(self.buffer, pos)
+        except ValueError as ve:
+            if self.closed:
+                raise exceptions.InvalidJsonError(ve)
+            self.waiting = True
+            return None
+        if (not self.closed and isinstance(value, (int, float)) and
+                not isinstance(value, bool) and (
+                    end == len(self.buffer) or
+                    JSON_VALUE_END.match(self.buffer, end) is None)):
+            # The number may continue in the next piece, as when the buffer
+            # ends with '1.' or '1e', so wait until a delimiter follows it.
+            self.waiting = True
+            return None
+        self.waiting = False
+        return value, end
+
+    def __parse(self):
+        """
+        Parses as much of the buffered text as possible, and returns the URL
+        objects decoded.
+        """
+        if len(self.pending) > 0:
+            self.buffer += "".join(self.pending)
+            self.pending = []
+            self.pending_size = 0
+        self.value_ended = False
+        urls = []
+        pos = 0
+        while True:
+            state = self.state
+            if state == self.DONE:
+                pos = self.__skip_whitespace(pos)
+                if pos < len(self.buffer):
+                    raise self.__invalid("Extra data after ticket")
+                break
+            if state in [self.ROOT_START, self.TICKET_START]:
+                found = self.__expect(pos, "{", state == self.TICKET_START)
+                if found is None:
+                    break
+                pos = found
+                self.in_ticket = state == self.TICKET_START
+                if self.in_ticket:
+                    self.ticket = {}
+                self.state = self.MEMBER_FIRST
+                pos += 1
+            elif state in [self.MEMBER_FIRST, self.MEMBER_NEXT]:
+                chars = '"}' if state == self.MEMBER_FIRST else ",}"
+                found = self.__expect(pos, chars)
+                if found is None:
+                    break
+                pos = found
+                if self.buffer[pos] == "}":
+                    pos += 1
+                    if self.in_ticket:
+                        self.in_ticket = False
+                        self.state = self.MEMBER_NEXT
+                    else:
+                        self.state = self.DONE
+                elif self.buffer[pos] == ",":
+                    pos += 1
+                    self.state = self.KEY
+                else:
+                    self.state = self.KEY
+            elif state == self.KEY:
+                found = self.__expect(pos, '"')
+                if found is None:
+                    break
+                pos = found
+                parsed = self.__value(pos)
+                if parsed is None:
+                    break
+                self.key, pos = parsed
+                self.state = self.COLON
+            elif state == self.COLON:
+                found = self.__expect(pos, ":")
+                if found is None:
+                    break
+                pos = found
+                pos += 1
+                self.state = self.VALUE
+                if not self.in_ticket and self.key == TICKET_ROOT_KEY:
+                    self.state = self.TICKET_START
+                elif self.in_ticket and self.key == "urls":
+                    self.state = self.URLS_START
+            elif state == self.VALUE:
+                pos = self.__skip_whitespace(pos)
+                parsed = self.__value(pos)
+                if parsed is None:
+                    break
+                value, pos = parsed
+                if self.in_ticket:
+                    self.ticket[self.key] = value
+                self.state = self.MEMBER_NEXT
+            elif state == self.URLS_START:
+                found = self.__expect(pos, "[", True)
+                if found is None:
+                    break
+                pos = found
+                pos += 1
+                self.state = self.URL_FIRST
+            elif state in [self.URL_FIRST, self.URL_NEXT]:
+                pos = self.__skip_whitespace(pos)
+                if pos == len(self.buffer) and not self.closed:
+                    break
+                if pos < len(self.buffer) and self.buffer[pos] == "]":
+                    pos += 1
+                    self.state = self.MEMBER_NEXT
+                elif state == self.URL_FIRST:
+                    self.state = self.URL
+                else:
+                    pos = self.__expect(pos, ",")
+                    pos += 1
+                    self.state = self.URL
+            elif state == self.URL:
+                pos = self.__skip_whitespace(pos)
+                parsed = self.__value(pos)
+                if parsed is None:
+                    break
+                url_object, pos = parsed
+                if not isinstance(url_object, dict):
+                    raise exceptions.MalformedJsonError()
+                urls.append(url_object)
+                self.num_urls += 1
+                self.state = self.URL_NEXT
+        self.buffer = self.buffer[pos:]
+        if self.keep_urls:
+            self.urls.extend(urls)
+        return urls
+
+    def feed(self, data):
+        """
+        Decodes the specified piece of the response, and returns the list of
+        URL objects completed by it.
+        """
+        try:
+            text = self.decoder.decode(data)
+        except UnicodeDecodeError as ude:
+            raise exceptions.TicketDecodeError(ude)
+        if not self.leading_checked:
+            self.__check_leading(text)
+        self.pending.append(text)
+        self.pending_size += len(text)
+        if self.waiting:
+            if not self.value_ended:
+                self.value_ended = JSON_VALUE_END.search(text) is not None
+            # The value being parsed cannot have been completed without a
+            # delimiter, and a large value is parsed again from its start only
+            # once the text buffered for it has doubled.
+            if not self.value_ended or (
+                    len(self.buffer) > JSON_REPARSE_SIZE and
+                    self.pending_size < len(self.buffer)):
+                return []
+        return self.__parse()
+
+    def close(self):
+        """
+        Decodes the remainder of the response, and returns the ticket. Any URL
+        objects not yet returned by :meth:`feed` are in the ``urls`` attribute
+        of the decoder.
+        """
+        try:
+            text = self.decoder.decode(b"", final=True)
+        except UnicodeDecodeError as ude:
+            raise exceptions.TicketDecodeError(ude)
+        if not self.leading_checked:
+            self.__check_leading(text)
+        if not self.leading_checked:
+            raise exceptions.EmptyTicketError()
+        self.pending.append(text)
+        self.closed = True
+        urls = self.__parse()
+        if not self.keep_urls:
+            self.urls = urls
+        if self.state != self.DONE:
+            raise self.__invalid("Unexpected end of ticket")
+        if self.ticket is None:
+            raise exceptions.MalformedJsonError()
+        ticket = dict(self.ticket)
+        if self.keep_urls:
+            ticket["urls"] = self.urls
+        return ticket
+
+
+class TicketStream(object):
+    """
+    Tracks the URL objects received from a ticket that is being streamed
+    while its blocks are downloaded. If the ticket request is retried, the
+    URL objects already received are returned by the server again; these are
+    checked to be unchanged, using a digest of the objects received so far,
+    and skipped.
+    """
+    def __init__(self):
+        self.num_urls = 0
+        self.md5 = hashlib.md5()
+        self.attempt_num_urls = 0
+        self.attempt_md5 = None
+
+    def start_attempt(self):
+        """
+        Starts a new attempt to receive the ticket.
+        """
+        self.attempt_num_urls = 0
+        self.attempt_md5 = hashlib.md5()
+
+    def is_new(self, url_object):
+        """
+        Returns True if the specified URL object, the next in the current
+        attempt, has not been received before.
+        """
+        data = json.dumps(url_object, sort_keys=True).encode("utf-8")
+        self.attempt_md5.update(data)
+        self.attempt_num_urls += 1
+        if self.attempt_num_urls <= self.num_urls:
+            if (self.attempt_num_urls == self.num_urls and
+                    self.attempt_md5.digest() != self.md5.digest()):
+                raise exceptions.TicketChangedError()
+            return False
+        self.md5.update(data)
+        self.num_urls += 1
+        return True
+
+    def end_attempt(self):
+        """
+        Checks that the attempt which has completed returned all of the URL
+        objects received before.
+        """
+        if self.attempt_num_urls < self.num_urls:
+            raise exceptions.TicketChangedError()
+
+
+class BlockDescriptor(object):
+    """
+    A compact representation of a URL object in a ticket, describing a block
+    of the data. A single byte range in the Range header is held as the
+    integer offsets ``range_start`` and ``range_end`` (inclusive, or None if
+    open ended), and the other headers as a tuple of (key, value) pairs,
+    which is shared between blocks with the same headers when the descriptors
+    are created by :meth:`parse` with the same header cache. Blocks made by
+    coalescing the ranges of several blocks list the ranges of bytes between
+    them, which are discarded, in ``gaps``; see :class:`.RangeCoalescer`.
+    """
+    __slots__ = ["url", "header_items", "range_start", "range_end", "gaps"]
+
+    def __init__(
+            self, url, header_items=(), range_start=None, range_end=None, gaps=()):
+        self.url = url
+        self.header_items = header_items
+        self.range_start = range_start
+        self.range_end = range_end
+        self.gaps = gaps
+
+    @classmethod
+    def parse(cls, url_object, header_cache=None):
+        """
+        Returns the descriptor for the specified URL object. Header keys are
+        interned, and if header_cache is a dictionary, it is used to share the
+        header tuples between descriptors.
+        """
+        try:
+            url = url_object["url"]
+            headers = url_object.get("headers") or {}
+            items = list(headers.items())
+        except (AttributeError, KeyError, TypeError):
+            raise exceptions.MalformedJsonError()
+        range_start = range_end = None
+        for j, (key, value) in enumerate(items):
+            if key.lower() == "range" and isinstance(value, six.string_types):
+                parsed = parse_range(value)
+                if parsed is not None:
+                    range_start, range_end = parsed
+                    del items[j]
+                break
+        header_items = tuple(
+            (intern(key) if isinstance(key, str) else key, value)
+            for key, value in items)
+        if header_cache is not None:
+            try:
+                header_items = header_cache.setdefault(header_items, header_items)
+            except TypeError:
+                # Values that are not hashable are not shared.
+                pass
+        return cls(url, header_items, range_start, range_end)
+
+    @property
+    def headers(self):
+        """
+        The headers to send with requests for this block, as a new dictionary.
+        """
+        headers = dict(self.header_items)
+        if self.range_start is not None:
+            headers["Range"] = format_range(self.range_start, self.range_end)
+        return headers
+
+    def to_url_object(self):
+        """
+        Returns the URL object in the ticket for this block.
+        """
+        url_object = {"url": self.url}
+        if self.header_items or self.range_start is not None:
+            url_object["headers"] = self.headers
+        return url_object
+
+
+class RangeCoalescer(object):
+    """
+    Merges consecutive blocks requesting byte ranges of the same URL with the
+    same headers into single blocks, so that fewer requests are made. Ranges
+    separated by at most ``max_gap`` bytes are merged, and the bytes between
+    them are recorded in the ``gaps`` of the merged block as (start, length)
+    tuples relative to its start, so that they can be discarded. Merged
+    blocks are at most ``max_size`` bytes long.
+    """
+    def __init__(self, max_gap, max_size=COALESCE_MAX_SIZE):
+        if max_gap < 0:
+            raise ValueError("max_gap must not be negative")
+        self.max_gap = max_gap
+        self.max_size = max_size
+        self.current = None
+
+    def _mergeable(self, first, second):
+        if (first.url != second.url or first.header_items != second.header_items or
+                first.range_end is None or second.range_start is None or
+                second.range_end is None):
+            return False
+        gap = second.range_start - first.range_end - 1
+        return (
+            0 <= gap <= self.max_gap and
+            second.range_end - first.range_start + 1 <= self.max_size)
+
+    def add(self, descriptor):
+        """
+        Adds the next block, and returns the preceding block if it could not
+        be merged with it, or None otherwise.
+        """
+        current = self.current
+        if current is not None and self._mergeable(current, descriptor):
+            gaps = current.gaps
+            gap = descriptor.range_start - current.range_end - 1
+            if gap > 0:
+                gaps += ((current.range_end + 1 - current.range_start, gap),)
+            self.current = BlockDescriptor(
+                current.url, current.header_items, current.range_start,
+                descriptor.range_end, gaps)
+            return None
+        self.current = descriptor
+        return current
+
+    def flush(self):
+        """
+        Returns the last block added, or None if there is none.
+        """
+        current = self.current
+        self.current = None
+        return current
+
+
+def coalesce_blocks(blocks, max_gap, max_size=COALESCE_MAX_SIZE):
+    """
+    Returns a generator of the specified block descriptors with the ranges of
+    consecutive blocks merged by a :class:`.RangeCoalescer`.
+    """
+    coalescer = RangeCoalescer(max_gap, max_size)
+    for descriptor in blocks:
+        merged = coalescer.add(descriptor)
+        if merged is not None:
+            yield merged
+    last = coalescer.flush()
+    if last is not None:
+        yield last
+
+
+class RetryState(object):
+    """
+    The retry state of a single transfer into the specified output. Retrying
+    requires the output to be rewound to its position at the start of the
+    transfer, so retries are disabled if the output does not support tell(),
+    as is the case for stdout. If ``output`` is None, as for ticket requests,
+    there is no data to rewind.
+
+    For HTTP transfers, the data written before an error is kept where
+    possible, and the next attempt requests only the remaining bytes using
+    an HTTP Range request. Engines call :meth:`request_headers` to get the
+    headers for each attempt and :meth:`handle_response` with the status and
+    headers of each response before reading its body.
+    """
+    def __init__(self, output, retry_policy, block=None):
+        self.output = output
+        self.retry_policy = retry_policy
+        # The index of the block in the ticket, if any.
+        self.block = block
+        self.num_retries = 0
+        self.wait = None
+        self.position = None
+        # The number of bytes of the transfer already written to the output.
+        self.offset = 0
+        # The ETag or Last-Modified value of the resource, used to check that
+        # it has not changed when resuming.
+        self.validator = None
+        self.resumable = False
+        # Whether the block requests a byte range of the resource.
+        self.ranged = False
+        # The time at which the current attempt started, and the number of
+        # bytes received in it.
+        self.attempt_start = None
+        self.received = 0
+        if output is None:
+            self.position = 0
+        else:
+            try:
+                self.position = output.tell()
+            except IOError:
+                pass
+
+    def restart(self):
+        """
+        Discards any data written so far, so that the transfer restarts from
+        the beginning.
+        """
+        self.offset = 0
+        if self.output is not None:
+            self.output.seek(self.position)
+            self.output.truncate()
+
+    def request_headers(self, headers):
+        """
+        Returns the headers to send for the next attempt of an HTTP transfer
+        with the specified headers.
+        """
+        self.ranged = get_header(headers, "Range") is not None
+        if self.offset > 0:
+            resumed = resume_headers(headers, self.offset, self.validator)
+            if resumed is not None:
+                return resumed
+            self.restart()
+        return headers
+
+    def handle_response(self, status_code, headers):
+        """
+        Updates the state from the status code and headers of the response to
+        a request made with the headers returned by :meth:`request_headers`.
+        If the server did not honour a request to resume the transfer, the
+        transfer restarts from the beginning. If the block is a byte range of
+        the resource, the full resource returned when it has changed cannot
+        be used, so the transfer restarts and ResourceChangedError is raised
+        to request the original range again.
+        """
+        if self.offset > 0:
+            etag_key = get_header(headers, "ETag")
+            if status_code == 206:
+                if (etag_key is not None and self.validator is not None and
+                        self.validator.startswith('"') and
+                        headers[etag_key] != self.validator):
+                    self.restart()
+                    raise exceptions.ResourceChangedError(
+                        self.validator, headers[etag_key])
+            elif status_code < 300 and self.ranged:
+                new_validator = None if etag_key is None else headers[etag_key]
+                self.restart()
+                raise exceptions.ResourceChangedError(self.validator, new_validator)
+            elif status_code < 300 or status_code == 416:
+                logging.info(
+                    "Server did not resume transfer (status={}); restarting".format(
+                        status_code))
+                self.restart()
+        self.resumable = False
+        accept_ranges_key = get_header(headers, "Accept-Ranges")
+        if accept_ranges_key is not None and headers[accept_ranges_key] == "none":
+            return
+        etag_key = get_header(headers, "ETag")
+        last_modified_key = get_header(headers, "Last-Modified")
+        # Weak ETags cannot be used with If-Range.
+        if etag_key is not None and not headers[etag_key].startswith("W/"):
+            self.validator = headers[etag_key]
+        elif last_modified_key is not None:
+            self.validator = headers[last_modified_key]
+        self.resumable = True
+
+    def handle_error(self, error):
+        """
+        Handles the specified retryable error and returns the number of seconds
+        to wait before the next attempt. If the transfer can be resumed, the
+        data written so far is kept; otherwise, the output is rewound to the
+        start of the transfer. If no more retries are possible, the error is
+        raised.
+        """
+        if self.position is None:
+            raise error
+        sleep_time = self.retry_policy.wait_time(
+            self.num_retries + 1, self.wait, getattr(error, "retry_after", None))
+        if sleep_time is None:
+            raise error
+        self.num_retries += 1
+        self.wait = sleep_time
+        self.received = 0
+        # If the body was longer than the Content-Length, we cannot tell which
+        # of the bytes written so far are valid. A truncated body is fine.
+        resumable = self.resumable and (
+            not isinstance(error, exceptions.ContentLengthMismatch) or
+            isinstance(error, exceptions.TruncatedContentError))
+        if resumable:
+            self.output.flush()
+            self.offset = self.output.tell() - self.position
+        else:
+            self.restart()
+        logging.warning(
+            "Error: '{}' occured; sleeping {}s before retrying "
+            "(attempt={}, offset={})".format(
+                error, sleep_time, self.num_retries, self.offset))
+        return sleep_time
+
+
+class TransferEvent(object):
+    """
+    An event in a transfer, passed to the ``listener`` of a download manager.
+    The ``event_type`` is one of the ``EVENT_*`` constants, and ``time`` is the
+    value of :func:`clock` when the event occurred. Other attributes are None
+    unless they apply to the event:
+
+    - ``block``: the index of the block in the ticket.
+    - ``url``: the URL of the ticket request or block. This is None for
+      blocks encoded as data URIs.
+    - ``size``: the number of bytes received for progress events, or the
+      total number of bytes written for end events.
+    - ``duration``: the time in seconds since the start of the ticket request,
+      block or transfer for end events, or since the start of the attempt
+      for first byte events.
+    - ``attempt``: the number of the attempt, starting from 1, for first byte
+      and retry events.
+    - ``error``: the exception that caused a retry, or that caused the
+      ticket request, block or transfer to fail.
+    - ``wait``: the time in seconds to wait before retrying.
+    - ``transfer``: the index of the region for the transfers made by
+      :func:`htsget.get_regions`, which share a listener.
+
+    Hedge events are sent when a duplicate request is made for a block that
+    has received no data after the delay given by ``duration``.
+    """
+    def __init__(
+            self, event_type, time, block=None, url=None, size=None, duration=None,
+            attempt=None, error=None, wait=None, transfer=None):
+        self.event_type = event_type
+        self.time = time
+        self.block = block
+        self.url = url
+        self.size = size
+        self.duration = duration
+        self.attempt = attempt
+        self.error = error
+        self.wait = wait
+        self.transfer = transfer
+
+    def __repr__(self):
+        attributes = ", ".join(
+            "{}={!r}".format(key, value) for key, value in sorted(self.__dict__.items())
+            if value is not None and key != "event_type")
+        return "TransferEvent({}, {})".format(self.event_type, attributes)
+
+
 class DownloadManager(object):
     """
     Abstract implementation of the protocol.
@@ -85,70 +1127,254 @@ class DownloadManager(object):
             self, url, output, data_format=None, reference_name=None,
             reference_md5=None, start=None, end=None, fields=None, tags=None,
             notags=None, max_retries=5, timeout=10, retry_wait=5, bearer_token=None,
-            headers=None):
+            headers=None, backoff=BACKOFF_EXPONENTIAL, max_retry_wait=60,
+            retry_budget=None, retry_deadline=None, buffer_size=BUFFER_SIZE,
+            listener=None, keep_ticket=False, regions=None, request_class=None):
+        if buffer_size < 1:
+            raise ValueError("buffer_size must be positive")
+        single_region = [reference_name, reference_md5, start, end]
+        if regions is not None and any(value is not None for value in single_region):
+            raise ValueError("regions cannot be combined with a single region")
         self.max_retries = max_retries
         self.timeout = timeout
         self.retry_wait = retry_wait
+        self.retry_policy = RetryPolicy(
+            max_retries=max_retries, retry_wait=retry_wait, backoff=backoff,
+            max_retry_wait=max_retry_wait, retry_budget=retry_budget,
+            retry_deadline=retry_deadline)
         self.bearer_token = bearer_token
         self.headers = headers
+        self.buffer_size = buffer_size
         self.output = output
         self.ticket_request_url = ticket_request_url(
             url, data_format=data_format, reference_name=reference_name,
             reference_md5=reference_md5, start=start, end=end, fields=fields,
-            tags=tags, notags=notags)
+            tags=tags, notags=notags, request_class=request_class)
+        self.request_class = request_class
+        # Tickets for several regions are requested by POST to the original
+        # URL, falling back to GET requests for each region.
+        self.ticket_request_body = None
+        self.ticket_post_url = None
+        self.region_request_urls = []
+        self.post_supported = True
+        if regions is not None:
+            regions = [tuple(region) for region in regions]
+            self.ticket_request_body = ticket_request_body(
+                regions, data_format=data_format, request_class=request_class,
+                fields=fields, tags=tags, notags=notags)
+            self.ticket_post_url = url
+            self.region_request_urls = [
+                ticket_request_url(
+                    url, data_format=data_format, reference_name=reference_name,
+                    start=start, end=end, fields=fields, tags=tags, notags=notags,
+                    request_class=request_class)
+                for reference_name, start, end in regions]
+        # The ticket, without its URL objects unless keep_ticket is True.
         self.ticket = None
+        self.keep_ticket = keep_ticket
+        self.header_cache = {}
         self.data_format = format
         self.md5 = None
+        self.digest = None
+        # True if URL objects for another class of data were left out.
+        self.filtered = False
+        self.listener = listener
+        # The index of the transfer given in events, if the listener is shared.
+        self.transfer = None
 
-    def __retry(self, method, *args):
-        completed = False
-        num_retries = 0
-        position_before = None
+    def _notify(self, event_type, **kwargs):
+        """
+        Passes a :class:`.TransferEvent` of the specified type with the specified
+        attributes to the listener, if any.
+        """
+        if self.listener is not None:
+            self.listener(TransferEvent(
+                event_type, clock(), transfer=self.transfer, **kwargs))
+
+    @contextlib.contextmanager
+    def _notifying(self, start_event, end_event, **kwargs):
+        """
+        Notifies the listener of the specified start event on entry, and of
+        the specified end event with its duration and any error raised on
+        exit. Items added to the yielded dictionary are included in the end
+        event.
+        """
+        start = clock()
+        if start_event is not None:
+            self._notify(start_event, **kwargs)
+        end = dict(kwargs)
         try:
-            # stdout does not support seek/tell, so we disable retry if this fails
-            position_before = self.output.tell()
-        except IOError:
-            pass
-        while not completed:
+            yield end
+        except BaseException as error:
+            end["error"] = error
+            raise
+        finally:
+            self._notify(end_event, duration=clock() - start, **end)
+
+    def _received(self, retry_state, num_bytes):
+        """
+        Records the receipt of the specified number of bytes in the current
+        attempt of the transfer with the specified retry state.
+        """
+        if self.listener is not None:
+            if retry_state.received == 0:
+                self._notify(
+                    EVENT_FIRST_BYTE, block=retry_state.block,
+                    duration=clock() - retry_state.attempt_start,
+                    attempt=retry_state.num_retries + 1)
+            self._notify(EVENT_PROGRESS, block=retry_state.block, size=num_bytes)
+        retry_state.received += num_bytes
+
+    def _retry_state(self, output, block=None):
+        return RetryState(output, self.retry_policy, block)
+
+    def _handle_retry(self, retry_state, error):
+        """
+        Handles the specified error in an attempt of the transfer with the
+        specified retry state, and returns the time to wait before retrying.
+        """
+        wait = retry_state.handle_error(error)
+        self._notify(
+            EVENT_RETRY, block=retry_state.block, attempt=retry_state.num_retries,
+            error=error, wait=wait)
+        return wait
+
+    def _retry(self, retry_state, method, *args):
+        while True:
+            retry_state.attempt_start = clock()
             try:
-                method(*args)
-                completed = True
+                return method(*args)
             except exceptions.RetryableError as re:
-                if position_before is not None and num_retries < self.max_retries:
-                    num_retries += 1
-                    sleep_time = self.retry_wait  # TODO exponential backoff
-                    logging.warning(
-                        "Error: '{}' occured; sleeping {}s before retrying "
-                        "(attempt={})".format(re, sleep_time, num_retries))
-                    self.output.seek(position_before)
-                    time.sleep(sleep_time)
-                else:
-                    raise re
+                time.sleep(self._handle_retry(retry_state, re))
+
+    def _ticket_request_headers(self):
+        """
+        Returns the headers to send with the ticket request.
+        """
+        headers = self.headers if self.headers else {}
+        if self.bearer_token is not None and "Authorization" in headers:
+            logging.warning("Both the bearer_token and Authorization header have values,"
+                            "the bearer_token will take precedence")
+        if self.bearer_token is not None:
+            headers["Authorization"] = "Bearer {}".format(self.bearer_token)
+        return headers
+
+    def _process_ticket(self):
+        """
+        Updates the state of the manager from the newly retrieved ticket.
+        """
+        self.data_format = self.ticket.get("format", "BAM")
+        self.md5 = self.ticket.get("md5", None)
+
+    def _check_digest(self, output):
+        """
+        Stores the digest computed by the specified :class:`.DigestOutput` and
+        checks it against the MD5 given in the ticket, if any.
+        """
+        self.digest = output.hexdigest()
+        if self.md5 is None:
+            return
+        if self.filtered:
+            # The MD5 is of all the data in the ticket, not the class requested.
+            logging.info("Not verifying the MD5 of a subset of the ticket")
+            return
+        if self.digest is None:
+            logging.warning("Cannot verify the MD5 of data written to a rewound output")
+        elif self.digest != self.md5.lower():
+            raise exceptions.MD5MismatchError(self.md5, self.digest)
 
     def _ticket_request(self):
         raise NotImplementedError()
 
-    def _handle_data_uri(self, parsed_url):
-        split = parsed_url.path.split(",", 1)
-        # TODO parse out the encoding properly.
-        description = split[0]
-        data = base64.b64decode(split[1])
-        logging.debug("handle_data_uri({}, length={})".format(description, len(data)))
-        self.output.write(data)
+    def _read_ticket(self, consume=None):
+        """
+        Requests the ticket, retrying as necessary. If specified, the consume
+        function is called with each new URL object in the ticket as it is
+        received.
+        """
+        retry_state = self._retry_state(None)
+        url_objects = []
+        with self._notifying(
+                EVENT_TICKET_START, EVENT_TICKET_END, url=self.ticket_request_url):
+            if consume is None:
+                self._retry(retry_state, self._handle_ticket_request)
+            else:
+                stream = TicketStream()
+
+                def consume_new(url_object):
+                    if stream.is_new(url_object):
+                        if self.keep_ticket:
+                            url_objects.append(url_object)
+                        consume(url_object)
+
+                def attempt():
+                    stream.start_attempt()
+                    self._handle_ticket_request(consume_new)
+                    stream.end_attempt()
+
+                self._retry(retry_state, attempt)
+                if self.keep_ticket:
+                    self.ticket["urls"] = url_objects
+        self._process_ticket()
 
-    def _handle_http_url(url, headers):
+    def _selects(self, url_object):
+        """
+        Returns False if the specified URL object is for a different class of
+        data from the one requested, as when the server ignores the class
+        parameter but labels the blocks in the ticket.
+        """
+        if self.request_class is None or not isinstance(url_object, dict):
+            return True
+        if url_object.get("class", self.request_class) != self.request_class:
+            self.filtered = True
+            return False
+        return True
+
+    def _describe(self, url_object):
+        """
+        Returns the :class:`.BlockDescriptor` for the specified URL object.
+        """
+        return BlockDescriptor.parse(url_object, self.header_cache)
+
+    def _handle_data_uri(self, parsed_url, output):
+        data_uri = DataUri(parsed_url.geturl())
+        size = 0
+        for piece in data_uri.pieces(self.buffer_size):
+            output.write(piece)
+            size += len(piece)
+        logging.debug("handle_data_uri({}, length={})".format(data_uri.media_type, size))
+        return size
+
+    def _handle_http_url(self, url, headers, output, retry_state):
         raise NotImplementedError()
 
+    def _block_output(self, descriptor, output):
+        """
+        Returns the output to which the response for the specified block
+        descriptor is written.
+        """
+        return output
+
+    def _handle_url(self, descriptor, output, block=None):
+        url = urlparse(descriptor.url)
+        if url.scheme.startswith("http"):
+            headers = descriptor.headers
+            output = self._block_output(descriptor, output)
+            retry_state = self._retry_state(output, block)
+            with self._notifying(
+                    EVENT_BLOCK_START, EVENT_BLOCK_END, block=block,
+                    url=descriptor.url) as end:
+                self._retry(
+                    retry_state, self._handle_http_url, urlunparse(url), headers,
+                    output, retry_state)
+                end["size"] = retry_state.offset + retry_state.received
+                end["attempt"] = retry_state.num_retries + 1
+        elif url.scheme == "data":
+            with self._notifying(EVENT_BLOCK_START, EVENT_BLOCK_END, block=block) as end:
+                end["size"] = self._handle_data_uri(url, output)
+                end["attempt"] = 1
+        else:
+            raise ValueError("Unsupported URL scheme:{}".format(url.scheme))
+
     def run(self):
-        self.__retry(self._handle_ticket_request)
-        self.data_format = self.ticket.get("format", "BAM")
-        self.md5 = self.ticket.get("md5", None)
-        for url_object in self.ticket["urls"]:
-            url = urlparse(url_object["url"])
-            if url.scheme.startswith("http"):
-                headers = url_object.get("headers", "")
-                self.__retry(self._handle_http_url, urlunparse(url), headers)
-            elif url.scheme == "data":
-                self._handle_data_uri(url)
-            else:
-                raise ValueError("Unsupported URL scheme:{}".format(url.scheme))
+        raise NotImplementedError()
@@ -0,0 +1,225 @@
+#
+# Copyright 2016-2017 University of Oxford
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Statistics about htsget transfers, collected from transfer events.
+"""
+from __future__ import division
+from __future__ import print_function
+
+import sys
+import threading
+
+from six.moves.urllib.parse import urlparse
+
+import htsget.protocol as protocol
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows.
+    resource = None
+
+PERCENTILES = [50, 90, 99]
+
+
+def percentile(values, p):
+    """
+    Returns the specified percentile of the specified sorted values using the
+    nearest rank method, or None if there are no values.
+    """
+    if len(values) == 0:
+        return None
+    rank = max(1, int(-(-p * len(values) // 100)))
+    return values[rank - 1]
+
+
+def throughput(size, duration):
+    """
+    Returns the throughput in MiB/s for the specified number of bytes
+    transferred in the specified number of seconds.
+    """
+    if size is None or not duration:
+        return None
+    return size / 2**20 / duration
+
+
+def peak_rss():
+    """
+    Returns the peak resident set size of this process in KiB, or None if
+    this is not available.
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        # Reported in bytes on macOS and kilobytes elsewhere.
+        peak //= 1024
+    return peak
+
+
+def block_order(key):
+    """
+    Returns the sort key for the (transfer, block) key of a block, where the
+    transfer may be None.
+    """
+    transfer, block = key
+    return -1 if transfer is None else transfer, block
+
+
+def error_string(error):
+    return None if error is None else "{}: {}".format(type(error).__name__, error)
+
+
+class BlockStats(object):
+    """
+    Statistics for a single block in a transfer.
+    """
+    def __init__(self, transfer, block, url, start_time):
+        self.transfer = transfer
+        self.block = block
+        # Only the host is kept, as URLs may contain credentials.
+        self.host = None if url is None else urlparse(url).netloc
+        self.start_time = start_time
+        self.first_byte_time = None
+        self.size = None
+        self.duration = None
+        self.retry_errors = []
+        self.error = None
+        self.hedged = False
+
+    def to_dict(self):
+        time_to_first_byte = None
+        if self.first_byte_time is not None:
+            time_to_first_byte = self.first_byte_time - self.start_time
+        return {
+            "transfer": self.transfer, "block": self.block, "host": self.host,
+            "size": self.size,
+            "duration": self.duration,
+            "throughput_mib_s": throughput(self.size, self.duration),
+            "time_to_first_byte": time_to_first_byte,
+            "retries": len(self.retry_errors), "retry_errors": self.retry_errors,
+            "hedged": self.hedged, "error": self.error}
+
+
+class TransferStats(object):
+    """
+    Collects statistics about a transfer from the events passed to it, for
+    use as the ``listener`` argument to :func:`htsget.get`. Events may be
+    passed concurrently from multiple threads. The statistics are returned
+    by :meth:`summary`. When used for the several transfers made by
+    :func:`htsget.get_regions`, the statistics are combined over them.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start_time = None
+        self.first_byte_time = None
+        self.ticket_duration = None
+        self.ticket_retry_errors = []
+        self.ticket_error = None
+        self.blocks = {}
+        # The (size, start time, end time, error) of each transfer ended.
+        self.transfers = {}
+
+    def __call__(self, event):
+        with self.lock:
+            self.handle_event(event)
+
+    def handle_event(self, event):
+        if self.start_time is None:
+            self.start_time = event.time
+        key = event.transfer, event.block
+        if event.event_type == protocol.EVENT_TICKET_END:
+            # The tickets of several transfers are requested concurrently.
+            self.ticket_duration = max(self.ticket_duration or 0, event.duration)
+            if self.ticket_error is None:
+                self.ticket_error = error_string(event.error)
+        elif event.event_type == protocol.EVENT_BLOCK_START:
+            # Hedged requests for a block start it again.
+            if key not in self.blocks:
+                self.blocks[key] = BlockStats(
+                    event.transfer, event.block, event.url, event.time)
+        elif event.event_type == protocol.EVENT_FIRST_BYTE:
+            block = self.blocks[key]
+            if block.first_byte_time is None:
+                block.first_byte_time = event.time
+            if self.first_byte_time is None:
+                self.first_byte_time = event.time
+        elif event.event_type == protocol.EVENT_RETRY:
+            if event.block is None:
+                self.ticket_retry_errors.append(error_string(event.error))
+            else:
+                self.blocks[key].retry_errors.append(error_string(event.error))
+        elif event.event_type == protocol.EVENT_HEDGE:
+            self.blocks[key].hedged = True
+        elif event.event_type == protocol.EVENT_BLOCK_END:
+            block = self.blocks[key]
+            if block.duration is not None and block.error is None:
+                # The block was completed by another hedged request.
+                return
+            block.size = event.size
+            block.duration = event.duration
+            block.error = error_string(event.error)
+        elif event.event_type == protocol.EVENT_TRANSFER_END:
+            self.transfers[event.transfer] = (
+                event.size, event.time - event.duration, event.time,
+                error_string(event.error))
+
+    def summary(self):
+        """
+        Returns a dictionary summarising the transfer, suitable for encoding as
+        JSON. All times are in seconds.
+        """
+        with self.lock:
+            blocks = [
+                self.blocks[key].to_dict()
+                for key in sorted(self.blocks.keys(), key=block_order)]
+            durations = sorted(
+                block["duration"] for block in blocks if block["duration"] is not None)
+            time_to_first_byte = None
+            if self.first_byte_time is not None:
+                time_to_first_byte = self.first_byte_time - self.start_time
+            percentiles = {
+                "p{}".format(p): percentile(durations, p) for p in PERCENTILES}
+            percentiles["max"] = durations[-1] if len(durations) > 0 else None
+            transfers = list(self.transfers.values())
+            size = duration = error = None
+            if len(transfers) > 0:
+                sizes = [transfer[0] for transfer in transfers]
+                if None not in sizes:
+                    size = sum(sizes)
+                duration = (
+                    max(transfer[2] for transfer in transfers) -
+                    min(transfer[1] for transfer in transfers))
+                errors = [transfer[3] for transfer in transfers if transfer[3]]
+                error = errors[0] if len(errors) > 0 else None
+            return {
+                "ticket": {
+                    "duration": self.ticket_duration,
+                    "retries": len(self.ticket_retry_errors),
+                    "retry_errors": self.ticket_retry_errors,
+                    "error": self.ticket_error},
+                "blocks": blocks,
+                "num_blocks": len(blocks),
+                "total_bytes": size,
+                "wall_time": duration,
+                "throughput_mib_s": throughput(size, duration),
+                "time_to_first_byte": time_to_first_byte,
+                "block_duration_percentiles": percentiles,
+                "retries": sum(block["retries"] for block in blocks) + len(
+                    self.ticket_retry_errors),
+                "hedged_blocks": sum(block["hedged"] for block in blocks),
+                "peak_rss_kib": peak_rss(),
+                "error": error}
@@ -0,0 +1,971 @@
+#
+# Copyright 2016-2017 University of Oxford
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Scheduling of the blocks of htsget transfers, and the file-like wrappers
+through which their data is written to the output.
+"""
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import concurrent.futures
+import functools
+import hashlib
+import logging
+import os
+import shutil
+import stat
+import tempfile
+import threading
+
+import six
+from six.moves import queue
+from six.moves.urllib.parse import urlparse
+
+import htsget.protocol as protocol
+import htsget.exceptions as exceptions
+
+# When downloading blocks in parallel, blocks are buffered until they can be
+# written to the output in ticket order. Blocks larger than this many bytes are
+# spooled to a temporary file rather than kept in memory.
+SPOOL_MAX_SIZE = 16 * 2**20
+
+# The maximum number of URL objects from a ticket that is still being received
+# that are queued for download.
+TICKET_QUEUE_SIZE = 1024
+
+# The number of first byte latencies of earlier blocks needed before requests
+# are hedged, and the maximum number used to choose the hedging delay.
+HEDGE_MIN_SAMPLES = 5
+HEDGE_MAX_SAMPLES = 1000
+
+
+def preallocate(fd, offset, length):
+    """
+    Allocates the specified region of the file with the specified descriptor,
+    using posix_fallocate if the platform and file system support it, and
+    otherwise extending the file to the end of the region.
+    """
+    if length == 0:
+        return
+    if hasattr(os, "posix_fallocate"):
+        try:
+            os.posix_fallocate(fd, offset, length)
+            return
+        except OSError:
+            # Not supported by this file system.
+            pass
+    if os.fstat(fd).st_size < offset + length:
+        os.ftruncate(fd, offset + length)
+
+
+def file_md5(fd, offset, length, buffer_size=protocol.BUFFER_SIZE):
+    """
+    Returns a hashlib object for the MD5 digest of the specified region of the
+    file with the specified descriptor.
+    """
+    md5 = hashlib.md5()
+    end = offset + length
+    while offset < end:
+        data = os.pread(fd, min(buffer_size, end - offset), offset)
+        if len(data) == 0:
+            break
+        md5.update(data)
+        offset += len(data)
+    return md5
+
+
+class HedgePolicy(object):
+    """
+    Decides when to make a duplicate request for a block that is slow to
+    start, from the first byte latencies of earlier blocks in the transfer.
+    The delay before hedging is the specified percentile of the latencies
+    recorded so far, or None if fewer than ``min_samples`` are recorded.
+    """
+    def __init__(self, percentile, min_samples=HEDGE_MIN_SAMPLES):
+        if not 0 < percentile <= 100:
+            raise ValueError("percentile must be in (0, 100]")
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.latencies = collections.deque(maxlen=HEDGE_MAX_SAMPLES)
+        self.lock = threading.Lock()
+
+    def record(self, latency):
+        """
+        Records the first byte latency of an attempt to download a block.
+        """
+        with self.lock:
+            self.latencies.append(latency)
+
+    def delay(self):
+        """
+        Returns the time in seconds to wait for the first byte of a block
+        before hedging, or None if requests should not be hedged yet.
+        """
+        with self.lock:
+            latencies = sorted(self.latencies)
+        if len(latencies) < max(1, self.min_samples):
+            return None
+        rank = max(1, int(-(-self.percentile * len(latencies) // 100)))
+        return latencies[rank - 1]
+
+
+class _Abandoned(Exception):
+    """
+    Raised when writing to a hedged attempt that has been abandoned.
+    """
+
+
+class _HedgedAttempt(object):
+    """
+    An attempt to download a block into a new spooled buffer on a separate
+    thread, which puts a tuple of itself and the error raised, if any, on the
+    specified queue when it finishes. The ``started`` event is set when the
+    first data is received or the attempt finishes. The buffer is closed if
+    the attempt fails or is abandoned.
+    """
+    def __init__(self, manager, block, descriptor, results):
+        self.buf = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+        self.started = threading.Event()
+        self.lock = threading.Lock()
+        self.abandoned = False
+        self.finished = False
+        thread = threading.Thread(
+            target=self._run, args=(manager, block, descriptor, results))
+        thread.daemon = True
+        thread.start()
+
+    def _run(self, manager, block, descriptor, results):
+        error = None
+        try:
+            manager._handle_url(descriptor, self, block)
+        except Exception as e:
+            error = e
+        with self.lock:
+            self.finished = True
+            if error is not None or self.abandoned:
+                self.buf.close()
+        self.started.set()
+        results.put((self, error))
+
+    def abandon(self):
+        """
+        Stops the attempt at its next write and discards its data.
+        """
+        with self.lock:
+            self.abandoned = True
+            if self.finished:
+                self.buf.close()
+
+    def write(self, data):
+        if self.abandoned:
+            raise _Abandoned()
+        self.started.set()
+        return self.buf.write(data)
+
+    def tell(self):
+        return self.buf.tell()
+
+    def seek(self, offset, whence=0):
+        return self.buf.seek(offset, whence)
+
+    def truncate(self, size=None):
+        if size is None:
+            return self.buf.truncate()
+        return self.buf.truncate(size)
+
+    def flush(self):
+        self.buf.flush()
+
+
+class _SharedBlock(object):
+    """
+    The state of a block shared by several transfers in :class:`.SharedBlocks`.
+    """
+    def __init__(self):
+        self.ready = threading.Event()
+        self.lock = threading.Lock()
+        self.buf = None
+        self.error = None
+
+
+class SharedBlocks(object):
+    """
+    Downloads each block needed by several transfers only once, fanning out
+    its data to all of their outputs. Blocks are identical if they have the
+    same URL, headers and byte ranges. The uses of each block are counted
+    from the descriptors of all the blocks of the transfers, and the data of
+    a shared block is kept in a spooled buffer until it has been written for
+    every use, or :meth:`close` is called.
+    """
+    def __init__(self, descriptors):
+        self.lock = threading.Lock()
+        self.uses = collections.Counter()
+        self.entries = {}
+        self.num_downloads = 0
+        for descriptor in descriptors:
+            key = self.key(descriptor)
+            if key is not None:
+                self.uses[key] += 1
+
+    @staticmethod
+    def key(descriptor):
+        """
+        Returns the key identifying the data of the specified block, or None
+        if it cannot be shared.
+        """
+        key = (
+            descriptor.url, descriptor.header_items, descriptor.range_start,
+            descriptor.range_end, descriptor.gaps)
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    def write(self, descriptor, download, output):
+        """
+        Writes the data of the specified block to the output. The data is
+        downloaded by calling ``download``, which returns a spooled buffer
+        positioned at its end, unless another transfer has already done so.
+        """
+        key = self.key(descriptor)
+        with self.lock:
+            entry = self.entries.get(key)
+            shared = entry is not None or (key is not None and self.uses[key] > 1)
+            owner = entry is None
+            if owner:
+                self.num_downloads += 1
+                if shared:
+                    entry = self.entries[key] = _SharedBlock()
+        if not shared:
+            buf = download()
+            with buf:
+                buf.seek(0)
+                shutil.copyfileobj(buf, output)
+            return
+        if owner:
+            try:
+                entry.buf = download()
+            except Exception as error:
+                entry.error = error
+            finally:
+                entry.ready.set()
+        else:
+            entry.ready.wait()
+        try:
+            if entry.error is not None:
+                raise entry.error
+            with entry.lock:
+                entry.buf.seek(0)
+                shutil.copyfileobj(entry.buf, output)
+        finally:
+            with self.lock:
+                self.uses[key] -= 1
+                if self.uses[key] == 0:
+                    del self.entries[key]
+                    if entry.buf is not None:
+                        entry.buf.close()
+
+    def close(self):
+        """
+        Discards the data of the blocks that have not been written for every
+        use, as when some of the transfers failed.
+        """
+        with self.lock:
+            for entry in self.entries.values():
+                if entry.buf is not None:
+                    entry.buf.close()
+            self.entries.clear()
+
+
+class _TransferStopped(Exception):
+    """
+    Raised in the thread streaming a ticket when the transfer has stopped.
+    """
+
+
+class WriteBehindOutput(object):
+    """
+    A wrapper around an output file that writes the data written through it
+    on a separate thread, so that slow writes to the output do not stall the
+    reception of data from the network. At most ``max_size`` bytes are queued
+    for writing, beyond which calls to :meth:`write` wait for the queue to
+    drain; a single larger piece is still accepted when the queue is empty.
+    Seeking, truncating and flushing wait for the queued data to be written.
+    An error raised by the output is raised by the next call to any of these
+    methods, and the data queued after it is discarded.
+    """
+    def __init__(self, output, max_size):
+        if max_size < 1:
+            raise ValueError("max_size must be positive")
+        self.output = output
+        self.max_size = max_size
+        self.condition = threading.Condition()
+        self.pieces = collections.deque()
+        self.queued = 0
+        self.error = None
+        self.closed = False
+        try:
+            self.position = output.tell()
+        except IOError:
+            self.position = None
+        self.thread = threading.Thread(target=self._write_pieces)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _write_pieces(self):
+        while True:
+            with self.condition:
+                while len(self.pieces) == 0 and not self.closed:
+                    self.condition.wait()
+                if len(self.pieces) == 0:
+                    return
+                piece = self.pieces[0]
+                error = self.error
+            if error is None:
+                try:
+                    self.output.write(piece)
+                except Exception as e:
+                    error = e
+            with self.condition:
+                self.pieces.popleft()
+                self.queued -= len(piece)
+                self.error = error
+                self.condition.notify_all()
+
+    def _check_error(self):
+        if self.error is not None:
+            raise self.error
+
+    def drain(self):
+        """
+        Waits until all of the queued data has been written to the output.
+        """
+        with self.condition:
+            while len(self.pieces) > 0:
+                self.condition.wait()
+            self._check_error()
+
+    def write(self, data):
+        if isinstance(data, (bytearray, memoryview)):
+            # The caller may reuse the buffer once this returns.
+            data = bytes(data)
+        with self.condition:
+            if self.closed:
+                raise ValueError("write to closed output")
+            self._check_error()
+            while self.queued > 0 and self.queued + len(data) > self.max_size:
+                self.condition.wait()
+                self._check_error()
+            self.pieces.append(data)
+            self.queued += len(data)
+            self.condition.notify_all()
+        if self.position is not None:
+            self.position += len(data)
+
+    def tell(self):
+        if self.position is None:
+            self.drain()
+            return self.output.tell()
+        return self.position
+
+    def seek(self, offset, whence=0):
+        self.drain()
+        self.position = self.output.seek(offset, whence)
+        if self.position is None:
+            self.position = self.output.tell()
+        return self.position
+
+    def truncate(self, size=None):
+        self.drain()
+        if size is None:
+            return self.output.truncate()
+        return self.output.truncate(size)
+
+    def flush(self):
+        self.drain()
+        self.output.flush()
+
+    def close(self, raise_error=True):
+        """
+        Writes the remaining queued data and stops the writing thread. The
+        wrapped output is not closed. Any error raised by the output is only
+        raised if ``raise_error`` is True, so that it does not replace an
+        exception already being handled.
+        """
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.thread.join()
+        if raise_error:
+            self._check_error()
+
+
+class GapSkippingOutput(object):
+    """
+    A wrapper around an output that discards the bytes written through it in
+    the specified gaps, which are (start, length) tuples in increasing order
+    giving positions relative to the position of the output when the wrapper
+    is created. Positions returned by tell() and passed to seek() include the
+    gaps, so that transfers can be resumed and rewound as usual.
+    """
+    def __init__(self, output, gaps):
+        self.output = output
+        self.gaps = gaps
+        self.position = 0
+        try:
+            self.start = output.tell()
+        except IOError:
+            self.start = None
+
+    def _kept(self, position):
+        """
+        Returns the number of bytes before the specified position that are not
+        in gaps.
+        """
+        kept = position
+        for start, length in self.gaps:
+            if start >= position:
+                break
+            kept -= min(length, position - start)
+        return kept
+
+    def write(self, data):
+        view = memoryview(data)
+        end = self.position + len(view)
+        offset = self.position
+        for start, length in self.gaps:
+            if start >= end:
+                break
+            if start + length <= offset:
+                continue
+            if start > offset:
+                self.output.write(view[offset - self.position: start - self.position])
+            offset = start + length
+        if offset < end:
+            self.output.write(view[offset - self.position:])
+        self.position = end
+
+    def tell(self):
+        if self.start is None:
+            raise IOError("Output is not seekable")
+        return self.start + self.position
+
+    def seek(self, position, whence=0):
+        if whence != 0:
+            raise ValueError("Only absolute positions are supported")
+        self.position = position - self.start
+        self.output.seek(self.start + self._kept(self.position))
+        return position
+
+    def truncate(self, size=None):
+        if size is None:
+            return self.output.truncate()
+        return self.output.truncate(size)
+
+    def flush(self):
+        self.output.flush()
+
+
+class PositionalOutput(object):
+    """
+    A file-like view of the region of ``size`` bytes starting at ``offset``
+    in the file with the specified descriptor. Data is written using
+    os.pwrite, so that blocks can be written to their regions of the file
+    concurrently. Writing beyond the end of the region raises
+    :class:`.ContentLengthMismatch`. Truncating has no effect, as rewound data
+    is overwritten when the transfer is retried.
+    """
+    def __init__(self, fd, offset, size):
+        self.fd = fd
+        self.offset = offset
+        self.size = size
+        self.position = 0
+
+    def write(self, data):
+        if self.position + len(data) > self.size:
+            raise exceptions.ContentLengthMismatch(
+                "Block is longer than its expected size of {} bytes".format(self.size))
+        view = memoryview(data)
+        while len(view) > 0:
+            num_bytes = os.pwrite(self.fd, view, self.offset + self.position)
+            view = view[num_bytes:]
+            self.position += num_bytes
+
+    def tell(self):
+        return self.position
+
+    def seek(self, position, whence=0):
+        if whence != 0:
+            raise ValueError("Only absolute positions are supported")
+        self.position = position
+        return position
+
+    def truncate(self, size=None):
+        pass
+
+    def flush(self):
+        pass
+
+
+class DigestOutput(object):
+    """
+    A wrapper around an output file that computes the MD5 digest of the data
+    written through it. Transfers that fail are rewound to the position at
+    which they started, so the state of the digest is saved at each call to
+    :meth:`checkpoint` and restored when the output is rewound to this
+    position. Data kept when a transfer is resumed is already included in the
+    digest. If the output is rewound to any other position, the digest can
+    no longer be computed and :meth:`hexdigest` returns None. The number of
+    bytes written and not discarded by rewinding is stored in ``size``.
+    """
+    def __init__(self, output):
+        self.output = output
+        self.md5 = hashlib.md5()
+        self.size = 0
+        self.position = None
+        self.checkpoint_md5 = None
+        self.checkpoint_position = None
+
+    def checkpoint(self):
+        """
+        Saves the current state of the digest, which is restored if the output
+        is rewound to its current position.
+        """
+        try:
+            self.position = self.output.tell()
+        except IOError:
+            # The output cannot be rewound.
+            self.position = None
+            return
+        self.checkpoint_position = self.position
+        self.checkpoint_md5 = None if self.md5 is None else self.md5.copy()
+
+    def write(self, data):
+        if isinstance(data, six.text_type):
+            # The digest is only defined for binary outputs.
+            self.md5 = None
+        elif self.md5 is not None:
+            self.md5.update(data)
+        self.size += len(data)
+        if self.position is not None:
+            self.position += len(data)
+        return self.output.write(data)
+
+    def seek(self, offset, whence=0):
+        self.output.seek(offset, whence)
+        position = self.output.tell()
+        if position == self.checkpoint_position and self.checkpoint_md5 is not None:
+            self.md5 = self.checkpoint_md5.copy()
+        elif position != self.position:
+            self.md5 = None
+        if self.position is not None:
+            self.size -= self.position - position
+        self.position = position
+
+    def tell(self):
+        return self.output.tell()
+
+    def truncate(self, size=None):
+        if size is None:
+            return self.output.truncate()
+        return self.output.truncate(size)
+
+    def flush(self):
+        self.output.flush()
+
+    def advance(self, size, md5=None):
+        """
+        Records that the specified number of bytes have been written directly
+        to the wrapped output at its current position, and moves past them.
+        The digest is replaced by the specified hashlib object, and is no
+        longer computed if this is None.
+        """
+        self.output.seek(self.output.tell() + size)
+        self.md5 = md5
+        self.size += size
+        if self.position is not None:
+            self.position += size
+
+    def hexdigest(self):
+        return None if self.md5 is None else self.md5.hexdigest()
+
+
+class TransferManager(protocol.DownloadManager):
+    """
+    Download manager which schedules the blocks of the ticket, downloading
+    them in parallel, hedging slow requests, and writing them to the output
+    in order or directly at their offsets in it.
+    """
+
+    def __init__(
+            self, url, output, parallelism=1, write_behind=None, preallocate=False,
+            coalesce_gap=None, hedge_percentile=None, **kwargs):
+        super(TransferManager, self).__init__(url, output, **kwargs)
+        self.parallelism = parallelism
+        self.write_behind = write_behind
+        self.preallocate = preallocate
+        self.coalesce_gap = coalesce_gap
+        self.hedge_policy = None
+        if hedge_percentile is not None:
+            self.hedge_policy = HedgePolicy(hedge_percentile)
+
+    def _received(self, retry_state, num_bytes):
+        if retry_state.received == 0 and self.hedge_policy is not None:
+            self.hedge_policy.record(protocol.clock() - retry_state.attempt_start)
+        super(TransferManager, self)._received(retry_state, num_bytes)
+
+    def _streams_ticket(self):
+        """
+        Returns True if blocks should be downloaded while the ticket is being
+        received. Engines supporting this accept a function as the argument to
+        :meth:`_handle_ticket_request`, which is called with each URL object
+        as it is decoded, and omit the URL objects from the stored ticket.
+        """
+        return False
+
+    def _ticket_blocks(self):
+        """
+        Returns a generator of the descriptors of the blocks in the ticket. If
+        the engine streams tickets, the ticket is read on another thread and
+        the blocks are generated as they are received.
+        """
+        if not self._streams_ticket():
+            self._read_ticket()
+            url_objects = self.ticket["urls"]
+            if not self.keep_ticket:
+                self.ticket = {
+                    key: value for key, value in self.ticket.items() if key != "urls"}
+            blocks = [
+                self._describe(url_object) for url_object in url_objects
+                if self._selects(url_object)]
+            del url_objects
+            for descriptor in blocks:
+                yield descriptor
+            return
+        url_queue = queue.Queue(TICKET_QUEUE_SIZE)
+        stopped = threading.Event()
+
+        def put(item):
+            while not stopped.is_set():
+                try:
+                    url_queue.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    pass
+            raise _TransferStopped()
+
+        def consume(url_object):
+            if self._selects(url_object):
+                put((self._describe(url_object), None))
+
+        def target():
+            try:
+                try:
+                    self._read_ticket(consume)
+                except Exception as error:
+                    put((None, error))
+                else:
+                    put((None, None))
+            except _TransferStopped:
+                pass
+
+        thread = threading.Thread(target=target)
+        thread.daemon = True
+        thread.start()
+        try:
+            while True:
+                descriptor, error = url_queue.get()
+                if error is not None:
+                    raise error
+                if descriptor is None:
+                    break
+                yield descriptor
+        finally:
+            stopped.set()
+
+    def _data_uri_size(self, parsed_url):
+        return protocol.DataUri(parsed_url.geturl()).size(self.buffer_size)
+
+    def _head_size(self, url, headers):
+        """
+        Returns the size of the resource at the specified HTTP URL reported by
+        the server in response to a HEAD request with the specified headers,
+        or None if it is unknown.
+        """
+        return None
+
+    def _block_size(self, descriptor):
+        """
+        Returns the size of the data for the specified block descriptor, or
+        None if it cannot be determined before downloading it.
+        """
+        url = urlparse(descriptor.url)
+        if url.scheme == "data":
+            return self._data_uri_size(url)
+        if descriptor.range_end is not None:
+            size = descriptor.range_end - descriptor.range_start + 1
+            return size - sum(length for _, length in descriptor.gaps)
+        if url.scheme.startswith("http"):
+            size = self._head_size(descriptor.url, dict(descriptor.header_items))
+            if size is not None and descriptor.range_start is not None:
+                size = max(0, size - descriptor.range_start)
+            return size
+        return None
+
+    def _block_output(self, descriptor, output):
+        """
+        Returns the output to which the response for the specified block
+        descriptor is written, discarding the bytes in its gaps, if any.
+        """
+        if len(descriptor.gaps) == 0:
+            return output
+        return GapSkippingOutput(output, descriptor.gaps)
+
+    def _download_hedged(self, block, descriptor):
+        """
+        Downloads the specified block into a new spooled buffer, making a
+        duplicate request if no data is received within the delay given by
+        the hedge policy, and returns the buffer of the first request to
+        complete successfully.
+        """
+        results = queue.Queue()
+        attempts = [_HedgedAttempt(self, block, descriptor, results)]
+        delay = self.hedge_policy.delay()
+        if delay is not None and not attempts[0].started.wait(delay):
+            logging.info("No data for block {} after {:.3f}s; hedging".format(
+                block, delay))
+            self._notify(
+                protocol.EVENT_HEDGE, block=block, url=descriptor.url, duration=delay)
+            attempts.append(_HedgedAttempt(self, block, descriptor, results))
+        error = None
+        for _ in attempts:
+            attempt, error = results.get()
+            if error is None:
+                for other in attempts:
+                    if other is not attempt:
+                        other.abandon()
+                return attempt.buf
+        raise error
+
+    def _download_block(self, block, descriptor):
+        """
+        Downloads the specified block descriptor, the block with the specified
+        index in the ticket, into a new spooled buffer, which is returned
+        positioned at the end of the data.
+        """
+        if (self.hedge_policy is not None and
+                urlparse(descriptor.url).scheme.startswith("http")):
+            return self._download_hedged(block, descriptor)
+        buf = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+        try:
+            self._handle_url(descriptor, buf, block)
+        except Exception:
+            buf.close()
+            raise
+        return buf
+
+    def _write_block(self, buf, output):
+        """
+        Writes the block downloaded into the specified buffer by
+        :meth:`_download_block` to the output, and closes the buffer.
+        """
+        with buf:
+            buf.seek(0)
+            shutil.copyfileobj(buf, output)
+
+    def _run_parallel(self, output, blocks):
+        """
+        Downloads the blocks for the specified descriptors using a pool of
+        worker threads, and writes them to the specified output in order. Each
+        block is retried independently of the others. To bound the amount of
+        buffered data, at most twice the number of workers blocks are in flight
+        at any time.
+        """
+        blocks = enumerate(blocks)
+        pending = collections.deque()
+        with concurrent.futures.ThreadPoolExecutor(self.parallelism) as executor:
+            try:
+                for block, descriptor in blocks:
+                    pending.append(
+                        executor.submit(self._download_block, block, descriptor))
+                    if len(pending) == 2 * self.parallelism:
+                        break
+                while len(pending) > 0:
+                    buf = pending.popleft().result()
+                    item = next(blocks, None)
+                    if item is not None:
+                        pending.append(executor.submit(self._download_block, *item))
+                    self._write_block(buf, output)
+            finally:
+                for future in pending:
+                    future.cancel()
+
+    def _positional_fd(self):
+        """
+        Returns the file descriptor of the output if blocks can be written
+        directly at their offsets in it, or None otherwise.
+        """
+        if not hasattr(os, "pwrite"):
+            return None
+        try:
+            fd = self.output.fileno()
+            if not stat.S_ISREG(os.fstat(fd).st_mode):
+                return None
+            self.output.tell()
+        except (AttributeError, IOError, OSError, ValueError):
+            return None
+        return fd
+
+    def _write_positional(self, fd, block, descriptor, offset, size):
+        """
+        Downloads the specified block into the region of the specified size
+        at the specified offset in the file with the specified descriptor.
+        """
+        block_output = PositionalOutput(fd, offset, size)
+        self._handle_url(descriptor, block_output, block)
+        if block_output.position != size:
+            raise exceptions.ContentLengthMismatch(
+                "Block {} has size {} rather than the expected {} bytes".format(
+                    block, block_output.position, size))
+
+    def _run_positional(self, output, descriptors, fd):
+        """
+        Downloads the specified blocks using a pool of worker threads which
+        write each block directly at its offset in the output, after
+        preallocating the space for all of them. Returns False without writing
+        anything if the size of any block cannot be determined.
+        """
+        with concurrent.futures.ThreadPoolExecutor(self.parallelism) as executor:
+            sizes = list(executor.map(self._block_size, descriptors))
+            if None in sizes:
+                logging.info("Sizes of blocks unknown; writing blocks in order")
+                return False
+            output.flush()
+            start = output.tell()
+            preallocate(fd, start, sum(sizes))
+            offset = start
+            pending = collections.deque()
+            try:
+                for block, (descriptor, size) in enumerate(zip(descriptors, sizes)):
+                    pending.append(executor.submit(
+                        self._write_positional, fd, block, descriptor, offset, size))
+                    offset += size
+                    if len(pending) == 2 * self.parallelism:
+                        pending.popleft().result()
+                while len(pending) > 0:
+                    pending.popleft().result()
+            finally:
+                for future in pending:
+                    future.cancel()
+        md5 = None
+        if self.md5 is not None:
+            md5 = file_md5(fd, start, offset - start, self.buffer_size)
+        output.advance(offset - start, md5)
+        return True
+
+    def _spools_blocks(self):
+        """
+        Returns True if the output cannot be rewound to retry a failed block,
+        in which case each block is downloaded into a spooled buffer and only
+        written to the output once it is complete.
+        """
+        try:
+            self.output.tell()
+        except IOError:
+            return True
+        return False
+
+    def _plan(self):
+        """
+        Reads the ticket and returns the list of the descriptors of the blocks
+        to download, as used by :meth:`_run_shared`.
+        """
+        ticket_blocks = self._ticket_blocks()
+        blocks = ticket_blocks
+        if self.coalesce_gap is not None:
+            blocks = protocol.coalesce_blocks(ticket_blocks, self.coalesce_gap)
+        try:
+            return list(blocks)
+        finally:
+            blocks.close()
+            ticket_blocks.close()
+
+    def _run_shared(self, descriptors, shared_blocks):
+        """
+        Downloads the blocks for the specified descriptors returned by
+        :meth:`_plan`, sharing them with other transfers using the specified
+        :class:`.SharedBlocks`, and writes them to the output in order.
+        """
+        writer = None
+        if self.write_behind is not None:
+            writer = WriteBehindOutput(self.output, self.write_behind)
+        output = DigestOutput(self.output if writer is None else writer)
+        with self._notifying(None, protocol.EVENT_TRANSFER_END) as end:
+            completed = False
+            try:
+                for block, descriptor in enumerate(descriptors):
+                    shared_blocks.write(
+                        descriptor,
+                        functools.partial(self._download_block, block, descriptor),
+                        output)
+                completed = True
+            finally:
+                end["size"] = output.size
+                if writer is not None:
+                    writer.close(completed)
+            self._check_digest(output)
+
+    def run(self):
+        # Hedged requests are downloaded into separate buffers.
+        spool = self.hedge_policy is not None or self._spools_blocks()
+        writer = None
+        if self.write_behind is not None:
+            writer = WriteBehindOutput(self.output, self.write_behind)
+        output = DigestOutput(self.output if writer is None else writer)
+        with self._notifying(None, protocol.EVENT_TRANSFER_END) as end:
+            ticket_blocks = self._ticket_blocks()
+            blocks = ticket_blocks
+            if self.coalesce_gap is not None:
+                blocks = protocol.coalesce_blocks(ticket_blocks, self.coalesce_gap)
+            completed = False
+            try:
+                fd = None
+                if self.parallelism > 1 and self.preallocate:
+                    fd = self._positional_fd()
+                if fd is not None:
+                    descriptors = list(blocks)
+                    if not self._run_positional(output, descriptors, fd):
+                        self._run_parallel(output, descriptors)
+                elif self.parallelism > 1:
+                    self._run_parallel(output, blocks)
+                else:
+                    for block, descriptor in enumerate(blocks):
+                        if spool:
+                            self._write_block(
+                                self._download_block(block, descriptor), output)
+                        else:
+                            output.checkpoint()
+                            self._handle_url(descriptor, output, block)
+                completed = True
+            finally:
+                blocks.close()
+                ticket_blocks.close()
+                end["size"] = output.size
+                if writer is not None:
+                    writer.close(completed)
+            self._check_digest(output)
@@ -19,17 +19,18 @@ setup(
             'htsget=htsget.cli:htsget_main',
         ]
     },
+    python_requires=">=3.5",
     install_requires=["requests", "six", "humanize"],
+    extras_require={"aio": ["aiohttp; python_version >= '3.7'"]},
     keywords=["BAM", "CRAM", "htsget"],
     license="Apache Software License",
     classifiers=[
         "Programming Language :: Python",
-        "Programming Language :: Python :: 2",
-        "Programming Language :: Python :: 2.7",
         "Programming Language :: Python :: 3",
-        "Programming Language :: Python :: 3.3",
-        "Programming Language :: Python :: 3.4",
+        "Programming Language :: Python :: 3 :: Only",
         "Programming Language :: Python :: 3.5",
+        "Programming Language :: Python :: 3.6",
+        "Programming Language :: Python :: 3.7",
         "License :: OSI Approved :: Apache Software License",
         "Development Status :: 3 - Alpha",
         "Environment :: Other Environment",
@@ -0,0 +1,181 @@
+#
+# Copyright 2016 University of Oxford
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Test cases for the asyncio interface using a simple HTTP server running locally.
+"""
+from __future__ import print_function
+from __future__ import division
+
+import hashlib
+import io
+import sys
+import tempfile
+import threading
+import unittest
+
+import htsget.exceptions as exceptions
+import htsget.protocol as protocol
+
+import tests.test_local_server as local_server
+
+# The asyncio interface requires Python 3.7, and these tests use asyncio.run.
+_aio_available = False
+if sys.version_info >= (3, 7):
+    try:
+        import asyncio
+        import htsget.aio as aio
+        _aio_available = True
+    except ImportError:
+        pass
+
+
+@unittest.skipIf(not _aio_available, "Requires Python 3.7 or later and aiohttp")
+class TestAsyncDataTransfers(local_server.ServerTest):
+    """
+    Test cases for transfers using the asyncio interface.
+    """
+    def assert_data_transfer_ok(self, test_instances, **kwargs):
+        self.httpd.test_instances = test_instances
+        kwargs.setdefault("max_retries", 0)
+        asyncio.run(aio.get(local_server.TestRequestHandler.ticket_url, self.output_file, **kwargs))
+        self.output_file.seek(0)
+        all_data = b"".join(test_instance.data for test_instance in test_instances)
+        self.assertEqual(self.output_file.read(), all_data)
+
+    def test_simple_data(self):
+        instances = [
+            local_server.TestUrlInstance(url="/data1", data=b"data1"),
+            local_server.TestUrlInstance(url="/data2", data=b"data2")
+        ]
+        self.assert_data_transfer_ok(instances)
+
+    def test_parallel_data(self):
+        instances = []
+        for j in range(10):
+            instances.append(local_server.TestUrlInstance(
+                url="/path/to/data/{}".format(j),
+                data=str(j).encode() * 1024 * (j + 1)))
+        self.assert_data_transfer_ok(instances, parallelism=4)
+
+    def test_md5(self):
+        instances = [local_server.TestUrlInstance(url="/data1", data=b"x" * 1024)]
+        self.httpd.ticket_md5 = hashlib.md5(b"x" * 1024).hexdigest()
+        self.assert_data_transfer_ok(instances, parallelism=2)
+        self.httpd.ticket_md5 = hashlib.md5(b"other").hexdigest()
+        self.assertRaises(
+            exceptions.MD5MismatchError, self.assert_data_transfer_ok, instances)
+
+    def test_resume_ticket(self):
+        instances = [
+            local_server.TestUrlInstance(url="/data{}".format(j), data=str(j).encode() * 1000)
+            for j in range(20)]
+        for parallelism in [1, 4]:
+            self.httpd.truncate_ticket = True
+            self.output_file.seek(0)
+            self.output_file.truncate()
+            self.assert_data_transfer_ok(
+                instances, max_retries=1, retry_wait=0, parallelism=parallelism)
+        for instance in instances:
+            self.assertEqual(len(instance.requests), 2)
+
+    def test_events(self):
+        instances = [
+            local_server.TestUrlInstance(url="/data1", data=b"x" * 1024),
+            local_server.TestUrlInstance(url="/data2", data=b"y" * 1024)
+        ]
+        events = []
+        self.assert_data_transfer_ok(instances, listener=events.append, parallelism=2)
+        block_ends = sorted(
+            (event.block, event.size) for event in events
+            if event.event_type == protocol.EVENT_BLOCK_END)
+        self.assertEqual(block_ends, [(0, 1024), (1, 1024)])
+        self.assertEqual(events[-1].event_type, protocol.EVENT_TRANSFER_END)
+        self.assertEqual(events[-1].size, 2048)
+
+    def test_concurrent_transfers(self):
+        instances = [
+            local_server.TestUrlInstance(url="/data1", data=b"x" * 1024),
+            local_server.TestUrlInstance(url="/data2", data=b"y" * 1024)
+        ]
+        self.httpd.test_instances = instances
+        outputs = [tempfile.TemporaryFile("wb+") for _ in range(5)]
+
+        async def run_all():
+            await asyncio.gather(*[
+                aio.get(local_server.TestRequestHandler.ticket_url, output, max_retries=0)
+                for output in outputs])
+
+        asyncio.run(run_all())
+        all_data = b"".join(instance.data for instance in instances)
+        for output in outputs:
+            with output:
+                output.seek(0)
+                self.assertEqual(output.read(), all_data)
+
+    def test_missing_path(self):
+        self.assertRaises(
+            exceptions.ClientError, asyncio.run,
+            aio.get(local_server.SERVER_URL + "/nopath", self.output_file, max_retries=0))
+
+    def test_bad_port(self):
+        self.assertRaises(
+            exceptions.RetryableIOError, asyncio.run,
+            aio.get("http://localhost:66123", self.output_file, max_retries=0))
+
+    def test_data_error(self):
+        self.httpd.test_instances = [
+            local_server.TestUrlInstance(url="/fail1", data=b"", error_code=500)
+        ]
+        self.assertRaises(
+            exceptions.RetryableIOError, asyncio.run,
+            aio.get(local_server.TestRequestHandler.ticket_url, self.output_file, max_retries=0))
+
+    def test_writes_off_event_loop(self):
+        write_threads = set()
+
+        class RecordingOutput(io.BytesIO):
+            def write(self, data):
+                write_threads.add(threading.current_thread())
+                return super(RecordingOutput, self).write(data)
+
+        self.httpd.test_instances = [
+            local_server.TestUrlInstance(url="/data1", data=b"x" * 1024),
+            local_server.TestUrlInstance(url="/data2", data=b"y" * 1024)
+        ]
+        for kwargs in [{}, {"parallelism": 2}, {"write_behind": 4}]:
+            write_threads.clear()
+            output = RecordingOutput()
+            asyncio.run(aio.get(
+                local_server.TestRequestHandler.ticket_url, output, max_retries=0,
+                **kwargs))
+            self.assertEqual(output.getvalue(), b"x" * 1024 + b"y" * 1024)
+            self.assertGreater(len(write_threads), 0)
+            self.assertNotIn(threading.current_thread(), write_threads)
+
+    def test_write_error_during_other_error(self):
+        class FailingOutput(io.BytesIO):
+            def write(self, data):
+                raise IOError("disk full")
+
+        self.httpd.test_instances = [
+            local_server.TestUrlInstance(url="/data1", data=b"x" * 1024),
+            local_server.TestUrlInstance(url="/fail1", data=b"", error_code=401)
+        ]
+        self.assertRaises(
+            exceptions.ClientError, asyncio.run,
+            aio.get(
+                local_server.TestRequestHandler.ticket_url, FailingOutput(),
+                max_retries=0, write_behind=100))
@@ -0,0 +1,287 @@
+#
+# Copyright 2016-2017 University of Oxford
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Test cases for the local caches.
+"""
+from __future__ import print_function
+from __future__ import division
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+import htsget.cache as cache
+
+EXAMPLE_URL = "http://example.com/data"
+
+
+class TestBlockKey(unittest.TestCase):
+    """
+    Tests for the cache keys of blocks.
+    """
+    def test_range_normalisation(self):
+        key = cache.block_key(EXAMPLE_URL, {"Range": "bytes=0-100"})
+        self.assertEqual(key, cache.block_key(EXAMPLE_URL, {"range": "bytes = 0-100"}))
+        self.assertEqual(
+            key, cache.block_key(EXAMPLE_URL, {"Range": "bytes=0-100", "a": "b"}))
+
+    def test_distinct_keys(self):
+        keys = set([
+            cache.block_key(EXAMPLE_URL, {}),
+            cache.block_key(EXAMPLE_URL, {"Range": "bytes=0-100"}),
+            cache.block_key(EXAMPLE_URL, {"Range": "bytes=0-"}),
+            cache.block_key(EXAMPLE_URL, {"Range": "bytes=1-2,4-5"}),
+            cache.block_key(EXAMPLE_URL + "/x", {}),
+        ])
+        self.assertEqual(len(keys), 5)
+
+
+class TestResponseTtl(unittest.TestCase):
+    """
+    Tests for the lifetimes of responses.
+    """
+    def test_no_headers(self):
+        self.assertIsNone(cache.response_ttl({}))
+        self.assertIsNone(cache.response_ttl({"Cache-Control": "public"}))
+
+    def test_cache_control(self):
+        self.assertEqual(cache.response_ttl({"Cache-Control": "max-age=100"}), 100)
+        self.assertEqual(
+            cache.response_ttl({"cache-control": "public, s-maxage=5, max-age=100"}), 5)
+        self.assertEqual(cache.response_ttl({"Cache-Control": "max-age=xx"}), 0)
+        self.assertEqual(cache.response_ttl({"Cache-Control": "no-cache"}), 0)
+        self.assertEqual(cache.response_ttl({"Cache-Control": "no-store"}), -1)
+        self.assertEqual(
+            cache.response_ttl({
+                "Cache-Control": "max-age=100",
+                "Expires": "Thu, 01 Jan 1970 00:00:00 GMT"}),
+            100)
+
+    def test_expires(self):
+        expires = "Sun, 06 Nov 1994 08:49:37 GMT"
+        now = 784111777 - 60
+        self.assertEqual(cache.response_ttl({"Expires": expires}, now), 60)
+        self.assertEqual(cache.response_ttl({"Expires": expires}, now + 100), 0)
+        self.assertEqual(cache.response_ttl({"Expires": "0"}), 0)
+        headers = {"Expires": expires, "Date": "Sun, 06 Nov 1994 08:48:37 GMT"}
+        self.assertEqual(cache.response_ttl(headers, 0), 60)
+
+
+class TestTicketCache(unittest.TestCase):
+    """
+    Tests for the ticket cache.
+    """
+    ticket = {"urls": [{"url": EXAMPLE_URL}]}
+
+    def test_missing(self):
+        ticket_cache = cache.TicketCache()
+        self.assertIsNone(ticket_cache.get(EXAMPLE_URL, {}))
+
+    def test_put_get(self):
+        ticket_cache = cache.TicketCache(max_ttl=100)
+        with mock.patch("time.time", return_value=1000):
+            ticket_cache.put(EXAMPLE_URL, {}, self.ticket, {"ETag": '"a"'})
+        entry = ticket_cache.get(EXAMPLE_URL, {})
+        self.assertEqual(entry.ticket, self.ticket)
+        self.assertEqual(entry.expires, 1100)
+        self.assertEqual(entry.etag, '"a"')
+        self.assertEqual(entry.conditional_headers(), {"If-None-Match": '"a"'})
+        self.assertTrue(entry.is_fresh(1099))
+        self.assertFalse(entry.is_fresh(1100))
+
+    def test_max_ttl(self):
+        ticket_cache = cache.TicketCache(max_ttl=10)
+        with mock.patch("time.time", return_value=1000):
+            ticket_cache.put(
+                EXAMPLE_URL, {}, self.ticket, {"Cache-Control": "max-age=1000"})
+            ticket_cache.put(
+                EXAMPLE_URL + "/x", {}, self.ticket, {"Cache-Control": "max-age=5"})
+        self.assertEqual(ticket_cache.get(EXAMPLE_URL, {}).expires, 1010)
+        self.assertEqual(ticket_cache.get(EXAMPLE_URL + "/x", {}).expires, 1005)
+
+    def test_no_store(self):
+        ticket_cache = cache.TicketCache()
+        ticket_cache.put(EXAMPLE_URL, {}, self.ticket, {"Cache-Control": "no-store"})
+        self.assertIsNone(ticket_cache.get(EXAMPLE_URL, {}))
+
+    def test_auth_identity(self):
+        ticket_cache = cache.TicketCache()
+        ticket_cache.put(EXAMPLE_URL, {"Authorization": "Bearer a"}, self.ticket, {})
+        self.assertIsNotNone(
+            ticket_cache.get(EXAMPLE_URL, {"authorization": "Bearer a"}))
+        self.assertIsNone(ticket_cache.get(EXAMPLE_URL, {"Authorization": "Bearer b"}))
+        self.assertIsNone(ticket_cache.get(EXAMPLE_URL, {}))
+
+    def test_refresh(self):
+        ticket_cache = cache.TicketCache(max_ttl=100)
+        with mock.patch("time.time", return_value=1000):
+            ticket_cache.put(
+                EXAMPLE_URL, {}, self.ticket, {"ETag": '"a"', "Last-Modified": "x"})
+        entry = ticket_cache.get(EXAMPLE_URL, {})
+        with mock.patch("time.time", return_value=2000):
+            ticket_cache.refresh(EXAMPLE_URL, {}, entry, {"Cache-Control": "max-age=10"})
+        entry = ticket_cache.get(EXAMPLE_URL, {})
+        self.assertEqual(entry.expires, 2010)
+        self.assertEqual(entry.etag, '"a"')
+        self.assertEqual(entry.last_modified, "x")
+
+    def test_max_entries(self):
+        ticket_cache = cache.TicketCache(max_entries=2)
+        for j in range(3):
+            ticket_cache.put(EXAMPLE_URL + str(j), {}, self.ticket, {})
+        self.assertIsNone(ticket_cache.get(EXAMPLE_URL + "0", {}))
+        self.assertIsNotNone(ticket_cache.get(EXAMPLE_URL + "1", {}))
+        self.assertIsNotNone(ticket_cache.get(EXAMPLE_URL + "2", {}))
+
+    def test_on_disk(self):
+        cache_dir = tempfile.mkdtemp(prefix="htsget_cache_test_")
+        try:
+            ticket_cache = cache.TicketCache(path=cache_dir)
+            ticket_cache.put(EXAMPLE_URL, {}, self.ticket, {"ETag": '"a"'})
+            other_cache = cache.TicketCache(path=cache_dir)
+            entry = other_cache.get(EXAMPLE_URL, {})
+            self.assertEqual(entry.ticket, self.ticket)
+            self.assertEqual(entry.etag, '"a"')
+            other_cache.clear()
+            self.assertIsNone(cache.TicketCache(path=cache_dir).get(EXAMPLE_URL, {}))
+        finally:
+            shutil.rmtree(cache_dir)
+
+
+class TestHeaderCache(unittest.TestCase):
+    """
+    Tests for the header cache.
+    """
+    def test_put_get(self):
+        header_cache = cache.HeaderCache()
+        self.assertIsNone(header_cache.get(EXAMPLE_URL, {}))
+        header_cache.put(EXAMPLE_URL, {}, b"header")
+        self.assertEqual(header_cache.get(EXAMPLE_URL, {}), b"header")
+        self.assertEqual(header_cache.get(EXAMPLE_URL, {}), b"header")
+        self.assertIsNone(header_cache.get(EXAMPLE_URL + "/x", {}))
+
+    def test_auth_identity(self):
+        header_cache = cache.HeaderCache()
+        header_cache.put(EXAMPLE_URL, {"Authorization": "Bearer a"}, b"header")
+        self.assertEqual(
+            header_cache.get(EXAMPLE_URL, {"authorization": "Bearer a"}), b"header")
+        self.assertIsNone(header_cache.get(EXAMPLE_URL, {"Authorization": "Bearer b"}))
+
+    def test_max_entries(self):
+        header_cache = cache.HeaderCache(max_entries=2)
+        for j in range(3):
+            header_cache.put(EXAMPLE_URL + str(j), {}, b"header")
+        self.assertIsNone(header_cache.get(EXAMPLE_URL + "0", {}))
+        self.assertIsNotNone(header_cache.get(EXAMPLE_URL + "1", {}))
+        self.assertIsNotNone(header_cache.get(EXAMPLE_URL + "2", {}))
+
+    def test_on_disk(self):
+        cache_dir = tempfile.mkdtemp(prefix="htsget_cache_test_")
+        try:
+            header_cache = cache.HeaderCache(path=cache_dir)
+            header_cache.put(EXAMPLE_URL, {}, b"\x00header")
+            other_cache = cache.HeaderCache(path=cache_dir)
+            self.assertEqual(other_cache.get(EXAMPLE_URL, {}), b"\x00header")
+            other_cache.clear()
+            self.assertIsNone(other_cache.get(EXAMPLE_URL, {}))
+            self.assertIsNone(cache.HeaderCache(path=cache_dir).get(EXAMPLE_URL, {}))
+        finally:
+            shutil.rmtree(cache_dir)
+
+
+class TestBlockCache(unittest.TestCase):
+    """
+    Tests for the on-disk block cache.
+    """
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp(prefix="htsget_cache_test_")
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def put(self, block_cache, url, data, etag='"etag"', headers={}):
+        writer = block_cache.put(url, headers, etag)
+        writer.write(data)
+        writer.commit()
+
+    def assert_cached(self, block_cache, url, data, etag='"etag"', headers={}):
+        entry = block_cache.get(url, headers)
+        self.assertIsNotNone(entry)
+        with entry:
+            self.assertEqual(entry.etag, etag)
+            self.assertEqual(entry.file.read(), data)
+
+    def test_missing(self):
+        block_cache = cache.BlockCache(self.cache_dir)
+        self.assertIsNone(block_cache.get(EXAMPLE_URL, {}))
+
+    def test_put_get(self):
+        block_cache = cache.BlockCache(self.cache_dir)
+        self.put(block_cache, EXAMPLE_URL, b"1234", headers={"Range": "bytes=0-3"})
+        self.assert_cached(
+            block_cache, EXAMPLE_URL, b"1234", headers={"Range": "bytes=0-3"})
+        self.assertIsNone(block_cache.get(EXAMPLE_URL, {}))
+
+    def test_uncommitted(self):
+        block_cache = cache.BlockCache(self.cache_dir)
+        writer = block_cache.put(EXAMPLE_URL, {}, '"etag"')
+        writer.write(b"1234")
+        self.assertIsNone(block_cache.get(EXAMPLE_URL, {}))
+        writer.abort()
+        self.assertIsNone(block_cache.get(EXAMPLE_URL, {}))
+        self.assertEqual(os.listdir(self.cache_dir), [])
+
+    def test_replace(self):
+        block_cache = cache.BlockCache(self.cache_dir)
+        self.put(block_cache, EXAMPLE_URL, b"1234", etag='"1"')
+        self.put(block_cache, EXAMPLE_URL, b"5678", etag='"2"')
+        self.assert_cached(block_cache, EXAMPLE_URL, b"5678", etag='"2"')
+
+    def test_shared_directory(self):
+        self.put(cache.BlockCache(self.cache_dir), EXAMPLE_URL, b"1234")
+        self.assert_cached(cache.BlockCache(self.cache_dir), EXAMPLE_URL, b"1234")
+
+    def test_too_large(self):
+        block_cache = cache.BlockCache(self.cache_dir, max_size=100)
+        writer = block_cache.put(EXAMPLE_URL, {}, '"etag"')
+        writer.write(b"x" * 60)
+        writer.write(b"x" * 60)
+        writer.commit()
+        self.assertIsNone(block_cache.get(EXAMPLE_URL, {}))
+        self.assertEqual(os.listdir(self.cache_dir), [])
+
+    def test_lru_eviction(self):
+        block_cache = cache.BlockCache(self.cache_dir, max_size=400)
+        urls = [EXAMPLE_URL + "/{}".format(j) for j in range(4)]
+        for j, url in enumerate(urls[:3]):
+            self.put(block_cache, url, b"x" * 100)
+            path = block_cache.entry_path(cache.block_key(url, {}))
+            os.utime(path, (j, j))
+        # Using the first entry makes the second the least recently used.
+        self.assert_cached(block_cache, urls[0], b"x" * 100)
+        self.put(block_cache, urls[3], b"x" * 100)
+        self.assertIsNone(block_cache.get(urls[1], {}))
+        for url in [urls[0], urls[2], urls[3]]:
+            self.assert_cached(block_cache, url, b"x" * 100)
+
+    def test_clear(self):
+        block_cache = cache.BlockCache(self.cache_dir)
+        self.put(block_cache, EXAMPLE_URL, b"1234")
+        block_cache.clear()
+        self.assertIsNone(block_cache.get(EXAMPLE_URL, {}))
@@ -19,16 +19,21 @@ Test cases for the htsget CLI.
 from __future__ import print_function
 from __future__ import division
 
+import hashlib
 import json
 import logging
 import os
+import shutil
 import sys
 import tempfile
 import unittest
 
 import mock
 
+from six import StringIO
+
 import htsget.cli as cli
+import htsget.stats
 import htsget.exceptions as exceptions
 
 
@@ -65,6 +70,19 @@ class TestHtsgetArgumentParser(unittest.TestCase):
         self.assertEqual(args.retry_wait, 5)
         self.assertEqual(args.timeout, 120)
         self.assertEqual(args.bearer_token, None)
+        self.assertEqual(args.parallel, None)
+        self.assertEqual(args.backoff, "exponential")
+        self.assertEqual(args.max_retry_wait, 60)
+        self.assertEqual(args.retry_budget, None)
+        self.assertEqual(args.retry_deadline, None)
+        self.assertEqual(args.block_cache, None)
+        self.assertEqual(args.block_cache_size, 1024)
+        self.assertEqual(args.ticket_cache, None)
+        self.assertEqual(args.ticket_cache_ttl, 60)
+        self.assertEqual(args.refresh_ticket, False)
+        self.assertEqual(args.buffer_size, 64)
+        self.assertEqual(args.print_md5, False)
+        self.assertEqual(args.stats_json, None)
 
 
 class TestHtsgetRun(unittest.TestCase):
@@ -256,6 +274,230 @@ class TestHtsgetRun(unittest.TestCase):
                 url, self.output_filename, bearer_token))
             kwargs["bearer_token"] = bearer_token
 
+    def test_backoff(self):
+        url = "http://example.com/otherstuff"
+        for backoff in ["fixed", "exponential", "decorrelated"]:
+            args, kwargs = self.run_cmd("{} -O {} --backoff {}".format(
+                url, self.output_filename, backoff))
+            self.assertEqual(kwargs["backoff"], backoff)
+
+    def test_retry_limits(self):
+        url = "http://example.com/otherstuff"
+        args, kwargs = self.run_cmd(
+            "{} -O {} --max-retry-wait 10 --retry-budget 20 "
+            "--retry-deadline 30.5".format(url, self.output_filename))
+        self.assertEqual(kwargs["max_retry_wait"], 10)
+        self.assertEqual(kwargs["retry_budget"], 20)
+        self.assertEqual(kwargs["retry_deadline"], 30.5)
+
+    def test_block_cache(self):
+        url = "http://example.com/otherstuff"
+        args, kwargs = self.run_cmd("{} -O {}".format(url, self.output_filename))
+        self.assertIsNone(kwargs["block_cache"])
+        cache_dir = tempfile.mkdtemp(prefix="htsget_cli_cache_")
+        try:
+            args, kwargs = self.run_cmd(
+                "{} -O {} --block-cache {} --block-cache-size 10".format(
+                    url, self.output_filename, cache_dir))
+            self.assertEqual(kwargs["block_cache"].path, cache_dir)
+            self.assertEqual(kwargs["block_cache"].max_size, 10 * 2**20)
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def test_ticket_cache(self):
+        url = "http://example.com/otherstuff"
+        args, kwargs = self.run_cmd("{} -O {}".format(url, self.output_filename))
+        self.assertIsNone(kwargs["ticket_cache"])
+        self.assertFalse(kwargs["bypass_ticket_cache"])
+        cache_dir = tempfile.mkdtemp(prefix="htsget_cli_cache_")
+        try:
+            args, kwargs = self.run_cmd(
+                "{} -O {} --ticket-cache {} --ticket-cache-ttl 10 "
+                "--refresh-ticket".format(url, self.output_filename, cache_dir))
+            self.assertEqual(kwargs["ticket_cache"].path, cache_dir)
+            self.assertEqual(kwargs["ticket_cache"].max_ttl, 10)
+            self.assertTrue(kwargs["bypass_ticket_cache"])
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def test_parallel(self):
+        url = "http://example.com/otherstuff"
+        args, kwargs = self.run_cmd("{} -O {}".format(url, self.output_filename))
+        self.assertEqual(kwargs["parallelism"], 1)
+        for parallel in [1, 4, 16]:
+            args, kwargs = self.run_cmd("{} -O {} -p {}".format(
+                url, self.output_filename, parallel))
+            self.assertEqual(kwargs["parallelism"], parallel)
+
+            args, kwargs = self.run_cmd("{} -O {} --parallel {}".format(
+                url, self.output_filename, parallel))
+            self.assertEqual(kwargs["parallelism"], parallel)
+
+    def test_buffer_size(self):
+        url = "http://example.com/otherstuff"
+        args, kwargs = self.run_cmd("{} -O {}".format(url, self.output_filename))
+        self.assertEqual(kwargs["buffer_size"], 65536)
+        args, kwargs = self.run_cmd("{} -O {} --buffer-size 1024".format(
+            url, self.output_filename))
+        self.assertEqual(kwargs["buffer_size"], 2**20)
+
+    def test_write_behind(self):
+        url = "http://example.com/otherstuff"
+        args, kwargs = self.run_cmd("{} -O {}".format(url, self.output_filename))
+        self.assertIsNone(kwargs["write_behind"])
+        args, kwargs = self.run_cmd("{} -O {} --write-behind 16".format(
+            url, self.output_filename))
+        self.assertEqual(kwargs["write_behind"], 16 * 2**20)
+
+    def test_preallocate(self):
+        url = "http://example.com/otherstuff"
+        args, kwargs = self.run_cmd("{} -O {}".format(url, self.output_filename))
+        self.assertFalse(kwargs["preallocate"])
+        args, kwargs = self.run_cmd("{} -O {} -p 4 --preallocate".format(
+            url, self.output_filename))
+        self.assertTrue(kwargs["preallocate"])
+
+    def test_coalesce_gap(self):
+        url = "http://example.com/otherstuff"
+        args, kwargs = self.run_cmd("{} -O {}".format(url, self.output_filename))
+        self.assertIsNone(kwargs["coalesce_gap"])
+        args, kwargs = self.run_cmd("{} -O {} --coalesce-gap 1024".format(
+            url, self.output_filename))
+        self.assertEqual(kwargs["coalesce_gap"], 1024)
+
+    def test_hedge(self):
+        url = "http://example.com/otherstuff"
+        args, kwargs = self.run_cmd("{} -O {}".format(url, self.output_filename))
+        self.assertIsNone(kwargs["hedge_percentile"])
+        args, kwargs = self.run_cmd("{} -O {} --hedge 95".format(
+            url, self.output_filename))
+        self.assertEqual(kwargs["hedge_percentile"], 95)
+
+    def test_regions(self):
+        url = "http://example.com/otherstuff"
+        with open(self.output_filename, "w") as f:
+            f.write("chr1 0 100\nchr2\n")
+        parser = cli.get_htsget_parser()
+        args = parser.parse_args([
+            url, "--regions", self.output_filename, "--output-dir", "/tmp/x",
+            "--parallel", "4", "--print-md5"])
+        with mock.patch("htsget.get_regions", return_value=["a", "b"]) as mocked, \
+                mock.patch("sys.exit") as mocked_exit, \
+                mock.patch("sys.stderr", new_callable=StringIO) as stderr:
+            cli.run(args)
+        mocked_exit.assert_called_once_with(0)
+        args, kwargs = mocked.call_args
+        self.assertEqual(args, (url, [("chr1", 0, 100), ("chr2", None, None)]))
+        self.assertEqual(kwargs["output_dir"], "/tmp/x")
+        self.assertEqual(kwargs["parallelism"], 4)
+        self.assertEqual(stderr.getvalue(), "a\nb\n")
+        args = parser.parse_args([url, "--regions", self.output_filename])
+        with mock.patch("htsget.get_regions", return_value=["a", "b"]) as mocked, \
+                mock.patch("sys.exit"):
+            cli.run(args)
+        args, kwargs = mocked.call_args
+        # The regions are transferred concurrently by default.
+        self.assertIsNone(kwargs["parallelism"])
+
+    def test_merge_regions(self):
+        url = "http://example.com/otherstuff"
+        manifest = tempfile.NamedTemporaryFile("w")
+        with manifest:
+            manifest.write("chr1 0 100\nchr2\n")
+            manifest.flush()
+            args, kwargs = self.run_cmd("{} --regions {} --merge-regions -O {}".format(
+                url, manifest.name, self.output_filename))
+        self.assertEqual(args[1].name, self.output_filename)
+        self.assertEqual(kwargs["regions"], [("chr1", 0, 100), ("chr2", None, None)])
+
+    def test_header_only(self):
+        parser = cli.get_htsget_parser()
+        args = parser.parse_args([
+            "http://example.com", "--header-only", "-O", self.output_filename,
+            "--print-md5"])
+        with mock.patch("htsget.get_header", return_value=b"header") as mocked, \
+                mock.patch("sys.exit") as mocked_exit, \
+                mock.patch("sys.stderr", new_callable=StringIO) as stderr:
+            cli.run(args)
+        mocked_exit.assert_called_once_with(0)
+        args, kwargs = mocked.call_args
+        self.assertEqual(args, ("http://example.com",))
+        self.assertIsNone(kwargs["header_cache"])
+        with open(self.output_filename, "rb") as f:
+            self.assertEqual(f.read(), b"header")
+        self.assertEqual(
+            stderr.getvalue(), "{}\n".format(hashlib.md5(b"header").hexdigest()))
+
+    def test_regions_with_output(self):
+        parser = cli.get_htsget_parser()
+        args = parser.parse_args([
+            "http://example.com", "--regions", self.output_filename, "-O",
+            self.output_filename])
+        with mock.patch("htsget.get_regions") as mocked, \
+                mock.patch("sys.exit") as mocked_exit, \
+                mock.patch("sys.stderr", new_callable=StringIO) as stderr:
+            cli.run(args)
+        mocked_exit.assert_called_once_with(1)
+        mocked.assert_not_called()
+        self.assertIn("--output cannot be used with --regions", stderr.getvalue())
+
+    def test_fields_and_tags(self):
+        url = "http://example.com/otherstuff"
+        args, kwargs = self.run_cmd("{} -O {}".format(url, self.output_filename))
+        self.assertIsNone(kwargs["fields"])
+        self.assertIsNone(kwargs["tags"])
+        self.assertIsNone(kwargs["notags"])
+        args, kwargs = self.run_cmd(
+            "{} -O {} --fields QNAME,POS --tags MD --notags OQ,MM".format(
+                url, self.output_filename))
+        self.assertEqual(kwargs["fields"], ["QNAME", "POS"])
+        self.assertEqual(kwargs["tags"], ["MD"])
+        self.assertEqual(kwargs["notags"], ["OQ", "MM"])
+
+    def test_no_tags(self):
+        parser = cli.get_htsget_parser()
+        args = parser.parse_args(["http://example.com", "--tags", ""])
+        self.assertEqual(args.tags, [])
+
+    def test_invalid_fields(self):
+        parser = cli.get_htsget_parser()
+        args = parser.parse_args([
+            "http://example.com", "-O", self.output_filename, "--tags", "MD",
+            "--notags", "MD"])
+        with mock.patch("sys.exit") as mocked_exit, \
+                mock.patch("sys.stderr", new_callable=StringIO) as stderr:
+            cli.run(args)
+        mocked_exit.assert_called_once_with(1)
+        self.assertIn("both included and excluded: MD", stderr.getvalue())
+
+    def test_print_md5(self):
+        url = "http://example.com/otherstuff"
+        parser = cli.get_htsget_parser()
+        args = parser.parse_args([url, "-O", self.output_filename, "--print-md5"])
+        digest = "d41d8cd98f00b204e9800998ecf8427e"
+        with mock.patch("htsget.get", return_value=digest), \
+                mock.patch("sys.exit") as mocked_exit, \
+                mock.patch("sys.stderr", new_callable=StringIO) as stderr:
+            cli.run(args)
+        mocked_exit.assert_called_once_with(0)
+        self.assertEqual(stderr.getvalue(), digest + "\n")
+
+    def test_stats_json(self):
+        url = "http://example.com/otherstuff"
+        args, kwargs = self.run_cmd("{} -O {}".format(url, self.output_filename))
+        self.assertIsNone(kwargs["listener"])
+        stats_dir = tempfile.mkdtemp(prefix="htsget_cli_stats_")
+        try:
+            stats_file = os.path.join(stats_dir, "stats.json")
+            args, kwargs = self.run_cmd("{} -O {} --stats-json {}".format(
+                url, self.output_filename, stats_file))
+            self.assertIsInstance(kwargs["listener"], htsget.stats.TransferStats)
+            with open(stats_file) as f:
+                summary = json.load(f)
+            self.assertEqual(summary["blocks"], [])
+        finally:
+            shutil.rmtree(stats_dir)
+
     def test_headers(self):
         url = "http://example.com/otherstuff"
         headers = '{"Header-Name":"value"}'
@@ -283,16 +525,43 @@ class TestHtsgetRun(unittest.TestCase):
             mocked_get.assert_not_called()
             mocked_exit.assert_called_once_with(1)
 
-    def test_stdout_zero_retries(self):
+    def test_stdout_retries(self):
         url = "http://example.com/stuff"
         args, kwargs = self.run_cmd("{}".format(url))
         self.assertEqual(args[0], url)
-        self.assertEqual(kwargs["max_retries"], 0)
-
-        # this is true even if we specify it explicitly
+        self.assertEqual(kwargs["max_retries"], 5)
         args, kwargs = self.run_cmd("{} --max-retries 10".format(url))
         self.assertEqual(args[0], url)
-        self.assertEqual(kwargs["max_retries"], 0)
+        self.assertEqual(kwargs["max_retries"], 10)
+
+
+class TestReadRegions(unittest.TestCase):
+    """
+    Tests for reading region manifests.
+    """
+
+    def read(self, text):
+        with tempfile.NamedTemporaryFile("w") as f:
+            f.write(text)
+            f.flush()
+            return cli.read_regions(f.name)
+
+    def test_regions(self):
+        regions = self.read(
+            "# regions\ntrack name=x\nbrowser position chr1\n\n"
+            "chr1\t10\t20\tname\t0\nchrX\n  chr2 5 6  \n")
+        self.assertEqual(
+            regions, [("chr1", 10, 20), ("chrX", None, None), ("chr2", 5, 6)])
+
+    def test_empty(self):
+        self.assertEqual(self.read(""), [])
+
+    def test_invalid(self):
+        for text in ["chr1 10\n", "chr1 x 20\n", "chr1 10 2.5\n", "chr1\nchr1\n"]:
+            self.assertRaises(ValueError, self.read, text)
+
+    def test_missing_file(self):
+        self.assertRaises(ValueError, cli.read_regions, "/no/such/file/exists")
 
 
 class TestVerbosity(unittest.TestCase):
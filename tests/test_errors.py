@@ -36,10 +36,14 @@ class MockedErrorResponse(object):
     def __init__(self, status_code, body):
         self.status_code = status_code
         self.text = body
+        self.closed = False
 
     def raise_for_status(self):
         raise requests.HTTPError()
 
+    def close(self):
+        self.closed = True
+
 
 class ClientErrorTest(unittest.TestCase):
     """
@@ -52,7 +56,7 @@ class ClientErrorTest(unittest.TestCase):
     def test_404(self):
         body = "XXXX"
         returned_response = MockedErrorResponse(404, body)
-        with mock.patch("requests.get", return_value=returned_response):
+        with mock.patch("requests.Session.get", return_value=returned_response):
             with tempfile.TemporaryFile("wb+") as f:
                 try:
                     htsget.get("http://some_url", f)
@@ -61,3 +65,21 @@ class ClientErrorTest(unittest.TestCase):
                     self.assertIn(body, s)
                 else:
                     self.assertFalse(True)
+        self.assertTrue(returned_response.closed)
+
+
+class RetryAfterTest(unittest.TestCase):
+    """
+    Tests for honouring the Retry-After header on server errors.
+    """
+    def test_retry_after(self):
+        response = MockedErrorResponse(503, "busy")
+        response.headers = {"Retry-After": "42"}
+        with mock.patch("requests.Session.get", return_value=response), \
+                mock.patch("time.sleep") as mock_sleep:
+            with tempfile.TemporaryFile("wb+") as f:
+                self.assertRaises(
+                    exceptions.RetryableIOError, htsget.get, "http://some_url", f,
+                    max_retries=2, retry_wait=1)
+        self.assertEqual(mock_sleep.call_args_list, [mock.call(42)] * 2)
+        self.assertTrue(response.closed)
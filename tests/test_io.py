@@ -26,6 +26,7 @@ import unittest
 import mock
 
 import htsget
+import htsget.cache
 import htsget.exceptions as exceptions
 
 
@@ -35,6 +36,7 @@ class MockedResponse(object):
     """
 
     def __init__(self, ticket, data):
+        self.status_code = 200
         self.headers = {}
         self.data = data
         self.ticket = ticket
@@ -57,6 +59,7 @@ class MockedTicketResponse(object):
     """
 
     def __init__(self, ticket, char_by_char=False):
+        self.status_code = 200
         self.headers = {}
         self.ticket = ticket
         self.char_by_char = char_by_char
@@ -76,7 +79,7 @@ class MockedTicketResponse(object):
 
 class MockedRequestsTest(unittest.TestCase):
     """
-    Test cases where we mock out requests.get.
+    Test cases where we mock out requests.Session.get.
     """
 
     def test_simple_case(self):
@@ -87,7 +90,8 @@ class MockedRequestsTest(unittest.TestCase):
             "urls": [{"url": data_url, "headers": headers}]}}
         data = b"0" * 1024
         returned_response = MockedResponse(json.dumps(ticket).encode(), data)
-        with mock.patch("requests.get", return_value=returned_response) as mocked_get:
+        with mock.patch(
+                "requests.Session.get", return_value=returned_response) as mocked_get:
             with tempfile.NamedTemporaryFile("wb+") as f:
                 htsget.get(ticket_url, f)
                 f.seek(0)
@@ -104,7 +108,8 @@ class MockedRequestsTest(unittest.TestCase):
         ticket = {"htsget": {"urls": []}}
         bearer_token = "x" * 1024
         returned_response = MockedTicketResponse(json.dumps(ticket).encode())
-        with mock.patch("requests.get", return_value=returned_response) as mocked_get:
+        with mock.patch(
+                "requests.Session.get", return_value=returned_response) as mocked_get:
             with tempfile.NamedTemporaryFile("wb+") as f:
                 htsget.get(ticket_url, f, bearer_token=bearer_token)
                 f.seek(0)
@@ -123,7 +128,8 @@ class MockedRequestsTest(unittest.TestCase):
         ticket_url = "http://ticket.com"
         ticket = {"htsget": {"urls": []}}
         returned_response = MockedTicketResponse(json.dumps(ticket).encode())
-        with mock.patch("requests.get", return_value=returned_response) as mocked_get:
+        with mock.patch(
+                "requests.Session.get", return_value=returned_response) as mocked_get:
             with tempfile.NamedTemporaryFile("wb+") as f:
                 htsget.get(ticket_url, f)
                 f.seek(0)
@@ -160,7 +166,8 @@ class MockedRequestsTest(unittest.TestCase):
         ticket_url = "http://ticket.com"
         ticket = {"htsget": {"urls": []}}
         returned_response = MockedTicketResponse(json.dumps(ticket).encode())
-        with mock.patch("requests.get", return_value=returned_response) as mocked_get:
+        with mock.patch(
+                "requests.Session.get", return_value=returned_response) as mocked_get:
             with tempfile.NamedTemporaryFile("wb+") as f:
                 htsget.get(ticket_url, f, bearer_token=bearer_token, headers=custom_headers)
                 f.seek(0)
@@ -173,7 +180,8 @@ class MockedRequestsTest(unittest.TestCase):
         ticket = {"htsget": {"urls": []}, "padding": "X" * 10}
         returned_response = MockedTicketResponse(
             json.dumps(ticket).encode(), char_by_char=True)
-        with mock.patch("requests.get", return_value=returned_response) as mocked_get:
+        with mock.patch(
+                "requests.Session.get", return_value=returned_response) as mocked_get:
             with tempfile.NamedTemporaryFile("wb+") as f:
                 htsget.get(ticket_url, f)
                 f.seek(0)
@@ -192,7 +200,8 @@ class MockedRequestsTest(unittest.TestCase):
         ticket_url = "http://ticket.com"
         ticket = (b" " * 100) + b"0" * 1024
         returned_response = MockedResponse(ticket, b"")
-        with mock.patch("requests.get", return_value=returned_response) as mocked_get:
+        with mock.patch(
+                "requests.Session.get", return_value=returned_response) as mocked_get:
             with tempfile.NamedTemporaryFile("wb+") as f:
                 self.assertRaises(
                     exceptions.InvalidLeadingJsonError, htsget.get, ticket_url, f)
@@ -206,7 +215,8 @@ class MockedRequestsTest(unittest.TestCase):
         ticket_url = "http://ticket.com"
         ticket = bytearray([0xff] * 100)
         returned_response = MockedResponse(ticket, b"")
-        with mock.patch("requests.get", return_value=returned_response) as mocked_get:
+        with mock.patch(
+                "requests.Session.get", return_value=returned_response) as mocked_get:
             with tempfile.NamedTemporaryFile("wb+") as f:
                 self.assertRaises(
                     exceptions.TicketDecodeError, htsget.get, ticket_url, f)
@@ -220,7 +230,8 @@ class MockedRequestsTest(unittest.TestCase):
         ticket_url = "http://ticket.com"
         ticket = b""
         returned_response = MockedResponse(ticket, b"")
-        with mock.patch("requests.get", return_value=returned_response) as mocked_get:
+        with mock.patch(
+                "requests.Session.get", return_value=returned_response) as mocked_get:
             with tempfile.NamedTemporaryFile("wb+") as f:
                 self.assertRaises(
                     exceptions.EmptyTicketError, htsget.get, ticket_url, f)
@@ -229,3 +240,135 @@ class MockedRequestsTest(unittest.TestCase):
             args, kwargs = mocked_get.call_args
             self.assertEqual(kwargs["headers"], {})
             self.assertEqual(kwargs["stream"], True)
+
+
+class TestSessions(unittest.TestCase):
+    """
+    Tests for the connection pooling sessions.
+    """
+
+    def test_create_session(self):
+        session = htsget.io.create_session(pool_connections=3, pool_maxsize=7)
+        for prefix in ["http://", "https://"]:
+            adapter = session.get_adapter(prefix + "example.com")
+            self.assertEqual(adapter._pool_connections, 3)
+            self.assertEqual(adapter._pool_maxsize, 7)
+            self.assertFalse(adapter._pool_block)
+
+    def test_shared_session(self):
+        session = htsget.io.get_shared_session()
+        self.assertIs(session, htsget.io.get_shared_session())
+        self.assertIs(session, htsget.io.get_shared_session(htsget.io.POOL_MAXSIZE))
+        other = htsget.io.get_shared_session(htsget.io.POOL_MAXSIZE + 1)
+        self.assertIsNot(session, other)
+
+    def test_manager_sessions(self):
+        dm1 = htsget.io.SynchronousDownloadManager("http://a.com", None)
+        dm2 = htsget.io.SynchronousDownloadManager("http://b.com", None)
+        self.assertIs(dm1.session, dm2.session)
+        dm3 = htsget.io.SynchronousDownloadManager(
+            "http://a.com", None, parallelism=htsget.io.POOL_MAXSIZE * 2)
+        self.assertIsNot(dm1.session, dm3.session)
+        adapter = dm3.session.get_adapter("http://a.com")
+        self.assertEqual(adapter._pool_maxsize, htsget.io.POOL_MAXSIZE * 2)
+
+    def test_session_used_for_all_requests(self):
+        ticket_url = "http://ticket.com"
+        data_url = "http://data.url.com"
+        ticket = {"htsget": {"urls": [{"url": data_url}, {"url": data_url}]}}
+        data = b"1234"
+        session = mock.Mock()
+        session.get.return_value = MockedResponse(json.dumps(ticket).encode(), data)
+        with mock.patch("requests.Session.get") as mocked_get:
+            with tempfile.NamedTemporaryFile("wb+") as f:
+                htsget.get(ticket_url, f, session=session)
+                f.seek(0)
+                self.assertEqual(f.read(), data * 2)
+            mocked_get.assert_not_called()
+        self.assertEqual(session.get.call_count, 3)
+
+
+class TestClient(unittest.TestCase):
+    """
+    Tests for the reusable client.
+    """
+
+    def test_owned_session(self):
+        with htsget.Client(parallelism=htsget.io.POOL_MAXSIZE * 2) as client:
+            self.assertTrue(client.owns_session)
+            self.assertIsNot(client.session, htsget.io.get_shared_session())
+            adapter = client.session.get_adapter("http://a.com")
+            self.assertEqual(adapter._pool_maxsize, htsget.io.POOL_MAXSIZE * 2)
+            with mock.patch.object(client.session, "close") as mocked_close:
+                client.close()
+            mocked_close.assert_called_once_with()
+
+    def test_session_not_closed(self):
+        session = mock.Mock()
+        with htsget.Client(session=session) as client:
+            self.assertFalse(client.owns_session)
+        session.close.assert_not_called()
+
+    def test_unknown_option(self):
+        self.assertRaises(TypeError, htsget.Client, reference_name="1")
+        self.assertRaises(TypeError, htsget.Client, xyz=1)
+
+    def test_get(self):
+        block_cache = mock.Mock()
+        ticket_cache = mock.Mock()
+        session = mock.Mock()
+        client = htsget.Client(
+            session=session, headers={"a": "1", "b": "2"}, block_cache=block_cache,
+            ticket_cache=ticket_cache, bearer_token="x", max_retries=2,
+            parallelism=4)
+        with mock.patch("htsget.io.get", return_value="digest") as mocked_get:
+            output = mock.Mock()
+            digest = client.get(
+                "http://ticket.com", output, headers={"b": "3"}, max_retries=3,
+                reference_name="1")
+        self.assertEqual(digest, "digest")
+        mocked_get.assert_called_once_with(
+            "http://ticket.com", output, headers={"a": "1", "b": "3"},
+            session=session, block_cache=block_cache, ticket_cache=ticket_cache,
+            bearer_token="x", max_retries=3, parallelism=4, reference_name="1")
+        self.assertEqual(client.headers, {"a": "1", "b": "2"})
+        self.assertEqual(client.options["max_retries"], 2)
+
+    def test_session_reused(self):
+        ticket_url = "http://ticket.com"
+        data_url = "http://data.url.com"
+        ticket = {"htsget": {"urls": [{"url": data_url}]}}
+        data = b"1234"
+        session = mock.Mock()
+        responses = []
+        for _ in range(3):
+            response = MockedResponse(json.dumps(ticket).encode(), data)
+            responses.extend([response, response])
+        session.get.side_effect = responses
+        client = htsget.Client(session=session, headers={"a": "1"})
+        for _ in range(3):
+            with tempfile.NamedTemporaryFile("wb+") as f:
+                client.get(ticket_url, f)
+                f.seek(0)
+                self.assertEqual(f.read(), data)
+        self.assertEqual(session.get.call_count, 6)
+        args, kwargs = session.get.call_args_list[0]
+        self.assertEqual(args[0], ticket_url)
+        self.assertEqual(kwargs["headers"]["a"], "1")
+
+    def test_get_header(self):
+        session = mock.Mock()
+        client = htsget.Client(session=session, bearer_token="x")
+        with mock.patch("htsget.io.get_header", return_value=b"h") as mocked:
+            self.assertEqual(client.get_header("http://ticket.com"), b"h")
+        args, kwargs = mocked.call_args
+        self.assertEqual(args, ("http://ticket.com",))
+        self.assertEqual(kwargs["session"], session)
+        self.assertEqual(kwargs["bearer_token"], "x")
+        self.assertIsNone(kwargs["header_cache"])
+        header_cache = htsget.cache.HeaderCache()
+        client = htsget.Client(session=session, header_cache=header_cache)
+        with mock.patch("htsget.io.get_header", return_value=b"h") as mocked:
+            client.get_header("http://ticket.com")
+        args, kwargs = mocked.call_args
+        self.assertIs(kwargs["header_cache"], header_cache)
@@ -19,8 +19,11 @@ Test cases using a simple HTTP server running locally.
 from __future__ import print_function
 from __future__ import division
 
+import concurrent.futures
+import hashlib
 import json
 import os
+import shutil
 import subprocess
 import sys
 import tempfile
@@ -29,13 +32,18 @@ import unittest
 import platform
 
 import mock
+import requests
 from six.moves import BaseHTTPServer
 from six.moves import socketserver
 from six.moves.urllib.parse import urljoin
+from six.moves.urllib.parse import urlparse
+from six.moves.urllib.parse import parse_qs
 
 import htsget
+import htsget.cache
 import htsget.exceptions as exceptions
 import htsget.cli as cli
+import htsget.protocol as protocol
 
 PORT = 6160
 SERVER_URL = "http://localhost:{}".format(PORT)
@@ -43,13 +51,51 @@ SERVER_URL = "http://localhost:{}".format(PORT)
 IS_WINDOWS = platform.system() == "Windows"
 
 
+class closing_statuses(object):
+    """
+    Context manager recording the statuses of the responses closed while it
+    is active.
+    """
+    def __init__(self):
+        self.statuses = []
+        self.__close = requests.Response.close
+        self.__patch = mock.patch.object(
+            requests.Response, "close", autospec=True, side_effect=self.__closed)
+
+    def __closed(self, response):
+        self.statuses.append(response.status_code)
+        self.__close(response)
+
+    def __enter__(self):
+        self.__patch.start()
+        return self
+
+    def __exit__(self, *args):
+        self.__patch.stop()
+
+
 class TestUrlInstance(object):
-    def __init__(self, url, data, headers={}, error_code=None, truncate=False):
+    def __init__(
+            self, url, data, headers={}, error_code=None, truncate=False,
+            truncate_first=False, supports_range=False, etag=None, data_class=None,
+            changed_etag=None, reference_name=None):
         self.url = url
         self.data = data
         self.headers = headers
         self.error_code = error_code
         self.truncate = truncate
+        # Truncate the first response only, at half of the requested data.
+        self.truncate_first = truncate_first
+        self.supports_range = supports_range
+        self.etag = etag
+        # The ETag the resource changes to after the first request.
+        self.changed_etag = changed_etag
+        # The class of the data, given in the ticket if specified.
+        self.data_class = data_class
+        # The reference whose tickets include the URL, or None for all tickets.
+        self.reference_name = reference_name
+        # The headers of the requests received for this URL.
+        self.requests = []
 
 
 class TestServer(socketserver.TCPServer):
@@ -60,6 +106,19 @@ class TestServer(socketserver.TCPServer):
     allow_reuse_address = True
     # This is set by clients to contain the list of TestUrlInstance objects.
     test_instances = []
+    # Additional headers sent with the ticket response.
+    ticket_headers = {}
+    # The headers of the ticket requests received.
+    ticket_requests = []
+    # The MD5 given in the ticket, if any.
+    ticket_md5 = None
+    # Truncate the next ticket response at half of its length.
+    truncate_ticket = False
+    # Whether the class parameter of ticket requests is honoured.
+    supports_class = True
+    # Whether POST ticket requests are supported, and the bodies received.
+    supports_post = True
+    ticket_posts = []
 
     def shutdown(self):
         self.socket.close()
@@ -77,30 +136,109 @@ class TestRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
 
     def do_GET(self):
         url_map = {instance.url: instance for instance in self.server.test_instances}
-        if self.path == self.ticket_path:
-            self.send_response(200)
-            self.end_headers()
-            urls = [
-                {
+        if urlparse(self.path).path == self.ticket_path:
+            self.server.ticket_requests.append(dict(self.headers))
+            etag = self.server.ticket_headers.get("ETag")
+            not_modified = (
+                etag is not None and self.headers.get("If-None-Match") == etag)
+            self.send_response(304 if not_modified else 200)
+            for key, value in self.server.ticket_headers.items():
+                self.send_header(key, value)
+            if not_modified:
+                self.end_headers()
+                return
+            query = parse_qs(urlparse(self.path).query)
+            request_class = query.get("class", [None])[0]
+            reference_name = query.get("referenceName", [None])[0]
+            urls = []
+            for test_instance in self.server.test_instances:
+                if (self.server.supports_class and request_class is not None and
+                        test_instance.data_class not in [None, request_class]):
+                    continue
+                if test_instance.reference_name not in [None, reference_name]:
+                    continue
+                url_object = {
                     "url": urljoin(SERVER_URL, test_instance.url),
                     "headers": test_instance.headers
-                } for test_instance in self.server.test_instances]
+                }
+                if test_instance.data_class is not None:
+                    url_object["class"] = test_instance.data_class
+                urls.append(url_object)
             ticket = {"htsget": {"urls": urls}}
-            self.wfile.write(json.dumps(ticket).encode())
+            if self.server.ticket_md5 is not None:
+                ticket["htsget"]["md5"] = self.server.ticket_md5
+            data = json.dumps(ticket).encode()
+            self.send_header("Content-Length", len(data))
+            self.end_headers()
+            if self.server.truncate_ticket:
+                self.server.truncate_ticket = False
+                data = data[:len(data) // 2]
+            self.wfile.write(data)
+            self.wfile.flush()
         elif self.path in url_map:
             instance = url_map[self.path]
+            instance.requests.append(dict(self.headers))
+            if instance.changed_etag is not None and len(instance.requests) > 1:
+                instance.etag = instance.changed_etag
+            data = instance.data
+            status = 200
+            range_header = self.headers.get("Range")
+            if instance.supports_range and range_header is not None:
+                start, end = protocol.parse_range(range_header)
+                end = len(data) - 1 if end is None else end
+                if_range = self.headers.get("If-Range")
+                if if_range is None or if_range == instance.etag:
+                    data = data[start: end + 1]
+                    status = 206
             if instance.error_code is not None:
                 self.send_error(instance.error_code)
+            elif (instance.etag is not None and
+                    self.headers.get("If-None-Match") == instance.etag):
+                self.send_response(304)
+                self.send_header("ETag", instance.etag)
+                self.end_headers()
             else:
-                self.send_response(200)
-                self.send_header("Content-Length", len(instance.data))
+                self.send_response(status)
+                self.send_header("Content-Length", len(data))
+                if instance.etag is not None:
+                    self.send_header("ETag", instance.etag)
                 if instance.truncate:
                     self.end_headers()
-                    self.wfile.write(instance.data[:-1])
+                    self.wfile.write(data[:-1])
+                    self.wfile.flush()
+                elif instance.truncate_first and len(instance.requests) == 1:
+                    self.end_headers()
+                    self.wfile.write(data[:len(data) // 2])
                     self.wfile.flush()
                 else:
                     self.end_headers()
-                    self.wfile.write(instance.data)
+                    self.wfile.write(data)
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        if self.path != self.ticket_path or not self.server.supports_post:
+            self.send_error(405)
+            return
+        length = int(self.headers.get("Content-Length"))
+        self.server.ticket_posts.append(json.loads(self.rfile.read(length).decode()))
+        urls = [
+            {
+                "url": urljoin(SERVER_URL, test_instance.url),
+                "headers": test_instance.headers
+            } for test_instance in self.server.test_instances]
+        data = json.dumps({"htsget": {"urls": urls}}).encode()
+        self.send_response(200)
+        self.send_header("Content-Length", len(data))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_HEAD(self):
+        url_map = {instance.url: instance for instance in self.server.test_instances}
+        if self.path in url_map:
+            self.send_response(200)
+            self.send_header("Content-Length", len(url_map[self.path].data))
+            self.end_headers()
         else:
             self.send_error(404)
 
@@ -131,16 +269,24 @@ class ServerTest(unittest.TestCase):
 
     def setUp(self):
         self.output_file = tempfile.NamedTemporaryFile("wb+")
+        self.httpd.ticket_md5 = None
+        self.httpd.truncate_ticket = False
+        self.httpd.supports_post = True
+        self.httpd.supports_class = True
+        self.httpd.ticket_posts = []
+        self.httpd.ticket_requests = []
+        self.httpd.ticket_headers = {}
 
 
 class TestDataTransfers(ServerTest):
     """
     Test cases for various data transfers.
     """
-    def assert_data_transfer_ok(self, test_instances, max_retries=0):
+    def assert_data_transfer_ok(self, test_instances, max_retries=0, **kwargs):
         self.httpd.test_instances = test_instances
         htsget.get(
-            TestRequestHandler.ticket_url, self.output_file, max_retries=max_retries)
+            TestRequestHandler.ticket_url, self.output_file, max_retries=max_retries,
+            **kwargs)
         self.output_file.seek(0)
         all_data = b"".join(test_instance.data for test_instance in test_instances)
         self.assertEqual(self.output_file.read(), all_data)
@@ -160,6 +306,53 @@ class TestDataTransfers(ServerTest):
                 data=bytes(j) * 1024))
         self.assert_data_transfer_ok(instances)
 
+    def test_parallel_data(self):
+        instances = []
+        for j in range(10):
+            instances.append(TestUrlInstance(
+                url="/path/to/data/{}".format(j),
+                data=str(j).encode() * 1024 * (j + 1)))
+        for parallelism in [2, 4, 20]:
+            self.output_file.seek(0)
+            self.output_file.truncate()
+            self.assert_data_transfer_ok(instances, parallelism=parallelism)
+
+    def test_buffer_sizes(self):
+        instances = [
+            TestUrlInstance(url="/data1", data=b"x" * 1000),
+            TestUrlInstance(url="/data2", data=bytes(bytearray(range(256))) * 100)
+        ]
+        for buffer_size in [1, 7, 1024, 2**20]:
+            self.output_file.seek(0)
+            self.output_file.truncate()
+            self.assert_data_transfer_ok(instances, buffer_size=buffer_size)
+            self.output_file.seek(0)
+            self.output_file.truncate()
+            self.assert_data_transfer_ok(
+                instances, buffer_size=buffer_size, parallelism=2)
+
+    def test_stats_json(self):
+        instances = [
+            TestUrlInstance(url="/data1", data=b"x" * 1000),
+            TestUrlInstance(url="/data2", data=b"y" * 2000)
+        ]
+        self.httpd.test_instances = instances
+        stats_file = tempfile.NamedTemporaryFile("w+")
+        with stats_file:
+            parser = cli.get_htsget_parser()
+            args = parser.parse_args([
+                TestRequestHandler.ticket_url, "-O", self.output_file.name,
+                "--stats-json", stats_file.name, "--parallel", "2"])
+            with mock.patch("sys.exit") as mocked_exit:
+                cli.run(args)
+            mocked_exit.assert_called_once_with(0)
+            summary = json.load(stats_file)
+        self.assertEqual(summary["total_bytes"], 3000)
+        self.assertEqual([block["size"] for block in summary["blocks"]], [1000, 2000])
+        self.assertGreater(summary["ticket"]["duration"], 0)
+        self.assertGreater(summary["time_to_first_byte"], 0)
+        self.assertIsNone(summary["error"])
+
     def test_transfer_with_cli(self):
         test_instances = [
             TestUrlInstance(url="/data1", data=b"data1"),
@@ -181,6 +374,208 @@ class TestDataTransfers(ServerTest):
         finally:
             os.unlink(filename)
 
+    def test_regions(self):
+        test_instances = [
+            TestUrlInstance(url="/data1", data=b"data1"),
+            TestUrlInstance(url="/data2", data=b"data2")
+        ]
+        self.httpd.test_instances = test_instances
+        regions = [("1", None, None), ("2", 10, 20), ("3", 0, 5)]
+        outputs = [tempfile.TemporaryFile("wb+") for _ in regions]
+        all_data = b"".join(test_instance.data for test_instance in test_instances)
+        try:
+            digests = htsget.get_regions(
+                TestRequestHandler.ticket_url, regions, outputs=outputs,
+                parallelism=3, max_retries=0)
+            for output in outputs:
+                output.seek(0)
+                self.assertEqual(output.read(), all_data)
+        finally:
+            for output in outputs:
+                output.close()
+        self.assertEqual(digests, [hashlib.md5(all_data).hexdigest()] * 3)
+        # The blocks shared by the tickets are downloaded once.
+        for instance in test_instances:
+            self.assertEqual(len(instance.requests), 1)
+
+    def test_regions_concurrent_by_default(self):
+        self.httpd.test_instances = [TestUrlInstance(url="/data1", data=b"data1")]
+        for num_regions in [3, htsget.io.POOL_MAXSIZE + 5]:
+            regions = [(str(j), None, None) for j in range(num_regions)]
+            outputs = [tempfile.TemporaryFile("wb+") for _ in regions]
+            executor = concurrent.futures.ThreadPoolExecutor
+            try:
+                with mock.patch(
+                        "concurrent.futures.ThreadPoolExecutor",
+                        side_effect=executor) as mocked:
+                    htsget.get_regions(
+                        TestRequestHandler.ticket_url, regions, outputs=outputs,
+                        max_retries=0)
+            finally:
+                for output in outputs:
+                    output.close()
+            mocked.assert_called_once_with(min(num_regions, htsget.io.POOL_MAXSIZE))
+
+    def test_post_regions(self):
+        test_instances = [
+            TestUrlInstance(url="/data1", data=b"data1"),
+            TestUrlInstance(url="/data2", data=b"data2")
+        ]
+        regions = [("1", 0, 100), ("2", None, None)]
+        self.assert_data_transfer_ok(test_instances, regions=regions, data_format="bam")
+        self.assertEqual(self.httpd.ticket_posts, [{
+            "format": "BAM", "regions": [
+                {"referenceName": "1", "start": 0, "end": 100},
+                {"referenceName": "2"}]}])
+        self.assertEqual(self.httpd.ticket_requests, [])
+
+    def test_post_regions_fallback(self):
+        test_instances = [
+            TestUrlInstance(url="/data1", data=b"data1"),
+            TestUrlInstance(url="/data2", data=b"data2")
+        ]
+        self.httpd.supports_post = False
+        regions = [("1", 0, 100), ("2", None, None), ("3", 5, 10)]
+        # The blocks repeated in the tickets for later regions are omitted.
+        self.assert_data_transfer_ok(test_instances, regions=regions)
+        self.assertEqual(self.httpd.ticket_posts, [])
+        self.assertEqual(len(self.httpd.ticket_requests), 3)
+        for instance in test_instances:
+            self.assertEqual(len(instance.requests), 1)
+
+    def get_header_instances(self):
+        return [
+            TestUrlInstance(url="/header", data=b"header", data_class="header"),
+            TestUrlInstance(url="/body", data=b"body", data_class="body")]
+
+    def test_get_header(self):
+        for supports_class in [True, False]:
+            self.httpd.supports_class = supports_class
+            instances = self.get_header_instances()
+            self.httpd.test_instances = instances
+            header_cache = htsget.cache.HeaderCache()
+            for _ in range(2):
+                header = htsget.get_header(
+                    TestRequestHandler.ticket_url, header_cache=header_cache,
+                    max_retries=0)
+                self.assertEqual(header, b"header")
+            self.assertEqual(len(instances[0].requests), 1)
+            self.assertEqual(len(instances[1].requests), 0)
+
+    def test_get_header_uncached(self):
+        instances = self.get_header_instances()
+        self.httpd.test_instances = instances
+        for _ in range(2):
+            header = htsget.get_header(TestRequestHandler.ticket_url, max_retries=0)
+            self.assertEqual(header, b"header")
+        self.assertEqual(len(instances[0].requests), 2)
+
+    def test_header_class_ignored_md5(self):
+        self.httpd.supports_class = False
+        self.httpd.test_instances = self.get_header_instances()
+        # The MD5 of the whole file cannot be checked against the header alone.
+        self.httpd.ticket_md5 = hashlib.md5(b"headerbody").hexdigest()
+        htsget.get(
+            TestRequestHandler.ticket_url, self.output_file, request_class="header",
+            max_retries=0)
+        self.output_file.seek(0)
+        self.assertEqual(self.output_file.read(), b"header")
+
+    def test_header_class_ignored_md5_ticket_cache(self):
+        self.httpd.supports_class = False
+        self.httpd.test_instances = self.get_header_instances()
+        self.httpd.ticket_md5 = hashlib.md5(b"headerbody").hexdigest()
+        header = htsget.get_header(
+            TestRequestHandler.ticket_url, ticket_cache=htsget.cache.TicketCache(),
+            header_cache=htsget.cache.HeaderCache(), max_retries=0)
+        self.assertEqual(header, b"header")
+
+    def test_header_only_with_cli(self):
+        self.httpd.test_instances = self.get_header_instances()
+        cache_dir = tempfile.mkdtemp()
+        try:
+            output = os.path.join(cache_dir, "header.bam")
+            cmd = [
+                TestRequestHandler.ticket_url, "--header-only", "--header-cache",
+                os.path.join(cache_dir, "headers"), "-O", output]
+            for _ in range(2):
+                args = cli.get_htsget_parser().parse_args(cmd)
+                with mock.patch("sys.exit") as mocked_exit:
+                    cli.run(args)
+                    mocked_exit.assert_called_once_with(0)
+                with open(output, "rb") as f:
+                    self.assertEqual(f.read(), b"header")
+            self.assertEqual(len(self.httpd.ticket_requests), 1)
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def test_regions_with_cli(self):
+        test_instances = [
+            TestUrlInstance(url="/data1", data=b"data1"),
+            TestUrlInstance(url="/data2", data=b"data2")
+        ]
+        self.httpd.test_instances = test_instances
+        output_dir = tempfile.mkdtemp()
+        try:
+            manifest = os.path.join(output_dir, "regions.bed")
+            with open(manifest, "w") as f:
+                f.write("chr1\t0\t100\nchr2\n")
+            cmd = [
+                TestRequestHandler.ticket_url, "--regions", manifest, "--output-dir",
+                output_dir, "--parallel", "2"]
+            parser = cli.get_htsget_parser()
+            args = parser.parse_args(cmd)
+            with mock.patch("sys.exit") as mocked_exit:
+                cli.run(args)
+                mocked_exit.assert_called_once_with(0)
+            all_data = b"".join(test_instance.data for test_instance in test_instances)
+            for filename in ["chr1_0_100.bam", "chr2.bam"]:
+                with open(os.path.join(output_dir, filename), "rb") as f:
+                    self.assertEqual(f.read(), all_data)
+        finally:
+            shutil.rmtree(output_dir)
+
+    def test_shared_session_cookies(self):
+        self.httpd.test_instances = [TestUrlInstance(url="/data", data=b"data")]
+        self.httpd.ticket_headers = {"Set-Cookie": "session=secret; Path=/"}
+        self.assert_data_transfer_ok(self.httpd.test_instances)
+        self.assertEqual(len(htsget.io.get_shared_session().cookies), 0)
+        # Sessions created for a single caller keep their cookies.
+        session = htsget.io.create_session()
+        self.output_file.seek(0)
+        self.output_file.truncate()
+        self.assert_data_transfer_ok(self.httpd.test_instances, session=session)
+        self.assertEqual(session.cookies.get("session"), "secret")
+
+    def test_regions_stats_json(self):
+        self.httpd.test_instances = [
+            TestUrlInstance(url="/data1", data=b"x" * 1000, reference_name="chr1"),
+            TestUrlInstance(url="/data2", data=b"y" * 10, reference_name="chr1"),
+            TestUrlInstance(url="/data3", data=b"z" * 10, reference_name="chr2"),
+            TestUrlInstance(url="/data4", data=b"w" * 5, reference_name="chr2")
+        ]
+        output_dir = tempfile.mkdtemp()
+        try:
+            manifest = os.path.join(output_dir, "regions.bed")
+            with open(manifest, "w") as f:
+                f.write("chr1\nchr2\n")
+            stats_json = os.path.join(output_dir, "stats.json")
+            args = cli.get_htsget_parser().parse_args([
+                TestRequestHandler.ticket_url, "--regions", manifest, "--output-dir",
+                output_dir, "--stats-json", stats_json, "--parallel", "2"])
+            with mock.patch("sys.exit") as mocked_exit:
+                cli.run(args)
+                mocked_exit.assert_called_once_with(0)
+            with open(stats_json) as f:
+                summary = json.load(f)
+        finally:
+            shutil.rmtree(output_dir)
+        self.assertEqual(summary["total_bytes"], 1025)
+        self.assertEqual(summary["num_blocks"], 4)
+        self.assertEqual(
+            [(block["transfer"], block["size"]) for block in summary["blocks"]],
+            [(0, 1000), (0, 10), (1, 10), (1, 5)])
+
     def test_transfer_with_cli_stdout(self):
         test_instances = [
             TestUrlInstance(url="/data1", data=b"data1"),
@@ -250,6 +645,24 @@ class TestSubprocessCli(ServerTest):
             data = f.read()
         self.assertEqual(data, self.stored_data)
 
+    @unittest.skipIf(IS_WINDOWS, "Pipe tests don't make sense on windows")
+    def test_transfer_with_cli_pipe_retry(self):
+        test_instances = [
+            TestUrlInstance(url="/data1", data=b"x" * 1024, truncate_first=True),
+            TestUrlInstance(url="/data2", data=b"y" * 1024, truncate_first=True)
+        ]
+        self.httpd.test_instances = test_instances
+        cmd = [
+            sys.executable, "htsget_dev.py", TestRequestHandler.ticket_url,
+            "--retry-wait", "0", "| cat"]
+        with open(self.output_file, "wb") as stdout:
+            subprocess.check_call(" ".join(cmd), shell=True, stdout=stdout)
+        with open(self.output_file, "rb") as f:
+            data = f.read()
+        self.assertEqual(data, self.stored_data)
+        for instance in test_instances:
+            self.assertEqual(len(instance.requests), 2)
+
     # TODO we should have a range of different errors here and verify that we
     # do actually print out the returned error message.
     def test_cli_error(self):
@@ -296,6 +709,19 @@ class TestErrorHandling(ServerTest):
             exceptions.ClientError, htsget.get,
             TestRequestHandler.ticket_url, self.output_file, max_retries=0)
 
+    def test_error_responses_closed(self):
+        for error_code, error in [
+                (500, exceptions.RetryableIOError), (401, exceptions.ClientError)]:
+            self.httpd.test_instances = [
+                TestUrlInstance(url="/fail1", data=b"", error_code=error_code)
+            ]
+            closed_statuses = closing_statuses()
+            with closed_statuses:
+                self.assertRaises(
+                    error, htsget.get, TestRequestHandler.ticket_url, self.output_file,
+                    max_retries=0)
+            self.assertEqual(closed_statuses.statuses, [error_code])
+
     def test_data_truncation(self):
         self.httpd.test_instances = [
             TestUrlInstance(url="/fail1", data=b"x" * 8192, truncate=True)
@@ -303,3 +729,317 @@ class TestErrorHandling(ServerTest):
         self.assertRaises(
             exceptions.ContentLengthMismatch, htsget.get,
             TestRequestHandler.ticket_url, self.output_file, max_retries=0)
+
+
+class TestResumeTransfers(ServerTest):
+    """
+    Test cases for resuming interrupted transfers using Range requests.
+    """
+    piece_size = 65536
+
+    def transfer(self, instance, **kwargs):
+        self.httpd.test_instances = [instance]
+        with mock.patch("time.sleep"):
+            htsget.get(
+                TestRequestHandler.ticket_url, self.output_file, max_retries=1,
+                **kwargs)
+        self.output_file.seek(0)
+        return self.output_file.read()
+
+    def test_resume(self):
+        data = bytes(bytearray(range(256))) * (4 * self.piece_size // 256)
+        instance = TestUrlInstance(
+            url="/data", data=data, truncate_first=True, supports_range=True,
+            etag='"abc"')
+        self.assertEqual(self.transfer(instance), data)
+        self.assertEqual(len(instance.requests), 2)
+        self.assertNotIn("Range", instance.requests[0])
+        self.assertEqual(
+            instance.requests[1]["Range"], "bytes={}-".format(len(data) // 2))
+        self.assertEqual(instance.requests[1]["If-Range"], '"abc"')
+
+    def test_resume_ticket_range(self):
+        size = 2 * self.piece_size
+        data = b"x" * size + b"y" * size
+        instance = TestUrlInstance(
+            url="/data", data=data, truncate_first=True, supports_range=True,
+            headers={"Range": "bytes={}-{}".format(size, 2 * size - 1)})
+        self.assertEqual(self.transfer(instance), b"y" * size)
+        self.assertEqual(
+            instance.requests[1]["Range"],
+            "bytes={}-{}".format(size + size // 2, 2 * size - 1))
+
+    def test_resume_ticket_range_changed(self):
+        size = 2 * self.piece_size
+        data = b"x" * size + b"y" * size
+        instance = TestUrlInstance(
+            url="/data", data=data, truncate_first=True, supports_range=True,
+            etag='"1"', changed_etag='"2"',
+            headers={"Range": "bytes={}-{}".format(size, 2 * size - 1)})
+        self.httpd.test_instances = [instance]
+        with mock.patch("time.sleep"):
+            htsget.get(TestRequestHandler.ticket_url, self.output_file, max_retries=2)
+        self.output_file.seek(0)
+        self.assertEqual(self.output_file.read(), b"y" * size)
+        self.assertEqual(len(instance.requests), 3)
+        self.assertEqual(instance.requests[1]["If-Range"], '"1"')
+        self.assertEqual(
+            instance.requests[2]["Range"], "bytes={}-{}".format(size, 2 * size - 1))
+        self.assertNotIn("If-Range", instance.requests[2])
+
+    def test_resume_changed_response_closed(self):
+        size = 2 * self.piece_size
+        instance = TestUrlInstance(
+            url="/data", data=b"x" * size + b"y" * size, truncate_first=True,
+            supports_range=True, etag='"1"', changed_etag='"2"',
+            headers={"Range": "bytes={}-{}".format(size, 2 * size - 1)})
+        self.httpd.test_instances = [instance]
+        closed_statuses = closing_statuses()
+        with closed_statuses, mock.patch("time.sleep"):
+            htsget.get(TestRequestHandler.ticket_url, self.output_file, max_retries=2)
+        # The full response to the ranged request is refused and closed.
+        self.assertIn(200, closed_statuses.statuses)
+        self.assertEqual(len(instance.requests), 3)
+
+    def test_resume_parallel(self):
+        data = b"1234" * self.piece_size
+        instance = TestUrlInstance(
+            url="/data", data=data, truncate_first=True, supports_range=True)
+        self.assertEqual(self.transfer(instance, parallelism=2), data)
+        self.assertEqual(
+            instance.requests[1]["Range"], "bytes={}-".format(len(data) // 2))
+
+    def test_resume_small_buffer(self):
+        data = bytes(bytearray(range(256))) * 11
+        instance = TestUrlInstance(
+            url="/data", data=data, truncate_first=True, supports_range=True)
+        self.assertEqual(self.transfer(instance, buffer_size=7), data)
+        self.assertEqual(
+            instance.requests[1]["Range"], "bytes={}-".format(len(data) // 2))
+
+    def test_resume_md5(self):
+        data = bytes(bytearray(range(256))) * 11
+        self.httpd.ticket_md5 = hashlib.md5(data).hexdigest()
+        for parallelism in [1, 2]:
+            instance = TestUrlInstance(
+                url="/data", data=data, truncate_first=True, supports_range=True)
+            self.output_file.seek(0)
+            self.output_file.truncate()
+            self.assertEqual(self.transfer(instance, parallelism=parallelism), data)
+            self.assertEqual(len(instance.requests), 2)
+
+    def test_resume_write_behind(self):
+        data = bytes(bytearray(range(256))) * 1024
+        for parallelism in [1, 2]:
+            instance = TestUrlInstance(
+                url="/data", data=data, truncate_first=True, supports_range=True)
+            self.output_file.seek(0)
+            self.output_file.truncate()
+            self.assertEqual(self.transfer(
+                instance, parallelism=parallelism, buffer_size=4096,
+                write_behind=8192), data)
+            self.assertEqual(len(instance.requests), 2)
+
+    def test_resume_preallocated(self):
+        data = bytes(bytearray(range(256))) * 64
+        instances = [
+            TestUrlInstance(
+                url="/data{}".format(j), data=data[j:], truncate_first=True,
+                supports_range=True)
+            for j in range(4)]
+        self.httpd.test_instances = instances
+        all_data = b"".join(instance.data for instance in instances)
+        self.httpd.ticket_md5 = hashlib.md5(all_data).hexdigest()
+        with mock.patch("time.sleep"):
+            digest = htsget.get(
+                TestRequestHandler.ticket_url, self.output_file, max_retries=1,
+                parallelism=2, preallocate=True)
+        self.assertEqual(digest, self.httpd.ticket_md5)
+        self.output_file.seek(0)
+        self.assertEqual(self.output_file.read(), all_data)
+        for instance in instances:
+            self.assertEqual(len(instance.requests), 2)
+            self.assertEqual(
+                instance.requests[1]["Range"],
+                "bytes={}-".format(len(instance.data) // 2))
+
+    def test_resume_events(self):
+        data = bytes(bytearray(range(256))) * 11
+        instance = TestUrlInstance(
+            url="/data", data=data, truncate_first=True, supports_range=True)
+        events = []
+        self.assertEqual(self.transfer(instance, listener=events.append), data)
+        first_bytes = [
+            event for event in events if event.event_type == protocol.EVENT_FIRST_BYTE]
+        self.assertEqual([event.attempt for event in first_bytes], [1, 2])
+        progress = sum(
+            event.size for event in events
+            if event.event_type == protocol.EVENT_PROGRESS)
+        self.assertEqual(progress, len(data))
+        retry, = [event for event in events if event.event_type == protocol.EVENT_RETRY]
+        self.assertIsInstance(retry.error, exceptions.TruncatedContentError)
+        block_end, = [
+            event for event in events if event.event_type == protocol.EVENT_BLOCK_END]
+        self.assertEqual(block_end.size, len(data))
+        self.assertEqual(block_end.attempt, 2)
+        self.assertEqual(events[-1].event_type, protocol.EVENT_TRANSFER_END)
+        self.assertEqual(events[-1].size, len(data))
+
+    def test_md5_mismatch(self):
+        self.httpd.ticket_md5 = hashlib.md5(b"other").hexdigest()
+        instance = TestUrlInstance(url="/data", data=b"data")
+        self.assertRaises(exceptions.MD5MismatchError, self.transfer, instance)
+
+    def test_resume_ticket(self):
+        instances = [
+            TestUrlInstance(url="/data{}".format(j), data=str(j).encode() * 1000)
+            for j in range(20)]
+        self.httpd.test_instances = instances
+        self.httpd.truncate_ticket = True
+        with mock.patch("time.sleep"):
+            htsget.get(
+                TestRequestHandler.ticket_url, self.output_file, max_retries=1)
+        self.output_file.seek(0)
+        self.assertEqual(
+            self.output_file.read(), b"".join(instance.data for instance in instances))
+        for instance in instances:
+            self.assertEqual(len(instance.requests), 1)
+
+    def test_range_ignored(self):
+        data = b"1234" * self.piece_size
+        instance = TestUrlInstance(url="/data", data=data, truncate_first=True)
+        self.assertEqual(self.transfer(instance), data)
+        self.assertEqual(len(instance.requests), 2)
+        self.assertIn("Range", instance.requests[1])
+
+
+class TestBlockCache(ServerTest):
+    """
+    Test cases for transfers using the block cache.
+    """
+    def setUp(self):
+        super(TestBlockCache, self).setUp()
+        self.cache_dir = tempfile.mkdtemp(prefix="htsget_cache_test_")
+        self.block_cache = htsget.cache.BlockCache(self.cache_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def transfer(self, instances, **kwargs):
+        self.httpd.test_instances = instances
+        with tempfile.TemporaryFile("wb+") as output:
+            htsget.get(
+                TestRequestHandler.ticket_url, output, max_retries=0,
+                block_cache=self.block_cache, **kwargs)
+            output.seek(0)
+            self.assertEqual(
+                output.read(), b"".join(instance.data for instance in instances))
+
+    def test_cached_blocks(self):
+        instances = [
+            TestUrlInstance(url="/data1", data=b"x" * 1000, etag='"1"'),
+            TestUrlInstance(url="/data2", data=b"y" * 1000, etag='"2"'),
+            TestUrlInstance(url="/data3", data=b"z" * 1000)
+        ]
+        self.transfer(instances)
+        for instance in instances:
+            self.assertNotIn("If-None-Match", instance.requests[0])
+        self.transfer(instances, parallelism=3)
+        self.assertEqual(instances[0].requests[1]["If-None-Match"], '"1"')
+        self.assertEqual(instances[1].requests[1]["If-None-Match"], '"2"')
+        # Blocks without an ETag cannot be validated, so are not cached.
+        self.assertNotIn("If-None-Match", instances[2].requests[1])
+
+    def test_changed_block(self):
+        instance = TestUrlInstance(url="/data1", data=b"x" * 1000, etag='"1"')
+        self.transfer([instance])
+        instance.data = b"y" * 100
+        instance.etag = '"2"'
+        self.transfer([instance])
+        self.transfer([instance])
+        self.assertEqual(instance.requests[2]["If-None-Match"], '"2"')
+
+    def test_ranges(self):
+        instance = TestUrlInstance(
+            url="/data", data=b"0123456789" * 50, etag='"1"',
+            headers={"Range": "bytes=0-499"})
+        self.transfer([instance])
+        # The same range expressed differently uses the same cache entry.
+        instance.headers = {"range": "bytes = 0-499"}
+        self.transfer([instance])
+        self.assertEqual(instance.requests[1]["If-None-Match"], '"1"')
+
+    def test_not_modified_response_closed(self):
+        instance = TestUrlInstance(url="/data1", data=b"x" * 1000, etag='"1"')
+        self.transfer([instance])
+        closed_statuses = closing_statuses()
+        with closed_statuses:
+            self.transfer([instance])
+        self.assertEqual(closed_statuses.statuses, [304])
+
+
+class TestTicketCache(ServerTest):
+    """
+    Test cases for transfers using the ticket cache.
+    """
+    def setUp(self):
+        super(TestTicketCache, self).setUp()
+        self.httpd.test_instances = [
+            TestUrlInstance(url="/data1", data=b"x" * 100),
+            TestUrlInstance(url="/data2", data=b"y" * 100)
+        ]
+        self.httpd.ticket_requests = []
+        self.httpd.ticket_headers = {}
+
+    def tearDown(self):
+        self.httpd.ticket_headers = {}
+
+    def transfer(self, ticket_cache, **kwargs):
+        with tempfile.TemporaryFile("wb+") as output:
+            htsget.get(
+                TestRequestHandler.ticket_url, output, max_retries=0,
+                ticket_cache=ticket_cache, **kwargs)
+            output.seek(0)
+            self.assertEqual(output.read(), b"x" * 100 + b"y" * 100)
+
+    def test_fresh_ticket(self):
+        ticket_cache = htsget.cache.TicketCache()
+        for _ in range(3):
+            self.transfer(ticket_cache)
+        self.assertEqual(len(self.httpd.ticket_requests), 1)
+        self.transfer(ticket_cache, bypass_ticket_cache=True)
+        self.assertEqual(len(self.httpd.ticket_requests), 2)
+
+    def test_auth_identity(self):
+        ticket_cache = htsget.cache.TicketCache()
+        self.transfer(ticket_cache, bearer_token="a")
+        self.transfer(ticket_cache, bearer_token="b")
+        self.transfer(ticket_cache, bearer_token="a")
+        self.assertEqual(len(self.httpd.ticket_requests), 2)
+
+    def test_no_store(self):
+        self.httpd.ticket_headers = {"Cache-Control": "no-store"}
+        ticket_cache = htsget.cache.TicketCache()
+        self.transfer(ticket_cache)
+        self.transfer(ticket_cache)
+        self.assertEqual(len(self.httpd.ticket_requests), 2)
+
+    def test_revalidation(self):
+        self.httpd.ticket_headers = {"Cache-Control": "max-age=0", "ETag": '"t1"'}
+        ticket_cache = htsget.cache.TicketCache()
+        self.transfer(ticket_cache)
+        self.transfer(ticket_cache)
+        self.transfer(ticket_cache)
+        self.assertEqual(len(self.httpd.ticket_requests), 3)
+        self.assertNotIn("If-None-Match", self.httpd.ticket_requests[0])
+        self.assertEqual(self.httpd.ticket_requests[1]["If-None-Match"], '"t1"')
+        self.assertEqual(self.httpd.ticket_requests[2]["If-None-Match"], '"t1"')
+
+    def test_not_modified_response_closed(self):
+        self.httpd.ticket_headers = {"Cache-Control": "max-age=0", "ETag": '"t1"'}
+        ticket_cache = htsget.cache.TicketCache()
+        self.transfer(ticket_cache)
+        closed_statuses = closing_statuses()
+        with closed_statuses:
+            self.transfer(ticket_cache)
+        self.assertEqual(closed_statuses.statuses, [304])
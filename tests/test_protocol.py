@@ -21,6 +21,7 @@ from __future__ import division
 
 import base64
 import collections
+import io
 import json
 import tempfile
 import unittest
@@ -34,7 +35,9 @@ from six.moves.urllib.parse import parse_qs
 import htsget.protocol as protocol
 import htsget.exceptions as exceptions
 
-EXAMPLE_URL = "http://example.com"
+from tests.util import (
+    EXAMPLE_URL, get_http_ticket, get_data_uri_ticket, get_ticket, range_descriptor,
+    TestDownloadManager, RetryCountDownloadManager)
 
 
 class TestManagerAbstractMethods(unittest.TestCase):
@@ -44,7 +47,9 @@ class TestManagerAbstractMethods(unittest.TestCase):
     def test_not_implemented(self):
         dm = protocol.DownloadManager(EXAMPLE_URL, None)
         self.assertRaises(NotImplementedError, dm._ticket_request)
-        self.assertRaises(NotImplementedError, dm._handle_http_url, {})
+        self.assertRaises(NotImplementedError, dm.run)
+        self.assertRaises(
+            NotImplementedError, dm._handle_http_url, EXAMPLE_URL, {}, None, None)
 
 
 class TestParseTicket(unittest.TestCase):
@@ -73,6 +78,475 @@ class TestParseTicket(unittest.TestCase):
             self.assertRaises(exceptions.InvalidJsonError, protocol.parse_ticket, text)
 
 
+class TestTicketDecoder(unittest.TestCase):
+    """
+    Tests for the incremental ticket decoder.
+    """
+    def decode(self, pieces):
+        decoder = protocol.TicketDecoder()
+        for piece in pieces:
+            decoder.feed(piece)
+        return decoder.close()
+
+    def test_simple_case(self):
+        content = {"urls": [{"url": "http://a.com"}]}
+        data = json.dumps({"htsget": content}).encode()
+        self.assertEqual(self.decode([data]), content)
+        pieces = [data[j: j + 1] for j in range(len(data))]
+        self.assertEqual(self.decode(pieces), content)
+
+    def test_split_multibyte_characters(self):
+        content = {"urls": [], "name": u"\u00e9\u4e2d"}
+        data = json.dumps({"htsget": content}, ensure_ascii=False).encode("utf-8")
+        pieces = [data[j: j + 1] for j in range(len(data))]
+        self.assertEqual(self.decode(pieces), content)
+
+    def test_leading_whitespace(self):
+        content = {"urls": []}
+        data = json.dumps({"htsget": content}).encode()
+        self.assertEqual(self.decode([b"  ", b"\n", b" " + data]), content)
+
+    def test_empty(self):
+        for pieces in [[], [b""], [b"   ", b"\n"]]:
+            self.assertRaises(exceptions.EmptyTicketError, self.decode, pieces)
+
+    def test_leading_json_error(self):
+        decoder = protocol.TicketDecoder()
+        decoder.feed(b"   ")
+        self.assertRaises(exceptions.InvalidLeadingJsonError, decoder.feed, b"  x{}")
+
+    def test_decode_error(self):
+        decoder = protocol.TicketDecoder()
+        self.assertRaises(exceptions.TicketDecodeError, decoder.feed, b"\xff" * 10)
+        decoder = protocol.TicketDecoder()
+        decoder.feed(b"{\xc3")
+        self.assertRaises(exceptions.TicketDecodeError, decoder.close)
+
+    def test_invalid_json(self):
+        self.assertRaises(exceptions.InvalidJsonError, self.decode, [b"{", b"xxx"])
+        for data in [b'{"htsget": {"urls": []}', b'{"htsget": {"urls": [}}']:
+            self.assertRaises(exceptions.InvalidJsonError, self.decode, [data])
+
+    def test_malformed(self):
+        for data in [b'{"htsget": []}', b'{"htsget": {"urls": {}}}', b'{"x": 1}']:
+            self.assertRaises(exceptions.MalformedJsonError, self.decode, [data])
+
+    def test_feed_returns_urls(self):
+        decoder = protocol.TicketDecoder()
+        self.assertEqual(decoder.feed(
+            b'{"htsget": {"format": "BAM", "urls": [{"url": "a"}, {"url": "b", '), [
+            {"url": "a"}])
+        self.assertEqual(decoder.feed(b'"headers": {"x": 1'), [])
+        self.assertEqual(decoder.feed(b'2}}, {"url": "c"}'), [
+            {"url": "b", "headers": {"x": 12}}, {"url": "c"}])
+        self.assertEqual(decoder.feed(b'], "size": 1'), [])
+        self.assertEqual(decoder.feed(b'5}}'), [])
+        self.assertEqual(decoder.close(), {
+            "format": "BAM", "size": 15, "urls": [
+                {"url": "a"}, {"url": "b", "headers": {"x": 12}}, {"url": "c"}]})
+
+    def test_split_numbers(self):
+        data = (
+            b'{"htsget": {"x": 1.5, "y": -2.25e-1, "z": 3E+2, '
+            b'"urls": [{"url": "a", "n": 10e-1}]}, "w": 12}')
+        for j in range(len(data) + 1):
+            self.assertEqual(self.decode([data[:j], data[j:]]), {
+                "x": 1.5, "y": -0.225, "z": 300.0, "urls": [{"url": "a", "n": 1.0}]})
+
+    def test_number_at_end_of_piece(self):
+        pieces = [b'{"htsget": {"x": 1.', b'5, "y": -1.', b'5e', b'2, "urls": []}}']
+        self.assertEqual(self.decode(pieces), {"x": 1.5, "y": -150.0, "urls": []})
+
+    def test_keep_urls(self):
+        urls = [{"url": "http://a.com/{}".format(j)} for j in range(10)]
+        data = json.dumps({"htsget": {"urls": urls, "md5": "x"}}).encode()
+        decoder = protocol.TicketDecoder(keep_urls=False)
+        received = []
+        for j in range(len(data)):
+            received.extend(decoder.feed(data[j: j + 1]))
+        self.assertEqual(decoder.close(), {"md5": "x"})
+        self.assertEqual(received + decoder.urls, urls)
+
+    def test_large_values(self):
+        headers = {"h{}".format(j): "v" * 10 for j in range(20000)}
+        urls = [
+            {"url": "data:;base64," + "x" * 2**20}, {"url": "a", "headers": headers},
+            {"url": "b"}]
+        data = json.dumps({"htsget": {"urls": urls}}).encode()
+        decoder = protocol.TicketDecoder()
+        raw_decode = mock.Mock(wraps=decoder.json_decoder.raw_decode)
+        decoder.json_decoder.raw_decode = raw_decode
+        for j in range(0, len(data), 1024):
+            decoder.feed(data[j: j + 1024])
+        self.assertEqual(decoder.close(), {"urls": urls})
+        # Incomplete values are not parsed again for every piece received.
+        self.assertLess(raw_decode.call_count, 100)
+
+
+class TestTicketStream(unittest.TestCase):
+    """
+    Tests for tracking the URL objects received from a streamed ticket.
+    """
+    def test_retry(self):
+        urls = [{"url": str(j)} for j in range(4)]
+        stream = protocol.TicketStream()
+        stream.start_attempt()
+        self.assertEqual([stream.is_new(url) for url in urls[:2]], [True, True])
+        stream.start_attempt()
+        self.assertEqual(
+            [stream.is_new(url) for url in urls], [False, False, True, True])
+        stream.end_attempt()
+        self.assertEqual(stream.num_urls, 4)
+
+    def test_changed(self):
+        stream = protocol.TicketStream()
+        stream.start_attempt()
+        stream.is_new({"url": "a"})
+        stream.is_new({"url": "b"})
+        stream.start_attempt()
+        stream.is_new({"url": "a"})
+        self.assertRaises(exceptions.TicketChangedError, stream.is_new, {"url": "c"})
+
+    def test_shorter(self):
+        stream = protocol.TicketStream()
+        stream.start_attempt()
+        stream.is_new({"url": "a"})
+        stream.start_attempt()
+        self.assertRaises(exceptions.TicketChangedError, stream.end_attempt)
+
+
+class TestBlockDescriptor(unittest.TestCase):
+    """
+    Tests for the compact representation of URL objects.
+    """
+    def test_range(self):
+        url_object = {"url": EXAMPLE_URL, "headers": {"range": "bytes=10-19", "a": "b"}}
+        descriptor = protocol.BlockDescriptor.parse(url_object)
+        self.assertEqual(descriptor.url, EXAMPLE_URL)
+        self.assertEqual(descriptor.range_start, 10)
+        self.assertEqual(descriptor.range_end, 19)
+        self.assertEqual(descriptor.header_items, (("a", "b"),))
+        self.assertEqual(descriptor.headers, {"Range": "bytes=10-19", "a": "b"})
+        descriptor = protocol.BlockDescriptor.parse(
+            {"url": EXAMPLE_URL, "headers": {"Range": "bytes=10-"}})
+        self.assertEqual((descriptor.range_start, descriptor.range_end), (10, None))
+        self.assertEqual(descriptor.to_url_object(), {
+            "url": EXAMPLE_URL, "headers": {"Range": "bytes=10-"}})
+
+    def test_unparsed_range(self):
+        headers = {"Range": "bytes=0-1,5-6"}
+        descriptor = protocol.BlockDescriptor.parse({"url": "x", "headers": headers})
+        self.assertIsNone(descriptor.range_start)
+        self.assertEqual(descriptor.headers, headers)
+
+    def test_no_headers(self):
+        for url_object in [{"url": "x"}, {"url": "x", "headers": {}}]:
+            descriptor = protocol.BlockDescriptor.parse(url_object)
+            self.assertEqual(descriptor.headers, {})
+            self.assertEqual(descriptor.to_url_object(), {"url": "x"})
+
+    def test_shared_headers(self):
+        header_cache = {}
+        descriptors = [
+            protocol.BlockDescriptor.parse({"url": str(j), "headers": {
+                "Authorization": "Bearer x", "Range": "bytes={}-{}".format(j, j)}},
+                header_cache)
+            for j in range(10)]
+        self.assertEqual(len(header_cache), 1)
+        for descriptor in descriptors:
+            self.assertIs(descriptor.header_items, descriptors[0].header_items)
+        self.assertEqual(
+            [d.range_start for d in descriptors], list(range(10)))
+        # Values that cannot be hashed are not shared.
+        descriptor = protocol.BlockDescriptor.parse(
+            {"url": "x", "headers": {"a": [1]}}, header_cache)
+        self.assertEqual(descriptor.headers, {"a": [1]})
+
+    def test_malformed(self):
+        for url_object in [{}, [], "x", {"url": "x", "headers": "y"}]:
+            self.assertRaises(
+                exceptions.MalformedJsonError, protocol.BlockDescriptor.parse,
+                url_object)
+
+    def test_slots(self):
+        descriptor = protocol.BlockDescriptor("x")
+        self.assertFalse(hasattr(descriptor, "__dict__"))
+
+
+class TestRangeCoalescer(unittest.TestCase):
+    """
+    Tests for merging the ranges of consecutive blocks.
+    """
+    def coalesce(self, descriptors, max_gap, max_size=protocol.COALESCE_MAX_SIZE):
+        return [
+            (d.url, d.range_start, d.range_end, d.gaps)
+            for d in protocol.coalesce_blocks(descriptors, max_gap, max_size)]
+
+    def test_contiguous(self):
+        descriptors = [range_descriptor("a", 10 * j, 10 * j + 9) for j in range(5)]
+        self.assertEqual(self.coalesce(descriptors, 0), [("a", 0, 49, ())])
+        self.assertEqual(
+            self.coalesce(descriptors, 0, max_size=20),
+            [("a", 0, 19, ()), ("a", 20, 39, ()), ("a", 40, 49, ())])
+
+    def test_gaps(self):
+        descriptors = [
+            range_descriptor("a", 0, 9), range_descriptor("a", 12, 19),
+            range_descriptor("a", 20, 29), range_descriptor("a", 35, 39),
+            range_descriptor("a", 50, 59)]
+        self.assertEqual(self.coalesce(descriptors, 5), [
+            ("a", 0, 39, ((10, 2), (30, 5))), ("a", 50, 59, ())])
+        self.assertEqual(self.coalesce(descriptors, 2), [
+            ("a", 0, 29, ((10, 2),)), ("a", 35, 39, ()), ("a", 50, 59, ())])
+
+    def test_not_merged(self):
+        descriptors = [
+            range_descriptor("a", 0, 9), range_descriptor("b", 10, 19),
+            range_descriptor("b", 15, 29), range_descriptor("b", 30, None),
+            range_descriptor("b", 40, 49), protocol.BlockDescriptor("b"),
+            range_descriptor("b", 50, 59, (("a", "b"),)),
+            range_descriptor("b", 60, 69, (("a", "c"),)),
+            range_descriptor("b", 5, 9)]
+        self.assertEqual(
+            self.coalesce(descriptors, 100),
+            [(d.url, d.range_start, d.range_end, ()) for d in descriptors])
+
+    def test_empty(self):
+        self.assertEqual(self.coalesce([], 0), [])
+
+    def test_negative_gap(self):
+        self.assertRaises(ValueError, protocol.RangeCoalescer, -1)
+
+
+class TestRetryPolicy(unittest.TestCase):
+    """
+    Tests for the retry policy.
+    """
+    def test_fixed(self):
+        policy = protocol.RetryPolicy(
+            max_retries=5, retry_wait=2, backoff=protocol.BACKOFF_FIXED)
+        self.assertEqual([policy.wait_time(j) for j in range(1, 7)], [2] * 5 + [None])
+
+    def test_exponential(self):
+        policy = protocol.RetryPolicy(max_retries=6, retry_wait=1, max_retry_wait=10)
+        self.assertEqual(
+            [policy.wait_time(j) for j in range(1, 8)], [1, 2, 4, 8, 10, 10, None])
+
+    def test_decorrelated(self):
+        policy = protocol.RetryPolicy(
+            max_retries=100, retry_wait=1, max_retry_wait=20,
+            backoff=protocol.BACKOFF_DECORRELATED)
+        previous_wait = None
+        for j in range(1, 101):
+            wait = policy.wait_time(j, previous_wait)
+            upper = 3 * (1 if previous_wait is None else previous_wait)
+            self.assertGreaterEqual(wait, 1)
+            self.assertLessEqual(wait, min(20, upper))
+            previous_wait = wait
+
+    def test_retry_after(self):
+        policy = protocol.RetryPolicy(retry_wait=1, max_retry_wait=10)
+        self.assertEqual(policy.wait_time(1, retry_after=30), 30)
+        self.assertEqual(policy.wait_time(3, retry_after=2), 4)
+
+    def test_retry_budget(self):
+        policy = protocol.RetryPolicy(max_retries=5, retry_wait=0, retry_budget=3)
+        self.assertEqual(policy.wait_time(1), 0)
+        self.assertEqual(policy.wait_time(1), 0)
+        self.assertEqual(policy.wait_time(2), 0)
+        with mock.patch("logging.warning"):
+            self.assertIsNone(policy.wait_time(1))
+
+    def test_retry_deadline(self):
+        with mock.patch("htsget.protocol.clock", return_value=100):
+            policy = protocol.RetryPolicy(retry_wait=5, retry_deadline=18)
+        with mock.patch("htsget.protocol.clock", return_value=110):
+            self.assertEqual(policy.wait_time(1), 5)
+            with mock.patch("logging.warning"):
+                self.assertIsNone(policy.wait_time(2))
+
+    def test_bad_backoff(self):
+        self.assertRaises(ValueError, protocol.RetryPolicy, backoff="xxx")
+
+    def test_parse_retry_after(self):
+        self.assertEqual(protocol.parse_retry_after("120"), 120)
+        self.assertEqual(protocol.parse_retry_after("-1"), 0)
+        self.assertIsNone(protocol.parse_retry_after("soon"))
+        now = 784111777 - 60
+        self.assertEqual(
+            protocol.parse_retry_after("Sun, 06 Nov 1994 08:49:37 GMT", now), 60)
+        self.assertEqual(
+            protocol.parse_retry_after("Sun, 06 Nov 1994 08:49:37 GMT", now + 120), 0)
+
+
+class TestRetryState(unittest.TestCase):
+    """
+    Tests for the retry state of a single transfer.
+    """
+    def test_rewinds_output(self):
+        output = io.BytesIO()
+        output.write(b"before")
+        retry_state = protocol.RetryState(output, protocol.RetryPolicy(
+            max_retries=2, retry_wait=3, backoff=protocol.BACKOFF_FIXED))
+        for j in range(2):
+            output.write(b"partial data")
+            with mock.patch("logging.warning"):
+                wait = retry_state.handle_error(exceptions.RetryableError())
+                self.assertEqual(wait, 3)
+            self.assertEqual(retry_state.num_retries, j + 1)
+            self.assertEqual(output.getvalue(), b"before")
+            self.assertEqual(output.tell(), len(b"before"))
+        error = exceptions.RetryableError()
+        self.assertRaises(exceptions.RetryableError, retry_state.handle_error, error)
+
+    def test_unseekable_output(self):
+        output = io.BytesIO()
+        output.tell = mock.Mock(side_effect=IOError())
+        retry_state = protocol.RetryState(
+            output, protocol.RetryPolicy(max_retries=10, retry_wait=3))
+        self.assertIsNone(retry_state.position)
+        error = exceptions.RetryableError()
+        self.assertRaises(exceptions.RetryableError, retry_state.handle_error, error)
+
+
+class TestRanges(unittest.TestCase):
+    """
+    Tests for the Range header utilities.
+    """
+    def test_parse_range(self):
+        self.assertEqual(protocol.parse_range("bytes=0-100"), (0, 100))
+        self.assertEqual(protocol.parse_range("bytes=10-"), (10, None))
+        self.assertEqual(protocol.parse_range(" BYTES = 5 - 6 "), (5, 6))
+        for bad_value in ["", "bytes=-100", "bytes=1-2,4-5", "items=1-2", "bytes=a-"]:
+            self.assertIsNone(protocol.parse_range(bad_value))
+
+    def test_format_range(self):
+        self.assertEqual(protocol.format_range(0, 100), "bytes=0-100")
+        self.assertEqual(protocol.format_range(10), "bytes=10-")
+
+    def test_resume_headers(self):
+        headers = {"a": "b"}
+        resumed = protocol.resume_headers(headers, 100)
+        self.assertEqual(resumed, {"a": "b", "Range": "bytes=100-"})
+        self.assertEqual(headers, {"a": "b"})
+        resumed = protocol.resume_headers({"range": "bytes=100-199"}, 50, '"etag"')
+        self.assertEqual(resumed, {"Range": "bytes=150-199", "If-Range": '"etag"'})
+        self.assertIsNone(protocol.resume_headers({"Range": "bytes=1-2,5-6"}, 1))
+
+
+class TestRetryStateResume(unittest.TestCase):
+    """
+    Tests for resuming transfers using the retry state.
+    """
+    def get_interrupted_state(self, response_headers):
+        output = io.BytesIO()
+        output.write(b"before")
+        retry_state = protocol.RetryState(
+            output, protocol.RetryPolicy(max_retries=5, retry_wait=0))
+        retry_state.handle_response(200, response_headers)
+        output.write(b"partial")
+        with mock.patch("logging.warning"):
+            retry_state.handle_error(exceptions.RetryableIOError(Exception()))
+        return retry_state
+
+    def test_resume(self):
+        retry_state = self.get_interrupted_state({"ETag": '"x"'})
+        self.assertEqual(retry_state.offset, len(b"partial"))
+        self.assertEqual(retry_state.output.getvalue(), b"beforepartial")
+        self.assertEqual(
+            retry_state.request_headers({"Range": "bytes=10-100"}),
+            {"Range": "bytes=17-100", "If-Range": '"x"'})
+        retry_state.handle_response(206, {"ETag": '"x"'})
+        self.assertEqual(retry_state.output.getvalue(), b"beforepartial")
+
+    def test_validators(self):
+        retry_state = self.get_interrupted_state({})
+        self.assertIsNone(retry_state.validator)
+        self.assertNotIn("If-Range", retry_state.request_headers({}))
+        retry_state = self.get_interrupted_state({"Last-Modified": "yesterday"})
+        self.assertEqual(retry_state.validator, "yesterday")
+        retry_state = self.get_interrupted_state(
+            {"Last-Modified": "yesterday", "ETag": 'W/"weak"'})
+        self.assertEqual(retry_state.validator, "yesterday")
+
+    def test_range_ignored(self):
+        for status_code in [200, 416]:
+            retry_state = self.get_interrupted_state({})
+            retry_state.handle_response(status_code, {})
+            self.assertEqual(retry_state.offset, 0)
+            self.assertEqual(retry_state.output.getvalue(), b"before")
+
+    def test_multiple_ranges(self):
+        retry_state = self.get_interrupted_state({})
+        headers = {"Range": "bytes=1-2,5-6"}
+        self.assertEqual(retry_state.request_headers(headers), headers)
+        self.assertEqual(retry_state.offset, 0)
+        self.assertEqual(retry_state.output.getvalue(), b"before")
+
+    def test_server_error_keeps_data(self):
+        retry_state = self.get_interrupted_state({})
+        retry_state.handle_response(503, {})
+        self.assertEqual(retry_state.offset, len(b"partial"))
+
+    def test_resource_changed(self):
+        retry_state = self.get_interrupted_state({"ETag": '"x"'})
+        self.assertRaises(
+            exceptions.ResourceChangedError, retry_state.handle_response, 206,
+            {"ETag": '"y"'})
+        self.assertEqual(retry_state.offset, 0)
+        self.assertEqual(retry_state.output.getvalue(), b"before")
+
+    def test_ranged_resource_changed(self):
+        retry_state = self.get_interrupted_state({"ETag": '"x"'})
+        self.assertEqual(
+            retry_state.request_headers({"Range": "bytes=100-299"}),
+            {"Range": "bytes=107-299", "If-Range": '"x"'})
+        # The whole changed resource is returned, which must not be written.
+        self.assertRaises(
+            exceptions.ResourceChangedError, retry_state.handle_response, 200,
+            {"ETag": '"y"'})
+        self.assertEqual(retry_state.offset, 0)
+        self.assertEqual(retry_state.output.getvalue(), b"before")
+        self.assertEqual(
+            retry_state.request_headers({"Range": "bytes=100-299"}),
+            {"Range": "bytes=100-299"})
+
+    def test_not_resumable(self):
+        for headers in [{"Accept-Ranges": "none"}, None]:
+            output = io.BytesIO()
+            retry_state = protocol.RetryState(
+                output, protocol.RetryPolicy(max_retries=5, retry_wait=0))
+            if headers is not None:
+                retry_state.handle_response(200, headers)
+            output.write(b"partial")
+            with mock.patch("logging.warning"):
+                retry_state.handle_error(exceptions.RetryableError())
+            self.assertEqual(retry_state.offset, 0)
+            self.assertEqual(output.getvalue(), b"")
+
+    def test_content_length_mismatch_restarts(self):
+        output = io.BytesIO()
+        retry_state = protocol.RetryState(
+            output, protocol.RetryPolicy(max_retries=5, retry_wait=0))
+        retry_state.handle_response(200, {})
+        output.write(b"partial")
+        with mock.patch("logging.warning"):
+            retry_state.handle_error(exceptions.ContentLengthMismatch())
+        self.assertEqual(retry_state.offset, 0)
+        self.assertEqual(output.getvalue(), b"")
+
+    def test_truncated_content_resumes(self):
+        output = io.BytesIO()
+        retry_state = protocol.RetryState(
+            output, protocol.RetryPolicy(max_retries=5, retry_wait=0))
+        retry_state.handle_response(200, {})
+        output.write(b"partial")
+        with mock.patch("logging.warning"):
+            retry_state.handle_error(exceptions.TruncatedContentError())
+        self.assertEqual(retry_state.offset, 7)
+        self.assertEqual(output.getvalue(), b"partial")
+
+
 class TestTicketRequestUrls(unittest.TestCase):
     """
     Tests the ticket request generator.
@@ -156,47 +630,190 @@ class TestTicketRequestUrls(unittest.TestCase):
         self.assertEqual(query["referenceName"], ["123"])
 
 
-def get_http_ticket(url, headers={}):
-    return {"url": url, "headers": headers}
+class TestTicketRequestBodies(unittest.TestCase):
+    """
+    Tests for the bodies of POST ticket requests.
+    """
+    def test_regions(self):
+        body = protocol.ticket_request_body(
+            [("chr1", 10, 20), ("chr2", None, None), ("chr3", 5, None)])
+        self.assertEqual(body, {"regions": [
+            {"referenceName": "chr1", "start": 10, "end": 20},
+            {"referenceName": "chr2"}, {"referenceName": "chr3", "start": 5}]})
+
+    def test_format(self):
+        body = protocol.ticket_request_body([("1", None, None)], data_format="cram")
+        self.assertEqual(body["format"], "CRAM")
 
+    def test_class(self):
+        body = protocol.ticket_request_body([("1", None, None)], request_class="header")
+        self.assertEqual(body["class"], "header")
+        self.assertNotIn("class", protocol.ticket_request_body([("1", None, None)]))
+        self.assertRaises(
+            ValueError, protocol.ticket_request_body, [("1", None, None)],
+            request_class="x")
 
-def get_data_uri_ticket(url):
-    return {"url": url}
+    def test_no_reference_name(self):
+        self.assertRaises(
+            ValueError, protocol.ticket_request_body, [(None, 1, 2)])
 
+    def test_manager(self):
+        dm = protocol.DownloadManager(
+            "http://example.com/reads/x?a=b", None, data_format="bam",
+            regions=[["1", 10, 20], ("2", None, None)])
+        self.assertEqual(dm.ticket_post_url, "http://example.com/reads/x?a=b")
+        self.assertEqual(dm.ticket_request_body["regions"][0]["referenceName"], "1")
+        self.assertEqual(len(dm.region_request_urls), 2)
+        query = parse_qs(urlparse(dm.region_request_urls[0]).query)
+        self.assertEqual(query, {
+            "a": ["b"], "format": ["BAM"], "referenceName": ["1"], "start": ["10"],
+            "end": ["20"]})
+        self.assertIsNone(protocol.DownloadManager(EXAMPLE_URL, None).ticket_post_url)
 
-def get_ticket(urls=[], format_=None, md5=None):
-    d = {"urls": urls}
-    if format_ is not None:
-        d["format"] = format_
-    if md5 is not None:
-        d["md5"] = md5
-    return d
+    def test_manager_single_region(self):
+        for kwargs in [{"reference_name": "1"}, {"start": 1}, {"reference_md5": "x"}]:
+            self.assertRaises(
+                ValueError, protocol.DownloadManager, EXAMPLE_URL, None,
+                regions=[("1", None, None)], **kwargs)
 
 
-class TestDownloadManager(protocol.DownloadManager):
+class TestRequestClasses(unittest.TestCase):
     """
-    Test download manager that stores a ticket.
+    Tests for requesting classes of data.
     """
-    def __init__(self, test_ticket, output, **kwargs):
-        super(TestDownloadManager, self).__init__(EXAMPLE_URL, output, **kwargs)
-        self.test_ticket = test_ticket
+    def get_ticket(self):
+        return get_ticket(urls=[
+            {"url": "data:,h", "class": "header"}, {"url": "data:,b", "class": "body"},
+            {"url": "data:,x"}])
+
+    def test_url(self):
+        for request_class in protocol.REQUEST_CLASSES:
+            url = protocol.ticket_request_url(EXAMPLE_URL, request_class=request_class)
+            self.assertEqual(parse_qs(urlparse(url).query), {"class": [request_class]})
+        url = protocol.ticket_request_url(EXAMPLE_URL)
+        self.assertNotIn("class", parse_qs(urlparse(url).query))
+
+    def test_unknown_class(self):
+        for request_class in ["", "Header", "all"]:
+            self.assertRaises(
+                ValueError, protocol.ticket_request_url, EXAMPLE_URL,
+                request_class=request_class)
+            self.assertRaises(
+                ValueError, protocol.DownloadManager, EXAMPLE_URL, None,
+                request_class=request_class)
+
+    def test_labelled_blocks_selected(self):
+        for request_class, data in [
+                (None, b"hbx"), ("header", b"hx"), ("body", b"bx")]:
+            output = io.BytesIO()
+            dm = TestDownloadManager(
+                self.get_ticket(), output, request_class=request_class)
+            dm.run()
+            self.assertEqual(output.getvalue(), data)
+
+
+class TestMergeTickets(unittest.TestCase):
+    """
+    Tests for merging the tickets for several regions.
+    """
+    def test_merge(self):
+        header = get_data_uri_ticket("data:,header")
+        tickets = [
+            {"format": "CRAM", "md5": "x", "urls": [
+                header, get_http_ticket("http://a.com", {"Range": "bytes=0-9"})]},
+            {"urls": [header, get_http_ticket("http://a.com", {"Range": "bytes=0-9"})]},
+            {"format": "BAM", "urls": [
+                get_data_uri_ticket("data:,header"),
+                get_http_ticket("http://a.com", {"Range": "bytes=10-19"})]}]
+        merged = protocol.merge_tickets(tickets)
+        self.assertEqual(merged, {"format": "CRAM", "urls": [
+            header, get_http_ticket("http://a.com", {"Range": "bytes=0-9"}),
+            get_http_ticket("http://a.com", {"Range": "bytes=10-19"})]})
+
+    def test_trailer(self):
+        header = get_data_uri_ticket("data:,header")
+        eof = get_data_uri_ticket("data:,eof")
+        blocks = [
+            get_http_ticket("http://a.com", {"Range": "bytes={}-{}".format(j, j + 9)})
+            for j in [0, 10, 20]]
+        tickets = [
+            {"urls": [header, blocks[0], blocks[1], eof]},
+            {"urls": [header, blocks[1], eof]},
+            {"urls": [header, blocks[2], eof]}]
+        self.assertEqual(
+            protocol.merge_tickets(tickets)["urls"], [header] + blocks + [eof])
+        # A single ticket is unchanged.
+        self.assertEqual(
+            protocol.merge_tickets(tickets[:1])["urls"], tickets[0]["urls"])
+        # The header is never moved to the end.
+        tickets = [{"urls": [header, eof]}, {"urls": [header, eof]}]
+        self.assertEqual(protocol.merge_tickets(tickets)["urls"], [header, eof])
 
-    def _handle_ticket_request(self):
-        self.ticket = self.test_ticket
+    def test_empty(self):
+        self.assertEqual(protocol.merge_tickets([]), {"urls": []})
+
+
+class TestFieldsAndTags(unittest.TestCase):
+    """
+    Tests for requesting fields and tags of read records.
+    """
+    def get_query(self, **kwargs):
+        url = protocol.ticket_request_url(EXAMPLE_URL, **kwargs)
+        return parse_qs(urlparse(url).query, keep_blank_values=True)
+
+    def test_url(self):
+        query = self.get_query(
+            fields=["qname", "FLAG"], tags=["MD", "NM"], notags=["OQ"])
+        self.assertEqual(query, {
+            "fields": ["QNAME,FLAG"], "tags": ["MD,NM"], "notags": ["OQ"]})
+
+    def test_no_tags(self):
+        self.assertEqual(self.get_query(tags=[]), {"tags": [""]})
+        self.assertEqual(self.get_query(), {})
+
+    def test_body(self):
+        body = protocol.ticket_request_body(
+            [("1", None, None)], fields=("SEQ",), tags=[], notags=["OQ", "MM"])
+        self.assertEqual(body["fields"], ["SEQ"])
+        self.assertEqual(body["tags"], [])
+        self.assertEqual(body["notags"], ["OQ", "MM"])
+        self.assertNotIn("fields", protocol.ticket_request_body([("1", None, None)]))
+
+    def test_invalid(self):
+        for kwargs in [
+                {"fields": ["QNAME", "XYZ"]}, {"fields": "QNAME"}, {"tags": "MD"},
+                {"tags": ["M"]}, {"tags": ["1A"]}, {"notags": ["MDX"]},
+                {"notags": [1]}, {"tags": ["MD", "NM"], "notags": ["NM"]},
+                {"fields": ["POS"], "data_format": "vcf"},
+                {"notags": ["MD"], "data_format": "BCF"}]:
+            self.assertRaises(
+                ValueError, protocol.ticket_request_url, EXAMPLE_URL, **kwargs)
+            self.assertRaises(
+                ValueError, protocol.DownloadManager, EXAMPLE_URL, None, **kwargs)
+
+    def test_manager(self):
+        dm = protocol.DownloadManager(
+            EXAMPLE_URL, None, fields=["POS"], notags=["OQ"],
+            regions=[("1", None, None)])
+        query = parse_qs(urlparse(dm.ticket_request_url).query)
+        self.assertEqual(query, {"fields": ["POS"], "notags": ["OQ"]})
+        self.assertEqual(dm.ticket_request_body["fields"], ["POS"])
+        query = parse_qs(urlparse(dm.region_request_urls[0]).query)
+        self.assertEqual(query["notags"], ["OQ"])
 
 
 class StoringUrlsDownloadManager(TestDownloadManager):
     """
     Simple implementation of the DownloadManager that just saves the URLs.
     """
-    def __init__(self, test_ticket, output):
-        super(StoringUrlsDownloadManager, self).__init__(test_ticket, output)
+    def __init__(self, test_ticket, output, **kwargs):
+        super(StoringUrlsDownloadManager, self).__init__(test_ticket, output, **kwargs)
         self.stored_urls = []
 
-    def _handle_data_uri(self, parsed_url):
+    def _handle_data_uri(self, parsed_url, output):
         self.stored_urls.append(parsed_url)
 
-    def _handle_http_url(self, url, headers):
+    def _handle_http_url(self, url, headers, output, retry_state):
         self.stored_urls.append((url, headers))
 
 
@@ -221,6 +838,17 @@ class TestTicketResponses(unittest.TestCase):
             dm.run()
         self.assertEqual(dm.stored_urls[0], (EXAMPLE_URL, headers))
 
+    def test_keep_ticket(self):
+        headers = {"Range": "bytes=0-10"}
+        ticket = get_ticket(urls=[get_http_ticket(EXAMPLE_URL, headers)], format_="CRAM")
+        dm = StoringUrlsDownloadManager(ticket, io.BytesIO())
+        dm.run()
+        self.assertEqual(dm.ticket, {"format": "CRAM"})
+        self.assertEqual(dm.stored_urls[0], (EXAMPLE_URL, headers))
+        dm = StoringUrlsDownloadManager(ticket, io.BytesIO(), keep_ticket=True)
+        dm.run()
+        self.assertEqual(dm.ticket, ticket)
+
     def test_basic_data_uri_parsing(self):
         data_uri = "data:application/vnd.ga4gh.bam;base64,SGVsbG8sIFdvcmxkIQ=="
         ticket = get_ticket(urls=[get_data_uri_ticket(data_uri)])
@@ -245,19 +873,62 @@ class TestDataUriParsing(unittest.TestCase):
             other_data = base64.b64decode("SGVsbG8sIFdvcmxkIQ==")
             self.assertEqual(data, other_data)
 
-    # TODO much more tests here with input data. Also need to test the various
-    # chunks of the parser.
+    def decode(self, uri, piece_size):
+        return b"".join(protocol.DataUri(uri).pieces(piece_size))
 
+    def test_base64_pieces(self):
+        data = bytes(bytearray(range(256))) * 10
+        uri = "data:application/vnd.ga4gh.bam;base64," + base64.b64encode(
+            data).decode()
+        for piece_size in [1, 4, 5, 7, 64, 10000]:
+            self.assertEqual(self.decode(uri, piece_size), data)
+        pieces = list(protocol.DataUri(uri).pieces(64))
+        self.assertGreater(len(pieces), 1)
+        self.assertLessEqual(max(len(piece) for piece in pieces), 64)
+        self.assertEqual(protocol.DataUri(uri).size(7), len(data))
 
-class RetryCountDownloadManager(TestDownloadManager):
+    def test_base64_whitespace_and_escapes(self):
+        encoded = base64.b64encode(b"hello, world!").decode()
+        self.assertEqual(encoded[-2:], "==")
+        uri = "data:;base64," + encoded[:5] + " \n" + encoded[5:-2] + "%3D%3d"
+        for piece_size in [4, 5, 6, 100]:
+            self.assertEqual(self.decode(uri, piece_size), b"hello, world!")
 
-    def __init__(self, test_ticket, output, **kwargs):
-        super(RetryCountDownloadManager, self).__init__(test_ticket, output, **kwargs)
-        self.attempt_counts = collections.Counter()
+    def test_percent_encoded(self):
+        uri = "data:text/plain;charset=utf-8,a%20b%C3%A9%2C%25,x"
+        for piece_size in [4, 5, 6, 7, 100]:
+            self.assertEqual(
+                self.decode(uri, piece_size), u"a b\u00e9,%,x".encode("utf-8"))
 
-    def _handle_http_url(self, url, headers):
-        self.attempt_counts[url] += 1
-        raise exceptions.RetryableError()
+    def test_media_type(self):
+        data_uri = protocol.DataUri("DATA:Application/VND.ga4gh.BAM;base64,")
+        self.assertEqual(data_uri.media_type, "application/vnd.ga4gh.bam")
+        self.assertTrue(data_uri.base64)
+        self.assertEqual(data_uri.parameters, {})
+        data_uri = protocol.DataUri('data:text/plain;Charset="utf-8";x=a%20b,abc')
+        self.assertEqual(data_uri.media_type, "text/plain")
+        self.assertFalse(data_uri.base64)
+        self.assertEqual(data_uri.parameters, {"charset": "utf-8", "x": "a b"})
+        data_uri = protocol.DataUri("data:,abc")
+        self.assertEqual(data_uri.media_type, "text/plain")
+        self.assertEqual(data_uri.parameters, {"charset": "US-ASCII"})
+        self.assertEqual(b"".join(data_uri.pieces()), b"abc")
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, protocol.DataUri, "data:text/plain")
+        self.assertRaises(ValueError, protocol.DataUri, "http://x.com/,y")
+        self.assertRaises(ValueError, self.decode, "data:;base64,abcde", 10)
+        self.assertRaises(ValueError, self.decode, "data:;base64,ab%2", 10)
+
+    def test_percent_encoded_block(self):
+        data_uri = "data:application/vnd.ga4gh.bam,%00%01abc%ff"
+        ticket = get_ticket(urls=[get_data_uri_ticket(data_uri)])
+        output = io.BytesIO()
+        events = []
+        dm = TestDownloadManager(ticket, output, listener=events.append)
+        dm.run()
+        self.assertEqual(output.getvalue(), b"\x00\x01abc\xff")
+        self.assertEqual(events[-1].size, 6)
 
 
 class FailingChunkDownloadManager(TestDownloadManager):
@@ -267,13 +938,13 @@ class FailingChunkDownloadManager(TestDownloadManager):
         self.attempt_counts = collections.Counter()
         self.data_map = data_map
 
-    def _handle_http_url(self, url, headers):
+    def _handle_http_url(self, url, headers, output, retry_state):
         self.attempt_counts[url] += 1
         if self.attempt_counts[url] == 1:
-            self.output.write("gibberish" * 100)
+            output.write("gibberish" * 100)
             raise exceptions.RetryableError()
         else:
-            self.output.write(self.data_map[url])
+            output.write(self.data_map[url])
 
 
 class TestRetries(unittest.TestCase):
@@ -322,6 +993,33 @@ class TestRetries(unittest.TestCase):
                 self.assertEqual(real_data, temp_file.read())
                 self.assertEqual(mock_sleep.call_count, len(data_map) * 1)
 
+    def test_retry_after(self):
+        ticket = get_ticket(urls=[get_http_ticket(EXAMPLE_URL)])
+
+        class RetryAfterDownloadManager(RetryCountDownloadManager):
+            def _handle_http_url(self, url, headers, output, retry_state):
+                self.attempt_counts[url] += 1
+                error = exceptions.RetryableError()
+                error.retry_after = 100
+                raise error
+
+        with tempfile.TemporaryFile("w+") as temp_file:
+            with mock.patch("time.sleep") as mock_sleep:
+                dm = RetryAfterDownloadManager(
+                    ticket, temp_file, max_retries=2, retry_wait=1)
+                self.assertRaises(exceptions.RetryableError, dm.run)
+                self.assertEqual(mock_sleep.call_args_list, [mock.call(100)] * 2)
+
+    def test_retry_budget(self):
+        ticket = get_ticket(urls=[get_http_ticket(EXAMPLE_URL)])
+        with tempfile.TemporaryFile("w+") as temp_file:
+            with mock.patch("time.sleep") as mock_sleep:
+                dm = RetryCountDownloadManager(
+                    ticket, temp_file, max_retries=10, retry_budget=3)
+                self.assertRaises(exceptions.RetryableError, dm.run)
+                self.assertEqual(dm.attempt_counts[EXAMPLE_URL], 4)
+                self.assertEqual(mock_sleep.call_count, 3)
+
     def test_unseekable_file(self):
         def tell_fails():
             raise IOError()
@@ -335,6 +1033,7 @@ class TestRetries(unittest.TestCase):
                     ticket, temp_file, max_retries=num_retries)
                 self.assertEqual(dm.max_retries, num_retries)
                 self.assertRaises(exceptions.RetryableError, dm.run)
-                self.assertEqual(dm.attempt_counts[EXAMPLE_URL], 1)
-                self.assertEqual(mock_sleep.call_count, 0)
-                self.assertEqual(mock_warning.call_count, 0)
+                # Blocks are spooled, so retries do not rewind the output.
+                self.assertEqual(dm.attempt_counts[EXAMPLE_URL], num_retries + 1)
+                self.assertEqual(mock_sleep.call_count, num_retries)
+                self.assertEqual(mock_warning.call_count, num_retries)
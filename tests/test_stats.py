@@ -0,0 +1,171 @@
+#
+# Copyright 2016-2017 University of Oxford
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Test cases for the transfer statistics.
+"""
+from __future__ import print_function
+from __future__ import division
+
+import json
+import unittest
+
+import htsget.exceptions as exceptions
+import htsget.protocol as protocol
+import htsget.stats as stats
+
+EXAMPLE_URL = "http://example.com/data?token=secret"
+
+
+def event(event_type, time, **kwargs):
+    return protocol.TransferEvent(event_type, time, **kwargs)
+
+
+class TestPercentile(unittest.TestCase):
+    """
+    Tests for the percentile calculation.
+    """
+    def test_empty(self):
+        self.assertIsNone(stats.percentile([], 50))
+
+    def test_nearest_rank(self):
+        values = list(range(1, 101))
+        self.assertEqual(stats.percentile(values, 50), 50)
+        self.assertEqual(stats.percentile(values, 99), 99)
+        self.assertEqual(stats.percentile(values, 100), 100)
+        self.assertEqual(stats.percentile([1, 2, 3], 50), 2)
+        self.assertEqual(stats.percentile([5], 90), 5)
+
+
+class TestTransferStats(unittest.TestCase):
+    """
+    Tests for collecting statistics from transfer events.
+    """
+    def get_events(self):
+        return [
+            event(protocol.EVENT_TICKET_START, 10, url=EXAMPLE_URL),
+            event(protocol.EVENT_RETRY, 10.1, error=exceptions.RetryableError("x")),
+            event(protocol.EVENT_TICKET_END, 10.5, url=EXAMPLE_URL, duration=0.5),
+            event(protocol.EVENT_BLOCK_START, 10.5, block=0, url=EXAMPLE_URL),
+            event(protocol.EVENT_BLOCK_START, 10.5, block=1),
+            event(protocol.EVENT_BLOCK_END, 10.5, block=1, size=10, duration=0),
+            event(protocol.EVENT_FIRST_BYTE, 10.75, block=0, attempt=1),
+            event(protocol.EVENT_PROGRESS, 10.75, block=0, size=2**20),
+            event(
+                protocol.EVENT_RETRY, 10.8, block=0, attempt=1,
+                error=exceptions.TruncatedContentError("short"), wait=0),
+            event(protocol.EVENT_FIRST_BYTE, 10.9, block=0, attempt=2),
+            event(protocol.EVENT_PROGRESS, 10.9, block=0, size=2**20),
+            event(
+                protocol.EVENT_BLOCK_END, 11.5, block=0, url=EXAMPLE_URL,
+                size=2**21, duration=1, attempt=2),
+            event(protocol.EVENT_TRANSFER_END, 11.5, size=2**21 + 10, duration=1.5)]
+
+    def test_summary(self):
+        transfer_stats = stats.TransferStats()
+        for e in self.get_events():
+            transfer_stats(e)
+        summary = transfer_stats.summary()
+        # The summary must be serialisable as JSON.
+        json.dumps(summary)
+        self.assertEqual(summary["ticket"]["duration"], 0.5)
+        self.assertEqual(summary["ticket"]["retries"], 1)
+        self.assertEqual(summary["num_blocks"], 2)
+        self.assertEqual(summary["total_bytes"], 2**21 + 10)
+        self.assertEqual(summary["wall_time"], 1.5)
+        self.assertEqual(summary["time_to_first_byte"], 0.75)
+        self.assertEqual(summary["retries"], 2)
+        self.assertEqual(summary["hedged_blocks"], 0)
+        self.assertIsNone(summary["error"])
+        block = summary["blocks"][0]
+        self.assertEqual(block["host"], "example.com")
+        self.assertEqual(block["size"], 2**21)
+        self.assertEqual(block["duration"], 1)
+        self.assertEqual(block["throughput_mib_s"], 2)
+        self.assertEqual(block["time_to_first_byte"], 0.25)
+        self.assertEqual(block["retries"], 1)
+        self.assertEqual(block["retry_errors"], ["TruncatedContentError: short"])
+        block = summary["blocks"][1]
+        self.assertIsNone(block["host"])
+        self.assertIsNone(block["throughput_mib_s"])
+        self.assertIsNone(block["time_to_first_byte"])
+        self.assertEqual(
+            summary["block_duration_percentiles"],
+            {"p50": 0, "p90": 1, "p99": 1, "max": 1})
+        self.assertNotIn("secret", json.dumps(summary))
+
+    def test_hedged(self):
+        transfer_stats = stats.TransferStats()
+        for e in [
+                event(protocol.EVENT_BLOCK_START, 0, block=0, url=EXAMPLE_URL),
+                event(protocol.EVENT_HEDGE, 1, block=0, url=EXAMPLE_URL, duration=1),
+                event(protocol.EVENT_BLOCK_START, 1, block=0, url=EXAMPLE_URL),
+                event(protocol.EVENT_FIRST_BYTE, 1.5, block=0, attempt=1),
+                event(protocol.EVENT_BLOCK_END, 2, block=0, size=10, duration=1),
+                event(
+                    protocol.EVENT_BLOCK_END, 3, block=0, size=0, duration=3,
+                    error=ValueError("abandoned")),
+                event(protocol.EVENT_TRANSFER_END, 3, size=10, duration=3)]:
+            transfer_stats(e)
+        summary = transfer_stats.summary()
+        self.assertEqual(summary["num_blocks"], 1)
+        self.assertEqual(summary["hedged_blocks"], 1)
+        block = summary["blocks"][0]
+        self.assertTrue(block["hedged"])
+        self.assertEqual(block["size"], 10)
+        self.assertEqual(block["duration"], 1)
+        self.assertEqual(block["time_to_first_byte"], 1.5)
+        self.assertIsNone(block["error"])
+
+    def test_several_transfers(self):
+        transfer_stats = stats.TransferStats()
+        for transfer, (start, size) in enumerate([(0, 1010), (1, 15)]):
+            for e in [
+                    event(protocol.EVENT_TICKET_END, start + 1, duration=1),
+                    event(protocol.EVENT_BLOCK_START, start + 1, block=0),
+                    event(protocol.EVENT_BLOCK_END, start + 2, block=0, size=size,
+                          duration=1),
+                    event(protocol.EVENT_TRANSFER_END, start + 2, size=size,
+                          duration=2)]:
+                e.transfer = transfer
+                transfer_stats(e)
+        summary = transfer_stats.summary()
+        self.assertEqual(summary["num_blocks"], 2)
+        self.assertEqual(
+            [(block["transfer"], block["size"]) for block in summary["blocks"]],
+            [(0, 1010), (1, 15)])
+        self.assertEqual(summary["total_bytes"], 1025)
+        self.assertEqual(summary["wall_time"], 3)
+        self.assertEqual(summary["ticket"]["duration"], 1)
+
+    def test_failure(self):
+        transfer_stats = stats.TransferStats()
+        error = exceptions.ClientError("404", "not found")
+        transfer_stats(event(protocol.EVENT_TICKET_START, 0, url=EXAMPLE_URL))
+        transfer_stats(event(
+            protocol.EVENT_TICKET_END, 1, url=EXAMPLE_URL, duration=1, error=error))
+        transfer_stats(event(
+            protocol.EVENT_TRANSFER_END, 1, size=0, duration=1, error=error))
+        summary = transfer_stats.summary()
+        self.assertEqual(summary["ticket"]["error"], "ClientError: 404:not found")
+        self.assertEqual(summary["error"], "ClientError: 404:not found")
+        self.assertEqual(summary["blocks"], [])
+        self.assertIsNone(summary["time_to_first_byte"])
+        self.assertIsNone(summary["block_duration_percentiles"]["max"])
+
+    def test_empty(self):
+        summary = stats.TransferStats().summary()
+        self.assertIsNone(summary["wall_time"])
+        self.assertEqual(summary["num_blocks"], 0)
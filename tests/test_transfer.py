@@ -0,0 +1,1162 @@
+#
+# Copyright 2016 University of Oxford
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Test cases for scheduling the blocks of transfers and writing them to the output.
+"""
+from __future__ import print_function
+from __future__ import division
+
+import collections
+import hashlib
+import io
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+import mock
+
+from six import StringIO
+
+import htsget.protocol as protocol
+import htsget.transfer as transfer
+import htsget.exceptions as exceptions
+
+from tests.util import (
+    EXAMPLE_URL, get_http_ticket, get_data_uri_ticket, get_ticket, range_descriptor,
+    TestDownloadManager, RetryCountDownloadManager)
+
+
+class TestGapSkippingOutput(unittest.TestCase):
+    """
+    Tests for discarding the bytes in the gaps between coalesced ranges.
+    """
+    def test_write(self):
+        data = b"0123456789abcdefghij"
+        gaps = ((0, 2), (5, 3), (12, 1), (19, 1))
+        expected = b"234" + b"89ab" + b"defghi"
+        for piece_size in range(1, len(data) + 1):
+            output = io.BytesIO()
+            output.write(b"x")
+            gap_output = transfer.GapSkippingOutput(output, gaps)
+            for j in range(0, len(data), piece_size):
+                gap_output.write(data[j: j + piece_size])
+            self.assertEqual(gap_output.tell(), 1 + len(data))
+            self.assertEqual(output.getvalue(), b"x" + expected)
+
+    def test_seek(self):
+        output = io.BytesIO()
+        gap_output = transfer.GapSkippingOutput(output, ((2, 3),))
+        gap_output.write(b"0123456")
+        self.assertEqual(output.getvalue(), b"0156")
+        gap_output.seek(4)
+        gap_output.truncate()
+        self.assertEqual(output.getvalue(), b"01")
+        gap_output.write(b"456")
+        self.assertEqual(output.getvalue(), b"0156")
+        gap_output.seek(1)
+        gap_output.truncate()
+        gap_output.write(b"123456")
+        self.assertEqual(output.getvalue(), b"0156")
+        self.assertEqual(gap_output.tell(), 7)
+
+
+class ParallelDownloadManager(TestDownloadManager):
+    """
+    Download manager that writes the data for each URL after a delay, failing
+    the first attempt for the URLs in the specified set.
+    """
+    def __init__(self, test_ticket, output, data_map, failing=(), **kwargs):
+        super(ParallelDownloadManager, self).__init__(test_ticket, output, **kwargs)
+        self.attempt_counts = collections.Counter()
+        self.data_map = data_map
+        self.failing = set(failing)
+
+    def _handle_http_url(self, url, headers, output, retry_state):
+        self.attempt_counts[url] += 1
+        data = self.data_map[url]
+        # Make the earlier blocks finish last.
+        time.sleep(0.001 * (len(self.data_map) - int(url.split("/")[-1])))
+        if url in self.failing and self.attempt_counts[url] == 1:
+            self._received(retry_state, 900)
+            output.write(b"gibberish" * 100)
+            raise exceptions.RetryableError()
+        self._received(retry_state, len(data))
+        output.write(data)
+
+
+class StreamingDownloadManager(ParallelDownloadManager):
+    """
+    Download manager that streams the ticket, only completing it once the
+    first block has started. The first attempt to read the ticket fails
+    after the specified number of URL objects if fail_after is given.
+    """
+    def __init__(self, *args, **kwargs):
+        self.fail_after = kwargs.pop("fail_after", None)
+        super(StreamingDownloadManager, self).__init__(*args, **kwargs)
+        self.block_started = threading.Event()
+        self.ticket_attempts = 0
+
+    def _streams_ticket(self):
+        return True
+
+    def _handle_http_url(self, url, headers, output, retry_state):
+        self.block_started.set()
+        super(StreamingDownloadManager, self)._handle_http_url(
+            url, headers, output, retry_state)
+
+    def _handle_ticket_request(self, consume=None):
+        self.ticket_attempts += 1
+        for j, url_object in enumerate(self.test_ticket["urls"]):
+            if self.ticket_attempts == 1 and j == self.fail_after:
+                raise exceptions.RetryableError()
+            consume(url_object)
+        if not self.block_started.wait(5):
+            raise AssertionError("No block started while reading the ticket")
+        self.ticket = {"format": "BAM"}
+
+
+class TestStreamingTicket(unittest.TestCase):
+    """
+    Tests for downloading blocks while the ticket is received.
+    """
+    def run_manager(self, num_urls, **kwargs):
+        data_map = collections.OrderedDict(
+            ("http://url.com/{}".format(j), str(j).encode() * (j + 1))
+            for j in range(num_urls))
+        ticket = get_ticket(urls=[get_http_ticket(url) for url in data_map.keys()])
+        output = io.BytesIO()
+        events = []
+        dm = StreamingDownloadManager(
+            ticket, output, data_map, retry_wait=0, listener=events.append, **kwargs)
+        dm.run()
+        self.assertEqual(output.getvalue(), b"".join(data_map.values()))
+        self.assertEqual(dm.data_format, "BAM")
+        event_types = [event.event_type for event in events]
+        self.assertLess(
+            event_types.index(protocol.EVENT_BLOCK_START),
+            event_types.index(protocol.EVENT_TICKET_END))
+        return dm
+
+    def test_sequential(self):
+        self.run_manager(5)
+
+    def test_parallel(self):
+        self.run_manager(20, parallelism=4)
+
+    def test_retry(self):
+        for parallelism in [1, 3]:
+            dm = self.run_manager(6, fail_after=3, parallelism=parallelism)
+            self.assertEqual(dm.ticket_attempts, 2)
+            self.assertEqual(set(dm.attempt_counts.values()), {1})
+
+    def test_keep_ticket(self):
+        dm = self.run_manager(3, fail_after=2)
+        self.assertEqual(dm.ticket, {"format": "BAM"})
+        dm = self.run_manager(3, fail_after=2, keep_ticket=True)
+        self.assertEqual(dm.ticket["urls"], dm.test_ticket["urls"])
+
+    def test_failure(self):
+        data_map = {"http://url.com/0": b"0", "http://url.com/1": b"1"}
+        ticket = get_ticket(urls=[get_http_ticket(url) for url in data_map.keys()])
+        dm = StreamingDownloadManager(
+            ticket, io.BytesIO(), data_map, fail_after=1, max_retries=0)
+        dm.block_started.set()
+        self.assertRaises(exceptions.RetryableError, dm.run)
+
+    def test_blocks_selected(self):
+        ticket = get_ticket(urls=[
+            {"url": "data:,h", "class": "header"}, {"url": "data:,b", "class": "body"},
+            {"url": "data:,x"}])
+        output = io.BytesIO()
+        dm = StreamingDownloadManager(ticket, output, {}, request_class="header")
+        dm.block_started.set()
+        dm.run()
+        self.assertEqual(output.getvalue(), b"hx")
+
+
+class TestParallelDownloads(unittest.TestCase):
+    """
+    Tests for downloading blocks concurrently.
+    """
+    def get_data_map(self, num_urls):
+        return collections.OrderedDict(
+            ("http://url.com/{}".format(j), str(j).encode() * (j + 1))
+            for j in range(num_urls))
+
+    def test_ticket_order(self):
+        data_map = self.get_data_map(20)
+        ticket = get_ticket(urls=[get_http_ticket(url) for url in data_map.keys()])
+        for parallelism in [1, 2, 5, 30]:
+            with tempfile.TemporaryFile("wb+") as temp_file:
+                dm = ParallelDownloadManager(
+                    ticket, temp_file, data_map, parallelism=parallelism)
+                dm.run()
+                temp_file.seek(0)
+                self.assertEqual(temp_file.read(), b"".join(data_map.values()))
+
+    def test_data_uris(self):
+        data_map = self.get_data_map(5)
+        urls = [get_http_ticket(url) for url in data_map.keys()]
+        data_uri = "data:application/vnd.ga4gh.bam;base64,SGVsbG8sIFdvcmxkIQ=="
+        urls.insert(2, get_data_uri_ticket(data_uri))
+        ticket = get_ticket(urls=urls)
+        values = list(data_map.values())
+        values.insert(2, b"Hello, World!")
+        with tempfile.TemporaryFile("wb+") as temp_file:
+            dm = ParallelDownloadManager(ticket, temp_file, data_map, parallelism=3)
+            dm.run()
+            temp_file.seek(0)
+            self.assertEqual(temp_file.read(), b"".join(values))
+
+    def test_independent_retries(self):
+        data_map = self.get_data_map(10)
+        failing = list(data_map.keys())[3:5]
+        ticket = get_ticket(urls=[get_http_ticket(url) for url in data_map.keys()])
+        with tempfile.TemporaryFile("wb+") as temp_file:
+            dm = ParallelDownloadManager(
+                ticket, temp_file, data_map, failing=failing, parallelism=4,
+                retry_wait=0)
+            dm.run()
+            temp_file.seek(0)
+            self.assertEqual(temp_file.read(), b"".join(data_map.values()))
+        for url in data_map.keys():
+            self.assertEqual(dm.attempt_counts[url], 2 if url in failing else 1)
+
+    def test_unseekable_output(self):
+        data_map = self.get_data_map(5)
+        failing = list(data_map.keys())[:1]
+        ticket = get_ticket(urls=[get_http_ticket(url) for url in data_map.keys()])
+
+        output = io.BytesIO()
+        output.tell = mock.Mock(side_effect=IOError())
+        with mock.patch("time.sleep"):
+            dm = ParallelDownloadManager(
+                ticket, output, data_map, failing=failing, parallelism=2)
+            dm.run()
+        self.assertEqual(output.getvalue(), b"".join(data_map.values()))
+
+    def test_failure(self):
+        data_map = self.get_data_map(10)
+        ticket = get_ticket(urls=[get_http_ticket(url) for url in data_map.keys()])
+        with tempfile.TemporaryFile("wb+") as temp_file:
+            with mock.patch("time.sleep"):
+                dm = RetryCountDownloadManager(
+                    ticket, temp_file, max_retries=2, parallelism=3)
+                self.assertRaises(exceptions.RetryableError, dm.run)
+            self.assertEqual(dm.attempt_counts[list(data_map.keys())[0]], 3)
+
+    def test_unseekable_file_spooled(self):
+        def tell_fails():
+            raise IOError()
+        data_map = collections.OrderedDict(
+            ("http://url.com/{}".format(j), str(j).encode() * (j + 10))
+            for j in range(4))
+        failing = list(data_map.keys())[1:3]
+        ticket = get_ticket(urls=[get_http_ticket(url) for url in data_map.keys()])
+        data = b"".join(data_map.values())
+        for write_behind in [None, 16]:
+            output = io.BytesIO()
+            output.tell = tell_fails
+            output.seek = mock.Mock(side_effect=IOError())
+            with mock.patch("time.sleep"):
+                dm = ParallelDownloadManager(
+                    ticket, output, data_map, failing=failing,
+                    write_behind=write_behind)
+                dm.run()
+            self.assertEqual(output.getvalue(), data)
+            self.assertEqual(dm.digest, hashlib.md5(data).hexdigest())
+            for url in data_map.keys():
+                self.assertEqual(dm.attempt_counts[url], 2 if url in failing else 1)
+
+
+class TestDigestOutput(unittest.TestCase):
+    """
+    Tests for computing the digest of the data written to an output.
+    """
+    def test_write(self):
+        output = io.BytesIO()
+        digest_output = transfer.DigestOutput(output)
+        digest_output.write(b"abc")
+        digest_output.write(memoryview(b"def"))
+        self.assertEqual(output.getvalue(), b"abcdef")
+        self.assertEqual(
+            digest_output.hexdigest(), hashlib.md5(b"abcdef").hexdigest())
+
+    def test_rewind_to_checkpoint(self):
+        output = io.BytesIO()
+        digest_output = transfer.DigestOutput(output)
+        digest_output.write(b"abc")
+        digest_output.checkpoint()
+        digest_output.write(b"gibberish")
+        digest_output.seek(3)
+        digest_output.truncate()
+        digest_output.write(b"def")
+        self.assertEqual(output.getvalue(), b"abcdef")
+        self.assertEqual(
+            digest_output.hexdigest(), hashlib.md5(b"abcdef").hexdigest())
+
+    def test_resume(self):
+        digest_output = transfer.DigestOutput(io.BytesIO())
+        digest_output.checkpoint()
+        digest_output.write(b"abc")
+        digest_output.flush()
+        digest_output.seek(digest_output.tell())
+        digest_output.write(b"def")
+        self.assertEqual(
+            digest_output.hexdigest(), hashlib.md5(b"abcdef").hexdigest())
+
+    def test_rewind_elsewhere(self):
+        digest_output = transfer.DigestOutput(io.BytesIO())
+        digest_output.checkpoint()
+        digest_output.write(b"abcdef")
+        digest_output.seek(2)
+        self.assertIsNone(digest_output.hexdigest())
+
+    def test_unseekable_output(self):
+        output = io.BytesIO()
+        output.tell = mock.Mock(side_effect=IOError())
+        digest_output = transfer.DigestOutput(output)
+        digest_output.checkpoint()
+        digest_output.write(b"abc")
+        self.assertEqual(digest_output.hexdigest(), hashlib.md5(b"abc").hexdigest())
+
+    def test_text_output(self):
+        digest_output = transfer.DigestOutput(StringIO())
+        digest_output.write(u"abc")
+        self.assertIsNone(digest_output.hexdigest())
+
+
+class SlowOutput(io.BytesIO):
+    """
+    Output that records the number of bytes queued by the specified writer
+    before each write, and waits until the event is set before writing.
+    """
+    def __init__(self):
+        super(SlowOutput, self).__init__()
+        self.writer = None
+        self.queued = []
+        self.event = threading.Event()
+
+    def write(self, data):
+        self.event.wait(5)
+        self.queued.append(self.writer.queued)
+        return super(SlowOutput, self).write(data)
+
+
+class TestWriteBehindOutput(unittest.TestCase):
+    """
+    Tests for writing to the output on a separate thread.
+    """
+    def test_write(self):
+        output = io.BytesIO()
+        writer = transfer.WriteBehindOutput(output, 100)
+        pieces = [str(j).encode() * 10 for j in range(100)]
+        for piece in pieces:
+            writer.write(piece)
+        self.assertEqual(writer.tell(), sum(len(piece) for piece in pieces))
+        writer.close()
+        self.assertEqual(output.getvalue(), b"".join(pieces))
+        self.assertRaises(ValueError, writer.write, b"x")
+
+    def test_max_size(self):
+        output = SlowOutput()
+        writer = transfer.WriteBehindOutput(output, 25)
+        output.writer = writer
+        output.event.set()
+        for j in range(50):
+            writer.write(b"x" * 10)
+        writer.write(b"y" * 100)
+        writer.close()
+        self.assertEqual(output.getvalue(), b"x" * 500 + b"y" * 100)
+        self.assertLessEqual(max(output.queued), 100)
+        self.assertLessEqual(max(output.queued[:50]), 20)
+
+    def test_buffer_copied(self):
+        output = io.BytesIO()
+        output.write(b"abc")
+        writer = transfer.WriteBehindOutput(output, 100)
+        self.assertEqual(writer.tell(), 3)
+        buf = bytearray(b"1234")
+        writer.write(memoryview(buf))
+        buf[:] = b"xxxx"
+        writer.write(buf)
+        writer.close()
+        self.assertEqual(output.getvalue(), b"abc1234xxxx")
+
+    def test_seek(self):
+        output = SlowOutput()
+        writer = transfer.WriteBehindOutput(output, 2**20)
+        output.writer = writer
+        writer.write(b"12345")
+        writer.write(b"6789")
+        self.assertEqual(writer.tell(), 9)
+        output.event.set()
+        writer.seek(4)
+        writer.truncate()
+        self.assertEqual(writer.tell(), 4)
+        writer.write(b"abc")
+        writer.flush()
+        self.assertEqual(output.getvalue(), b"1234abc")
+        writer.close()
+
+    def test_error(self):
+        output = mock.Mock()
+        output.tell.side_effect = IOError()
+        output.write.side_effect = IOError("disk full")
+        writer = transfer.WriteBehindOutput(output, 100)
+        writer.write(b"x")
+        self.assertRaises(IOError, writer.drain)
+        self.assertRaises(IOError, writer.write, b"y")
+        self.assertRaises(IOError, writer.close)
+        self.assertEqual(output.write.call_count, 1)
+
+    def test_error_during_other_error(self):
+        class FailingOutput(io.BytesIO):
+            def write(self, data):
+                raise IOError("disk full")
+
+        class WritingDownloadManager(TestDownloadManager):
+            def __init__(self, test_ticket, output, error=None, **kwargs):
+                super(WritingDownloadManager, self).__init__(
+                    test_ticket, output, **kwargs)
+                self.error = error
+
+            def _handle_http_url(self, url, headers, output, retry_state):
+                output.write(b"x")
+                if self.error is not None:
+                    raise self.error
+
+        ticket = get_ticket(urls=[get_http_ticket(EXAMPLE_URL)])
+        dm = WritingDownloadManager(ticket, FailingOutput(), write_behind=100)
+        self.assertRaises(IOError, dm.run)
+        # The error writing the output does not replace the one stopping the
+        # transfer.
+        dm = WritingDownloadManager(
+            ticket, FailingOutput(), exceptions.ClientError("not found", ""),
+            write_behind=100)
+        self.assertRaises(exceptions.ClientError, dm.run)
+
+    def test_not_seekable(self):
+        output = mock.Mock()
+        output.tell.side_effect = IOError()
+        writer = transfer.WriteBehindOutput(output, 100)
+        writer.write(b"x")
+        self.assertRaises(IOError, writer.tell)
+        writer.close()
+        output.write.assert_called_once_with(b"x")
+
+    def test_bad_size(self):
+        self.assertRaises(ValueError, transfer.WriteBehindOutput, io.BytesIO(), 0)
+
+    def test_retries(self):
+        data_map = collections.OrderedDict(
+            ("http://url.com/{}".format(j), str(j).encode() * (j + 100))
+            for j in range(5))
+        failing = list(data_map.keys())[1:3]
+        ticket = get_ticket(urls=[get_http_ticket(url) for url in data_map.keys()])
+        data = b"".join(data_map.values())
+        for parallelism in [1, 3]:
+            output = io.BytesIO()
+            with mock.patch("logging.warning"):
+                dm = ParallelDownloadManager(
+                    ticket, output, data_map, failing=failing,
+                    parallelism=parallelism, retry_wait=0, write_behind=150)
+                dm.run()
+            self.assertEqual(output.getvalue(), data)
+            self.assertEqual(dm.digest, hashlib.md5(data).hexdigest())
+            output = io.BytesIO()
+            dm = ResumingDownloadManager(
+                ticket, output, data_map, parallelism=parallelism, retry_wait=0,
+                write_behind=150)
+            dm.run()
+            self.assertEqual(output.getvalue(), data)
+
+
+class TestPositionalOutput(unittest.TestCase):
+    """
+    Tests for writing blocks at their offsets in a file.
+    """
+    def test_write(self):
+        with tempfile.TemporaryFile("wb+") as f:
+            fd = f.fileno()
+            transfer.preallocate(fd, 0, 12)
+            self.assertEqual(os.fstat(fd).st_size, 12)
+            second = transfer.PositionalOutput(fd, 6, 6)
+            second.write(b"world!")
+            first = transfer.PositionalOutput(fd, 0, 6)
+            first.write(b"hex")
+            first.seek(1)
+            first.truncate()
+            self.assertEqual(first.tell(), 1)
+            first.write(memoryview(b"ello "))
+            self.assertEqual(first.tell(), 6)
+            self.assertRaises(exceptions.ContentLengthMismatch, first.write, b"x")
+            self.assertRaises(ValueError, first.seek, 0, 2)
+            f.seek(0)
+            self.assertEqual(f.read(), b"hello world!")
+            self.assertEqual(
+                transfer.file_md5(fd, 6, 6, buffer_size=4).hexdigest(),
+                hashlib.md5(b"world!").hexdigest())
+
+    def test_preallocate_empty(self):
+        with tempfile.TemporaryFile("wb+") as f:
+            transfer.preallocate(f.fileno(), 0, 0)
+            self.assertEqual(os.fstat(f.fileno()).st_size, 0)
+
+    def test_preallocate_unsupported(self):
+        with tempfile.TemporaryFile("wb+") as f, \
+                mock.patch("os.posix_fallocate", side_effect=OSError(), create=True):
+            transfer.preallocate(f.fileno(), 5, 10)
+            self.assertEqual(os.fstat(f.fileno()).st_size, 15)
+
+
+class PositionalDownloadManager(TestDownloadManager):
+    """
+    Download manager that reports the sizes of blocks in its data map in
+    response to HEAD requests, and records the outputs blocks are written to.
+    """
+    def __init__(self, test_ticket, output, data_map, head_sizes=True, **kwargs):
+        super(PositionalDownloadManager, self).__init__(test_ticket, output, **kwargs)
+        self.data_map = data_map
+        self.head_sizes = head_sizes
+        self.outputs = []
+        self.attempt_counts = collections.Counter()
+
+    def _head_size(self, url, headers):
+        return len(self.data_map[url]) if self.head_sizes else None
+
+    def _handle_http_url(self, url, headers, output, retry_state):
+        self.attempt_counts[url] += 1
+        self.outputs.append(output)
+        data = self.data_map[url]
+        if self.attempt_counts[url] == 1 and url.endswith("1"):
+            output.write(b"x" * 3)
+            raise exceptions.RetryableError()
+        output.write(data)
+
+
+class TestPositionalDownloads(unittest.TestCase):
+    """
+    Tests for writing blocks in parallel at their offsets in the output.
+    """
+    def get_ticket(self, data_map):
+        urls = []
+        for j, (url, data) in enumerate(data_map.items()):
+            headers = {}
+            if j % 2 == 0:
+                headers["Range"] = "bytes=0-{}".format(len(data) - 1)
+            urls.append(get_http_ticket(url, headers))
+        data_uri = "data:application/vnd.ga4gh.bam;base64,SGVsbG8sIFdvcmxkIQ=="
+        urls.insert(1, get_data_uri_ticket(data_uri))
+        values = list(data_map.values())
+        values.insert(1, b"Hello, World!")
+        data = b"".join(values)
+        return get_ticket(urls=urls, md5=hashlib.md5(data).hexdigest()), data
+
+    def run_manager(self, num_urls, **kwargs):
+        data_map = collections.OrderedDict(
+            ("http://url.com/{}".format(j), str(j).encode() * (j + 10))
+            for j in range(num_urls))
+        ticket, data = self.get_ticket(data_map)
+        with tempfile.TemporaryFile("wb+") as f:
+            f.write(b"prefix")
+            with mock.patch("logging.warning"):
+                dm = PositionalDownloadManager(
+                    ticket, f, data_map, parallelism=3, preallocate=True,
+                    retry_wait=0, **kwargs)
+                dm.run()
+            self.assertEqual(f.tell(), 6 + len(data))
+            f.seek(0)
+            self.assertEqual(f.read(), b"prefix" + data)
+        self.assertEqual(dm.digest, hashlib.md5(data).hexdigest())
+        self.assertEqual(dm.attempt_counts["http://url.com/1"], 2)
+        return dm
+
+    def test_positional(self):
+        dm = self.run_manager(8)
+        for output in dm.outputs:
+            self.assertIsInstance(output, transfer.PositionalOutput)
+
+    def test_unknown_sizes(self):
+        dm = self.run_manager(8, head_sizes=False)
+        for output in dm.outputs:
+            self.assertNotIsInstance(output, transfer.PositionalOutput)
+
+    def test_not_regular_file(self):
+        data_map = {"http://url.com/0": b"0" * 10}
+        ticket, data = self.get_ticket(data_map)
+        output = io.BytesIO()
+        dm = PositionalDownloadManager(
+            ticket, output, data_map, parallelism=2, preallocate=True)
+        dm.run()
+        self.assertEqual(output.getvalue(), data)
+        self.assertNotIsInstance(dm.outputs[0], transfer.PositionalOutput)
+
+    def test_size_mismatch(self):
+        data_map = {"http://url.com/0": b"0" * 10}
+        ticket = get_ticket(urls=[get_http_ticket(
+            "http://url.com/0", {"Range": "bytes=0-19"})])
+        with tempfile.TemporaryFile("wb+") as f:
+            dm = PositionalDownloadManager(
+                ticket, f, data_map, parallelism=2, preallocate=True)
+            self.assertRaises(exceptions.ContentLengthMismatch, dm.run)
+
+    def test_open_range(self):
+        dm = PositionalDownloadManager(
+            get_ticket(), io.BytesIO(), {"http://u": b"x" * 10})
+        descriptor = protocol.BlockDescriptor("http://u", (), 4, None)
+        self.assertEqual(dm._block_size(descriptor), 6)
+        descriptor = protocol.BlockDescriptor("ftp://u")
+        self.assertIsNone(dm._block_size(descriptor))
+
+
+class RangeDownloadManager(TestDownloadManager):
+    """
+    Download manager that returns the requested ranges of the resources in
+    the specified map, failing the first request for the specified (url,
+    range) tuple after writing half of the data, and records the requests.
+    """
+    def __init__(self, test_ticket, output, resources, failing=None, **kwargs):
+        super(RangeDownloadManager, self).__init__(test_ticket, output, **kwargs)
+        self.resources = resources
+        self.failing = failing
+        self.requests = []
+
+    def _handle_http_url(self, url, headers, output, retry_state):
+        headers = retry_state.request_headers(headers)
+        request = (url, headers["Range"])
+        first = request not in self.requests
+        self.requests.append(request)
+        start, end = protocol.parse_range(headers["Range"])
+        retry_state.handle_response(206, {"ETag": '"x"'})
+        data = self.resources[url][start: end + 1]
+        if request == self.failing and first:
+            output.write(data[:len(data) // 2])
+            raise exceptions.TruncatedContentError()
+        output.write(data)
+
+
+class TestCoalescedDownloads(unittest.TestCase):
+    """
+    Tests for downloading blocks with coalesced ranges.
+    """
+    def get_ticket(self):
+        resources = {
+            "http://a.com/x": bytes(bytearray(range(256))),
+            "http://a.com/y": b"y" * 100}
+        ranges = [
+            ("http://a.com/x", 0, 9), ("http://a.com/x", 10, 19),
+            ("http://a.com/x", 25, 99), ("http://a.com/x", 100, 199),
+            ("http://a.com/y", 0, 49), ("http://a.com/x", 200, 255),
+            ("http://a.com/y", 60, 99)]
+        urls = [
+            get_http_ticket(url, {"Range": "bytes={}-{}".format(start, end)})
+            for url, start, end in ranges]
+        data = b"".join(
+            resources[url][start: end + 1] for url, start, end in ranges)
+        return get_ticket(urls=urls, md5=hashlib.md5(data).hexdigest()), resources, data
+
+    def test_coalesced(self):
+        ticket, resources, data = self.get_ticket()
+        for parallelism in [1, 2]:
+            output = io.BytesIO()
+            dm = RangeDownloadManager(
+                ticket, output, resources, coalesce_gap=5, parallelism=parallelism)
+            dm.run()
+            self.assertEqual(output.getvalue(), data)
+            self.assertEqual(sorted(dm.requests), [
+                ("http://a.com/x", "bytes=0-199"), ("http://a.com/x", "bytes=200-255"),
+                ("http://a.com/y", "bytes=0-49"), ("http://a.com/y", "bytes=60-99")])
+
+    def test_not_coalesced(self):
+        ticket, resources, data = self.get_ticket()
+        output = io.BytesIO()
+        dm = RangeDownloadManager(ticket, output, resources)
+        dm.run()
+        self.assertEqual(output.getvalue(), data)
+        self.assertEqual(len(dm.requests), 7)
+
+    def test_resume(self):
+        ticket, resources, data = self.get_ticket()
+        for parallelism in [1, 2]:
+            output = io.BytesIO()
+            with mock.patch("logging.warning"):
+                dm = RangeDownloadManager(
+                    ticket, output, resources,
+                    failing=("http://a.com/x", "bytes=0-199"),
+                    coalesce_gap=5, parallelism=parallelism, retry_wait=0)
+                dm.run()
+            self.assertEqual(output.getvalue(), data)
+            self.assertEqual(dm.digest, hashlib.md5(data).hexdigest())
+            self.assertIn(("http://a.com/x", "bytes=100-199"), dm.requests)
+            self.assertEqual(len(dm.requests), 5)
+
+    def test_positional(self):
+        ticket, resources, data = self.get_ticket()
+        with tempfile.TemporaryFile("wb+") as f:
+            dm = RangeDownloadManager(
+                ticket, f, resources, coalesce_gap=5, parallelism=2,
+                preallocate=True)
+            dm.run()
+            f.seek(0)
+            self.assertEqual(f.read(), data)
+        self.assertEqual(len(dm.requests), 4)
+
+
+class TestHedgePolicy(unittest.TestCase):
+    """
+    Tests for the policy deciding when to hedge requests.
+    """
+    def test_too_few_samples(self):
+        policy = transfer.HedgePolicy(90, min_samples=3)
+        self.assertIsNone(policy.delay())
+        policy.record(1)
+        policy.record(2)
+        self.assertIsNone(policy.delay())
+        policy.record(3)
+        self.assertEqual(policy.delay(), 3)
+
+    def test_percentiles(self):
+        for percentile, delay in [(1, 1), (50, 50), (90, 90), (95.5, 96), (100, 100)]:
+            policy = transfer.HedgePolicy(percentile)
+            for latency in reversed(range(1, 101)):
+                policy.record(latency)
+            self.assertEqual(policy.delay(), delay)
+
+    def test_max_samples(self):
+        policy = transfer.HedgePolicy(100)
+        policy.record(1000)
+        for _ in range(transfer.HEDGE_MAX_SAMPLES):
+            policy.record(1)
+        self.assertEqual(policy.delay(), 1)
+
+    def test_bad_percentile(self):
+        for percentile in [0, -1, 100.1]:
+            self.assertRaises(ValueError, transfer.HedgePolicy, percentile)
+
+
+class HedgingDownloadManager(TestDownloadManager):
+    """
+    Download manager that returns the data for each URL, except that the
+    first request for the specified slow URL waits until the release event is
+    set or the slow wait elapses, and the first request for the failing URL
+    fails.
+    """
+    def __init__(
+            self, test_ticket, output, data_map, slow=None, slow_wait=10,
+            failing=None, **kwargs):
+        super(HedgingDownloadManager, self).__init__(test_ticket, output, **kwargs)
+        self.data_map = data_map
+        self.slow = slow
+        self.slow_wait = slow_wait
+        self.failing = failing
+        self.release = threading.Event()
+        self.lock = threading.Lock()
+        self.attempt_counts = collections.Counter()
+
+    def _handle_http_url(self, url, headers, output, retry_state):
+        with self.lock:
+            self.attempt_counts[url] += 1
+            first = self.attempt_counts[url] == 1
+        if url == self.failing and first:
+            raise exceptions.ClientError("failed", "")
+        if url == self.slow and first:
+            self.release.wait(self.slow_wait)
+        data = self.data_map[url]
+        self._received(retry_state, len(data))
+        output.write(data)
+
+
+class TestHedgedDownloads(unittest.TestCase):
+    """
+    Tests for hedging requests for blocks that are slow to start.
+    """
+    def get_data_map(self, num_urls):
+        return collections.OrderedDict(
+            ("http://url.com/{}".format(j), str(j).encode() * (j + 1))
+            for j in range(num_urls))
+
+    def run_manager(self, data_map, **kwargs):
+        ticket = get_ticket(urls=[get_http_ticket(url) for url in data_map.keys()])
+        output = io.BytesIO()
+        events = []
+        dm = HedgingDownloadManager(
+            ticket, output, data_map, hedge_percentile=50, listener=events.append,
+            **kwargs)
+        try:
+            dm.run()
+        finally:
+            dm.release.set()
+        self.assertEqual(output.getvalue(), b"".join(data_map.values()))
+        return dm, events
+
+    def test_slow_block_hedged(self):
+        data_map = self.get_data_map(10)
+        for parallelism in [1, 3]:
+            dm, events = self.run_manager(
+                data_map, slow="http://url.com/8", parallelism=parallelism)
+            self.assertEqual(dm.attempt_counts["http://url.com/8"], 2)
+            hedges = [e for e in events if e.event_type == protocol.EVENT_HEDGE]
+            self.assertEqual([e.block for e in hedges], [8])
+            self.assertEqual(hedges[0].url, "http://url.com/8")
+            self.assertGreaterEqual(hedges[0].duration, 0)
+
+    def test_not_hedged_without_samples(self):
+        data_map = self.get_data_map(10)
+        dm, events = self.run_manager(
+            data_map, slow="http://url.com/0", slow_wait=0.1)
+        self.assertEqual(dm.attempt_counts["http://url.com/0"], 1)
+        self.assertNotIn(
+            protocol.EVENT_HEDGE, [e.event_type for e in events])
+
+    def test_fast_blocks_not_hedged(self):
+        data_map = self.get_data_map(10)
+        dm, events = self.run_manager(data_map)
+        self.assertEqual(set(dm.attempt_counts.values()), {1})
+        self.assertNotIn(
+            protocol.EVENT_HEDGE, [e.event_type for e in events])
+
+    def test_failure(self):
+        data_map = self.get_data_map(3)
+        self.assertRaises(
+            exceptions.ClientError, self.run_manager, data_map,
+            failing="http://url.com/1")
+
+    def test_data_uri_not_hedged(self):
+        data_uri = "data:application/vnd.ga4gh.bam;base64,SGVsbG8sIFdvcmxkIQ=="
+        output = io.BytesIO()
+        dm = HedgingDownloadManager(
+            get_ticket(urls=[get_data_uri_ticket(data_uri)]), output, {},
+            hedge_percentile=50)
+        dm.run()
+        self.assertEqual(output.getvalue(), b"Hello, World!")
+
+
+class TestSharedBlocks(unittest.TestCase):
+    """
+    Tests for sharing blocks between transfers.
+    """
+    def get_download(self, data, downloads):
+        def download():
+            downloads.append(data)
+            buf = tempfile.SpooledTemporaryFile()
+            buf.write(data)
+            return buf
+        return download
+
+    def test_key(self):
+        key = transfer.SharedBlocks.key
+        header_items = (("a", "b"),)
+        descriptor = range_descriptor("http://a.com", 0, 9, header_items)
+        self.assertEqual(
+            key(descriptor), key(range_descriptor("http://a.com", 0, 9, header_items)))
+        self.assertNotEqual(
+            key(descriptor), key(range_descriptor("http://a.com", 0, 10, header_items)))
+        self.assertNotEqual(
+            key(descriptor), key(range_descriptor("http://b.com", 0, 9, header_items)))
+        self.assertIsNone(transfer.SharedBlocks.key(
+            protocol.BlockDescriptor("http://a.com", (("a", ["b"]),))))
+
+    def test_shared(self):
+        descriptors = [
+            range_descriptor("http://a.com", start, end)
+            for start, end in [(0, 9), (10, 19), (0, 9), (0, 9)]]
+        shared_blocks = transfer.SharedBlocks(descriptors)
+        downloads = []
+        outputs = [io.BytesIO() for _ in descriptors]
+        for j, descriptor in enumerate(descriptors):
+            data = str(j).encode() * 10
+            shared_blocks.write(
+                descriptor, self.get_download(data, downloads), outputs[j])
+        self.assertEqual(downloads, [b"0" * 10, b"1" * 10])
+        self.assertEqual(
+            [output.getvalue() for output in outputs], [b"0" * 10, b"1" * 10] + [
+                b"0" * 10] * 2)
+        self.assertEqual(shared_blocks.num_downloads, 2)
+        self.assertEqual(shared_blocks.entries, {})
+
+    def test_concurrent(self):
+        descriptor = range_descriptor("http://a.com", 0, 9)
+        shared_blocks = transfer.SharedBlocks([descriptor] * 10)
+        downloads = []
+        outputs = [io.BytesIO() for _ in range(10)]
+        threads = [
+            threading.Thread(target=shared_blocks.write, args=(
+                descriptor, self.get_download(b"x" * 10, downloads), output))
+            for output in outputs]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(downloads, [b"x" * 10])
+        for output in outputs:
+            self.assertEqual(output.getvalue(), b"x" * 10)
+
+    def test_error(self):
+        descriptor = range_descriptor("http://a.com", 0, 9)
+        shared_blocks = transfer.SharedBlocks([descriptor] * 2)
+
+        def download():
+            raise exceptions.ClientError("404", "")
+
+        for _ in range(2):
+            self.assertRaises(
+                exceptions.ClientError, shared_blocks.write, descriptor, download,
+                io.BytesIO())
+        self.assertEqual(shared_blocks.entries, {})
+
+    def test_close(self):
+        descriptor = range_descriptor("http://a.com", 0, 9)
+        shared_blocks = transfer.SharedBlocks([descriptor] * 2)
+        shared_blocks.write(descriptor, self.get_download(b"x", []), io.BytesIO())
+        buf = shared_blocks.entries[shared_blocks.key(descriptor)].buf
+        self.assertFalse(buf.closed)
+        shared_blocks.close()
+        self.assertTrue(buf.closed)
+        self.assertEqual(shared_blocks.entries, {})
+
+    def test_managers(self):
+        data_map = collections.OrderedDict(
+            ("http://url.com/{}".format(j), str(j).encode() * 10) for j in range(4))
+        tickets = [
+            get_ticket(urls=[get_http_ticket(url) for url in urls])
+            for urls in [list(data_map)[:3], list(data_map)[1:]]]
+        managers = [
+            ParallelDownloadManager(ticket, io.BytesIO(), data_map)
+            for ticket in tickets]
+        plans = [manager._plan() for manager in managers]
+        shared_blocks = transfer.SharedBlocks(plans[0] + plans[1])
+        for manager, plan in zip(managers, plans):
+            manager._run_shared(plan, shared_blocks)
+        values = list(data_map.values())
+        self.assertEqual(managers[0].output.getvalue(), b"".join(values[:3]))
+        self.assertEqual(managers[1].output.getvalue(), b"".join(values[1:]))
+        self.assertEqual(managers[0].attempt_counts + managers[1].attempt_counts, {
+            url: 1 for url in data_map})
+        self.assertEqual(
+            managers[1].digest, hashlib.md5(managers[1].output.getvalue()).hexdigest())
+
+
+class ResumingDownloadManager(TestDownloadManager):
+    """
+    Download manager that writes the first half of the data for each URL
+    and fails on the first attempt, and resumes from the data written on the
+    second.
+    """
+    def __init__(self, test_ticket, output, data_map, **kwargs):
+        super(ResumingDownloadManager, self).__init__(test_ticket, output, **kwargs)
+        self.attempt_counts = collections.Counter()
+        self.data_map = data_map
+
+    def _handle_http_url(self, url, headers, output, retry_state):
+        self.attempt_counts[url] += 1
+        data = self.data_map[url]
+        retry_state.handle_response(200 if retry_state.offset == 0 else 206, {})
+        if self.attempt_counts[url] == 1:
+            output.write(data[:len(data) // 2])
+            raise exceptions.TruncatedContentError()
+        output.write(data[retry_state.offset:])
+
+
+class TestDigests(unittest.TestCase):
+    """
+    Tests for verifying the MD5 given in the ticket.
+    """
+    def get_data_map(self, num_urls):
+        return collections.OrderedDict(
+            ("http://url.com/{}".format(j), str(j).encode() * (j + 10))
+            for j in range(num_urls))
+
+    def get_ticket(self, data_map, md5=None):
+        urls = [get_http_ticket(url) for url in data_map.keys()]
+        data_uri = "data:application/vnd.ga4gh.bam;base64,SGVsbG8sIFdvcmxkIQ=="
+        urls.insert(1, get_data_uri_ticket(data_uri))
+        values = list(data_map.values())
+        values.insert(1, b"Hello, World!")
+        data = b"".join(values)
+        if md5 is None:
+            md5 = hashlib.md5(data).hexdigest()
+        return get_ticket(urls=urls, md5=md5), data
+
+    def test_digest(self):
+        data_map = self.get_data_map(5)
+        failing = list(data_map.keys())[2:4]
+        for parallelism in [1, 3]:
+            ticket, data = self.get_ticket(data_map)
+            output = io.BytesIO()
+            with mock.patch("logging.warning"):
+                dm = ParallelDownloadManager(
+                    ticket, output, data_map, failing=failing,
+                    parallelism=parallelism, retry_wait=0)
+                dm.run()
+            self.assertEqual(output.getvalue(), data)
+            self.assertEqual(dm.digest, hashlib.md5(data).hexdigest())
+
+    def test_digest_resumed(self):
+        data_map = self.get_data_map(5)
+        for parallelism in [1, 3]:
+            ticket, data = self.get_ticket(data_map)
+            output = io.BytesIO()
+            with mock.patch("logging.warning"):
+                dm = ResumingDownloadManager(
+                    ticket, output, data_map, parallelism=parallelism,
+                    retry_wait=0)
+                dm.run()
+            self.assertEqual(output.getvalue(), data)
+            self.assertEqual(dm.digest, hashlib.md5(data).hexdigest())
+
+    def test_upper_case_md5(self):
+        data_map = self.get_data_map(2)
+        ticket, data = self.get_ticket(data_map)
+        ticket["md5"] = ticket["md5"].upper()
+        dm = ParallelDownloadManager(ticket, io.BytesIO(), data_map)
+        dm.run()
+        self.assertEqual(dm.digest, hashlib.md5(data).hexdigest())
+
+    def test_no_md5(self):
+        data_map = self.get_data_map(2)
+        ticket, data = self.get_ticket(data_map)
+        del ticket["md5"]
+        dm = ParallelDownloadManager(ticket, io.BytesIO(), data_map)
+        dm.run()
+        self.assertEqual(dm.digest, hashlib.md5(data).hexdigest())
+
+    def test_mismatch(self):
+        data_map = self.get_data_map(3)
+        for parallelism in [1, 2]:
+            ticket, data = self.get_ticket(data_map, md5="0" * 32)
+            dm = ParallelDownloadManager(
+                ticket, io.BytesIO(), data_map, parallelism=parallelism)
+            with self.assertRaises(exceptions.MD5MismatchError) as context:
+                dm.run()
+            self.assertEqual(context.exception.md5, "0" * 32)
+            self.assertEqual(context.exception.digest, hashlib.md5(data).hexdigest())
+
+
+class TestEvents(unittest.TestCase):
+    """
+    Tests for the events passed to transfer listeners.
+    """
+    def get_data_map(self, num_urls):
+        return collections.OrderedDict(
+            ("http://url.com/{}".format(j), str(j).encode() * (j + 1))
+            for j in range(num_urls))
+
+    def run_manager(self, data_map, **kwargs):
+        urls = [get_http_ticket(url) for url in data_map.keys()]
+        data_uri = "data:application/vnd.ga4gh.bam;base64,SGVsbG8sIFdvcmxkIQ=="
+        urls.append(get_data_uri_ticket(data_uri))
+        events = []
+        with mock.patch("logging.warning"):
+            dm = ParallelDownloadManager(
+                get_ticket(urls=urls), io.BytesIO(), data_map, retry_wait=0,
+                listener=events.append, **kwargs)
+            dm.run()
+        return events
+
+    def assert_events_ok(self, events, data_map, failing):
+        event_types = [event.event_type for event in events]
+        self.assertEqual(event_types[:2], [
+            protocol.EVENT_TICKET_START, protocol.EVENT_TICKET_END])
+        self.assertEqual(events[0].url, EXAMPLE_URL)
+        self.assertEqual(event_types[-1], protocol.EVENT_TRANSFER_END)
+        num_blocks = len(data_map) + 1
+        total_size = sum(len(data) for data in data_map.values()) + 13
+        self.assertEqual(events[-1].size, total_size)
+        self.assertIsNone(events[-1].error)
+        times = [event.time for event in events]
+        self.assertEqual(times, sorted(times))
+        starts = [e for e in events if e.event_type == protocol.EVENT_BLOCK_START]
+        ends = [e for e in events if e.event_type == protocol.EVENT_BLOCK_END]
+        self.assertEqual(sorted(e.block for e in starts), list(range(num_blocks)))
+        self.assertEqual(sorted(e.block for e in ends), list(range(num_blocks)))
+        for block, (url, data) in enumerate(data_map.items()):
+            start = [e for e in starts if e.block == block][0]
+            end = [e for e in ends if e.block == block][0]
+            self.assertEqual(start.url, url)
+            self.assertEqual(end.size, len(data))
+            self.assertEqual(end.attempt, 2 if url in failing else 1)
+            self.assertGreaterEqual(end.duration, 0)
+            self.assertIsNone(end.error)
+        data_end = [e for e in ends if e.block == num_blocks - 1][0]
+        self.assertIsNone(data_end.url)
+        self.assertEqual(data_end.size, 13)
+        retries = [e for e in events if e.event_type == protocol.EVENT_RETRY]
+        self.assertEqual(
+            sorted(e.block for e in retries),
+            [list(data_map.keys()).index(url) for url in failing])
+        for event in retries:
+            self.assertEqual(event.attempt, 1)
+            self.assertEqual(event.wait, 0)
+            self.assertIsInstance(event.error, exceptions.RetryableError)
+
+    def test_sequential(self):
+        data_map = self.get_data_map(5)
+        failing = list(data_map.keys())[1:3]
+        events = self.run_manager(data_map, failing=failing)
+        self.assert_events_ok(events, data_map, failing)
+        # Blocks are downloaded in order.
+        block_events = [
+            (e.event_type, e.block) for e in events
+            if e.event_type in [protocol.EVENT_BLOCK_START, protocol.EVENT_BLOCK_END]]
+        self.assertEqual(block_events, [
+            (event_type, j) for j in range(6)
+            for event_type in [protocol.EVENT_BLOCK_START, protocol.EVENT_BLOCK_END]])
+
+    def test_parallel(self):
+        data_map = self.get_data_map(10)
+        failing = list(data_map.keys())[4:5]
+        events = self.run_manager(data_map, failing=failing, parallelism=4)
+        self.assert_events_ok(events, data_map, failing)
+
+    def test_failure(self):
+        data_map = self.get_data_map(3)
+        events = []
+        ticket = get_ticket(urls=[get_http_ticket(url) for url in data_map.keys()])
+        dm = RetryCountDownloadManager(
+            ticket, io.BytesIO(), max_retries=0, listener=events.append)
+        self.assertRaises(exceptions.RetryableError, dm.run)
+        self.assertEqual(
+            [event.event_type for event in events], [
+                protocol.EVENT_TICKET_START, protocol.EVENT_TICKET_END,
+                protocol.EVENT_BLOCK_START, protocol.EVENT_BLOCK_END,
+                protocol.EVENT_TRANSFER_END])
+        for event in events[-2:]:
+            self.assertIsInstance(event.error, exceptions.RetryableError)
+        self.assertEqual(events[-1].size, 0)
+
+    def test_received(self):
+        events = []
+        dm = TestDownloadManager(get_ticket(), io.BytesIO(), listener=events.append)
+        retry_state = dm._retry_state(io.BytesIO(), 3)
+        retry_state.attempt_start = protocol.clock()
+        dm._received(retry_state, 10)
+        dm._received(retry_state, 5)
+        self.assertEqual(
+            [(e.event_type, e.block, e.size) for e in events], [
+                (protocol.EVENT_FIRST_BYTE, 3, None), (protocol.EVENT_PROGRESS, 3, 10),
+                (protocol.EVENT_PROGRESS, 3, 5)])
+        self.assertEqual(events[0].attempt, 1)
+        self.assertGreaterEqual(events[0].duration, 0)
+        self.assertEqual(retry_state.received, 15)
+
+    def test_no_listener(self):
+        dm = TestDownloadManager(get_ticket(), io.BytesIO())
+        retry_state = dm._retry_state(io.BytesIO())
+        dm._received(retry_state, 10)
+        self.assertEqual(retry_state.received, 10)
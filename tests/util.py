@@ -0,0 +1,72 @@
+#
+# Copyright 2016 University of Oxford
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Helpers shared by the download manager test cases.
+"""
+from __future__ import print_function
+from __future__ import division
+
+import collections
+
+import htsget.protocol as protocol
+import htsget.transfer as transfer
+import htsget.exceptions as exceptions
+
+EXAMPLE_URL = "http://example.com"
+
+
+def get_http_ticket(url, headers={}):
+    return {"url": url, "headers": headers}
+
+
+def get_data_uri_ticket(url):
+    return {"url": url}
+
+
+def get_ticket(urls=[], format_=None, md5=None):
+    d = {"urls": urls}
+    if format_ is not None:
+        d["format"] = format_
+    if md5 is not None:
+        d["md5"] = md5
+    return d
+
+
+def range_descriptor(url, start, end, header_items=()):
+    return protocol.BlockDescriptor(url, header_items, start, end)
+
+
+class TestDownloadManager(transfer.TransferManager):
+    """
+    Test download manager that stores a ticket.
+    """
+    def __init__(self, test_ticket, output, **kwargs):
+        super(TestDownloadManager, self).__init__(EXAMPLE_URL, output, **kwargs)
+        self.test_ticket = test_ticket
+
+    def _handle_ticket_request(self):
+        self.ticket = self.test_ticket
+
+
+class RetryCountDownloadManager(TestDownloadManager):
+
+    def __init__(self, test_ticket, output, **kwargs):
+        super(RetryCountDownloadManager, self).__init__(test_ticket, output, **kwargs)
+        self.attempt_counts = collections.Counter()
+
+    def _handle_http_url(self, url, headers, output, retry_state):
+        self.attempt_counts[url] += 1
+        raise exceptions.RetryableError()